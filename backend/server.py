@@ -1,45 +1,1016 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Form, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Form, UploadFile, File, Header, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReturnDocument, monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure, ExecutionTimeout
 import os
+import abc
 import logging
+import logging.handlers
+import queue
+import random
+import atexit
+import asyncio
+import hashlib
+import json
+import heapq
+import bisect
+import re
+import time
+import unicodedata
+import threading
+import socket
+import contextvars
+import functools
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from typing import List, Optional, Dict, Any, Set
 import uuid
 from datetime import datetime, timedelta
 import bcrypt
 import jwt
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as RLImage
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
 import io
 import base64
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# MongoDB connection settings
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+class MongoSettings(BaseModel):
+    url: str
+    db_name: str = 'inventory_db'
+    app_name: str = 'inventory-api'
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+    connect_timeout_ms: int = 20000
+    socket_timeout_ms: Optional[int] = None
+    server_selection_timeout_ms: int = 30000
+    compressors: Optional[str] = None  # e.g. 'zstd,snappy,zlib'
+    retry_writes: bool = True
+    read_preference: str = 'primary'
+    report_read_preference: str = 'secondaryPreferred'  # dashboard, stock and exports
+    
+    @field_validator('read_preference', 'report_read_preference')
+    @classmethod
+    def check_read_preference(cls, value: str) -> str:
+        if value not in READ_PREFERENCES:
+            raise ValueError(f"read preference must be one of {', '.join(READ_PREFERENCES)}")
+        return value
+    
+    @classmethod
+    def from_env(cls) -> 'MongoSettings':
+        values = {'url': os.environ['MONGO_URL']}
+        for field in cls.model_fields:
+            env_value = os.environ.get('DB_NAME' if field == 'db_name' else f'MONGO_{field.upper()}')
+            if field != 'url' and env_value is not None:
+                values[field] = env_value
+        return cls(**values)
+    
+    def client_options(self) -> dict:
+        options = {
+            'appname': self.app_name,
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'maxIdleTimeMS': self.max_idle_time_ms,
+            'waitQueueTimeoutMS': self.wait_queue_timeout_ms,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'socketTimeoutMS': self.socket_timeout_ms,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'compressors': self.compressors,
+            'retryWrites': self.retry_writes,
+            'readPreference': self.read_preference,
+        }
+        return {key: value for key, value in options.items() if value is not None}
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    # Motor checks connections out on its executor threads, so the start time
+    # of a checkout can be kept thread-local until it completes or fails
+    BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.checkouts = 0
+        self.failed_checkouts = defaultdict(int)
+        self.checked_out = 0
+        self.open_connections = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.recent_wait_ms = 0.0  # exponentially weighted, used for load shedding
+        self.wait_histogram = defaultdict(int)
+    
+    def _finish(self) -> float:
+        started = getattr(self.local, 'started', None)
+        self.local.started = None
+        return (time.perf_counter() - started) * 1000 if started else 0.0
+    
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+    
+    def connection_checked_out(self, event):
+        wait_ms = self._finish()
+        bucket = next((f"le_{limit}ms" for limit in self.BUCKETS_MS if wait_ms <= limit), "gt_1000ms")
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.recent_wait_ms = 0.8 * self.recent_wait_ms + 0.2 * wait_ms
+            self.wait_histogram[bucket] += 1
+    
+    def connection_check_out_failed(self, event):
+        self._finish()
+        with self.lock:
+            self.failed_checkouts[event.reason] += 1
+    
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+    
+    def connection_created(self, event):
+        with self.lock:
+            self.open_connections += 1
+    
+    def connection_closed(self, event):
+        with self.lock:
+            self.open_connections -= 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+    
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "max_pool_size": mongo_settings.max_pool_size,
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "failed_checkouts": dict(self.failed_checkouts),
+                "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+                "recent_wait_ms": self.recent_wait_ms,
+                "wait_histogram": dict(self.wait_histogram)
+            }
+
+# Logging
+# Handlers write from a QueueListener thread; the event loop only enqueues
+# records. Each request gets an ID (taken from X-Request-ID or generated) that
+# is stamped on every log line and sent to Mongo as the command comment, so a
+# slow request can be matched to its entries in the profiler and slow query log.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # 'json' or 'text'
+LOG_SLOW_REQUEST_MS = float(os.environ.get('LOG_SLOW_REQUEST_MS', 1000))
+MONGO_SLOW_COMMAND_MS = float(os.environ.get('MONGO_SLOW_COMMAND_MS', 500))
+# Fraction of successful, fast requests logged per path prefix (longest match
+# wins); errors and slow requests are always logged
+LOG_SAMPLE_RATES: Dict[str, float] = {
+    "/api/products/search": 0.01,
+    "/api/customers/lookup": 0.01,
+    "/api/sync": 0.05,
+    "/api/dashboard": 0.1,
+    "/api/metrics": 0.0,
+}
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('request_id', default=None)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = request_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    # Attributes every LogRecord has; anything else was passed via extra=
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+    
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging() -> logging.handlers.QueueListener:
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # The filter runs on the calling thread, where the request context is visible
+    queue_handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
+
+def command_comment() -> Optional[str]:
+    return request_id.get()
+
+def log_sample_rate(path: str) -> float:
+    matches = [prefix for prefix in LOG_SAMPLE_RATES if path.startswith(prefix)]
+    return LOG_SAMPLE_RATES[max(matches, key=len)] if matches else 1.0
+
+class SlowCommandLogger(monitoring.CommandListener):
+    # Runs on Motor's executor threads, where the request context is not
+    # available; the request ID comes back from the command's comment
+    def __init__(self):
+        self.commands = {}
+    
+    def started(self, event):
+        self.commands[event.request_id] = (event.command.get('comment'), event.command.get(event.command_name))
+    
+    def succeeded(self, event):
+        self._finish(event, None)
+    
+    def failed(self, event):
+        self._finish(event, event.failure)
+    
+    def _finish(self, event, failure):
+        comment, target = self.commands.pop(event.request_id, (None, None))
+        duration_ms = event.duration_micros / 1000
+        if duration_ms >= MONGO_SLOW_COMMAND_MS or failure:
+            logger.warning("Slow or failed Mongo command", extra={
+                "request_id": comment,
+                "command": event.command_name,
+                "target": target if isinstance(target, str) else None,
+                "duration_ms": round(duration_ms, 1),
+                "failure": failure,
+            })
+
+class RequestIdMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        current_id = incoming if REQUEST_ID_PATTERN.fullmatch(incoming) else uuid.uuid4().hex
+        token = request_id.set(current_id)
+        started = time.perf_counter()
+        status_code = 500
+        
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", current_id.encode("latin-1"))]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            if status_code >= 500 or duration_ms >= LOG_SLOW_REQUEST_MS or random.random() < log_sample_rate(scope["path"]):
+                access_logger.info(f"{scope['method']} {scope['path']} {status_code}", extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status_code,
+                    "duration_ms": round(duration_ms, 1),
+                })
+            request_id.reset(token)
+
+# Request deadlines
+# DeadlineMiddleware gives each request a time budget. Mongo reads issued
+# while it runs carry the remaining budget as maxTimeMS, so the server stops
+# working on them once the client could no longer use the answer.
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 10))
+DEADLINE_RETRY_AFTER_SECONDS = int(os.environ.get('DEADLINE_RETRY_AFTER_SECONDS', 2))
+# Longest matching path prefix wins; None disables the deadline (streams)
+ROUTE_DEADLINE_SECONDS: Dict[str, Optional[float]] = {
+    "/api/dashboard": 5,
+    "/api/stock": 5,
+    # Manually triggered all-branch batch jobs
+    "/api/stock/verify": None,
+    "/api/stock/snapshots": None,
+    "/api/stock/reorder/run": None,
+    "/api/customers/dedup": None,
+    "/api/sales/archive": None,
+    "/api/sales": 10,
+    "/api/products/search": 1,
+    "/api/customers/lookup": 1,
+    "/api/events": None,
+    "/api/analytics": 60,
+    "/api/exports": None,  # downloads stream large files
+}
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('request_deadline', default=None)
+
+def route_deadline_seconds(path: str) -> Optional[float]:
+    matches = [prefix for prefix in ROUTE_DEADLINE_SECONDS if path.startswith(prefix)]
+    if not matches:
+        return REQUEST_DEADLINE_SECONDS
+    return ROUTE_DEADLINE_SECONDS[max(matches, key=len)]
+
+def deadline_exceeded_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Request deadline exceeded"},
+        headers={"Retry-After": str(DEADLINE_RETRY_AFTER_SECONDS)}
+    )
+
+def remaining_ms() -> Optional[int]:
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    remaining = int((deadline - time.monotonic()) * 1000)
+    if remaining <= 0:
+        raise HTTPException(status_code=503, detail="Request deadline exceeded", headers={"Retry-After": str(DEADLINE_RETRY_AFTER_SECONDS)})
+    return remaining
+
+class DeadlineCollection:
+    # Adds maxTimeMS to reads and the request ID as the comment on reads and
+    # writes; everything else goes straight to the collection
+    COMMENTED_WRITES = {
+        'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+        'delete_one', 'delete_many', 'find_one_and_update', 'bulk_write',
+    }
+    
+    def __init__(self, collection):
+        self._collection = collection
+    
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self.COMMENTED_WRITES:
+            return attribute
+        
+        def with_comment(*args, **kwargs):
+            comment = command_comment()
+            if comment:
+                kwargs.setdefault('comment', comment)
+            return attribute(*args, **kwargs)
+        return with_comment
+    
+    def _read_options(self, kwargs: dict, max_time_key: str = 'maxTimeMS') -> dict:
+        budget = remaining_ms()
+        if budget:
+            kwargs.setdefault(max_time_key, budget)
+        comment = command_comment()
+        if comment:
+            kwargs.setdefault('comment', comment)
+        return kwargs
+    
+    def find(self, *args, **kwargs):
+        return self._collection.find(*args, **self._read_options(kwargs, 'max_time_ms'))
+    
+    def aggregate(self, pipeline, *args, **kwargs):
+        return self._collection.aggregate(pipeline, *args, **self._read_options(kwargs))
+    
+    async def find_one(self, *args, **kwargs):
+        return await self._collection.find_one(*args, **self._read_options(kwargs, 'max_time_ms'))
+    
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self._collection.count_documents(filter, *args, **self._read_options(kwargs))
+    
+    async def distinct(self, key, *args, **kwargs):
+        return await self._collection.distinct(key, *args, **self._read_options(kwargs))
+
+class DeadlineDatabase:
+    def __init__(self, database):
+        self._database = database
+    
+    def _wrap(self, attribute):
+        # Collections are wrapped; database methods such as watch() pass through
+        return DeadlineCollection(attribute) if hasattr(attribute, 'insert_one') else attribute
+    
+    def __getattr__(self, name):
+        return self._wrap(getattr(self._database, name))
+    
+    def __getitem__(self, name):
+        return self._wrap(self._database[name])
+
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        budget = route_deadline_seconds(scope["path"])
+        if budget is None:
+            return await self.app(scope, receive, send)
+        
+        deadline_token = request_deadline.set(time.monotonic() + budget)
+        response_started = False
+        # This middleware is the only reader of receive(); the app reads from
+        # the queue, which leaves us free to notice the client hanging up
+        messages: asyncio.Queue = asyncio.Queue()
+        
+        async def app_receive():
+            return await messages.get()
+        
+        async def app_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        handler = asyncio.ensure_future(self.app(scope, app_receive, app_send))
+        
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not handler.done():
+                        handler.cancel()
+                    return
+        
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await asyncio.wait_for(asyncio.shield(handler), timeout=budget)
+        except asyncio.TimeoutError:
+            handler.cancel()
+            if not response_started:
+                await deadline_exceeded_response()(scope, receive, send)
+        except asyncio.CancelledError:
+            if not handler.cancelled():
+                raise
+            # The client disconnected; there is nobody to respond to
+        finally:
+            watcher.cancel()
+            if not handler.done():
+                handler.cancel()
+            request_deadline.reset(deadline_token)
+
+# Admission control
+# Routes are tagged with a priority class via @priority(). Each class has its
+# own concurrency limit and wait-queue bound; requests beyond both get 429.
+# Best-effort classes are also shed up front while the event loop is lagging
+# or Mongo pool checkouts are slow, keeping capacity for checkout and login.
+SHED_LOOP_LAG_MS = float(os.environ.get('SHED_LOOP_LAG_MS', 200))
+SHED_POOL_WAIT_MS = float(os.environ.get('SHED_POOL_WAIT_MS', 100))
+SHED_RETRY_AFTER_SECONDS = int(os.environ.get('SHED_RETRY_AFTER_SECONDS', 5))
+# class -> (concurrency limit, queue bound, shed under pressure)
+PRIORITY_CLASSES = {
+    "critical": (int(os.environ.get('CRITICAL_CONCURRENCY', 200)), int(os.environ.get('CRITICAL_QUEUE', 1000)), False),
+    "normal": (int(os.environ.get('NORMAL_CONCURRENCY', 100)), int(os.environ.get('NORMAL_QUEUE', 200)), False),
+    "best_effort": (int(os.environ.get('BEST_EFFORT_CONCURRENCY', 8)), int(os.environ.get('BEST_EFFORT_QUEUE', 16)), True),
+}
+
+def priority(priority_class: str):
+    # 'stream' marks long-lived routes that are not admission controlled
+    if priority_class not in PRIORITY_CLASSES and priority_class != 'stream':
+        raise ValueError(f"Unknown priority class {priority_class}")
+    def decorator(endpoint):
+        endpoint.priority_class = priority_class
+        return endpoint
+    return decorator
+
+class AdmissionClass:
+    def __init__(self, name: str, limit: int, queue_limit: int, shed_under_pressure: bool):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.shed_under_pressure = shed_under_pressure
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+    
+    def snapshot(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected,
+            "shed": self.shed,
+            "avg_wait_ms": self.total_wait_ms / self.admitted if self.admitted else 0.0,
+            "max_wait_ms": self.max_wait_ms
+        }
+
+class AdmissionController:
+    def __init__(self, classes: Dict[str, tuple]):
+        self.classes = {name: AdmissionClass(name, *config) for name, config in classes.items()}
+        self.loop_lag_ms = 0.0
+    
+    def under_pressure(self) -> bool:
+        return self.loop_lag_ms > SHED_LOOP_LAG_MS or pool_metrics.recent_wait_ms > SHED_POOL_WAIT_MS
+    
+    def reject(self, detail: str):
+        raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(SHED_RETRY_AFTER_SECONDS)})
+    
+    @asynccontextmanager
+    async def admit(self, name: str):
+        admission_class = self.classes[name]
+        if admission_class.shed_under_pressure and self.under_pressure():
+            admission_class.shed += 1
+            self.reject("Server busy, try again later")
+        if admission_class.semaphore.locked() and admission_class.waiting >= admission_class.queue_limit:
+            admission_class.rejected += 1
+            self.reject("Too many queued requests, try again later")
+        
+        admission_class.waiting += 1
+        started = time.perf_counter()
+        try:
+            await admission_class.semaphore.acquire()
+        finally:
+            admission_class.waiting -= 1
+        wait_ms = (time.perf_counter() - started) * 1000
+        admission_class.admitted += 1
+        admission_class.total_wait_ms += wait_ms
+        admission_class.max_wait_ms = max(admission_class.max_wait_ms, wait_ms)
+        admission_class.in_flight += 1
+        try:
+            yield
+        finally:
+            admission_class.in_flight -= 1
+            admission_class.semaphore.release()
+    
+    async def monitor_loop_lag(self, interval: float = 0.1):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag_ms = max(0.0, (loop.time() - started - interval) * 1000)
+            self.loop_lag_ms = 0.7 * self.loop_lag_ms + 0.3 * lag_ms
+    
+    def snapshot(self) -> dict:
+        return {
+            "loop_lag_ms": self.loop_lag_ms,
+            "pool_wait_ms": pool_metrics.recent_wait_ms,
+            "under_pressure": self.under_pressure(),
+            "classes": {name: admission_class.snapshot() for name, admission_class in self.classes.items()}
+        }
+
+admission = AdmissionController(PRIORITY_CLASSES)
+loop_lag_task: Optional[asyncio.Task] = None
+
+async def admit_request(request: Request):
+    priority_class = getattr(request.scope.get("endpoint"), "priority_class", "normal")
+    if priority_class not in admission.classes:
+        yield
+        return
+    async with admission.admit(priority_class):
+        yield
+
 # MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'inventory_db')]
+mongo_settings = MongoSettings.from_env()
+pool_metrics = PoolMetrics()
+client = AsyncIOMotorClient(mongo_settings.url, event_listeners=[pool_metrics, SlowCommandLogger()], **mongo_settings.client_options())
+db = DeadlineDatabase(client[mongo_settings.db_name])
+# Reporting reads (dashboard, stock, exports) may be served by secondaries
+reporting_db = DeadlineDatabase(client.get_database(
+    mongo_settings.db_name,
+    read_preference=READ_PREFERENCES[mongo_settings.report_read_preference]()
+))
+
+# Storage repository
+# The operations routes need from a document store, behind one interface:
+# lookups with a small filter language (equality plus $in/$ne/$gt/$gte/$lt/
+# $lte on top-level fields), paged lists, grouped sums, an atomic
+# conditional stock decrement and named counters. This is an abstraction
+# with two tested implementations, not a storage switch: only the list reads,
+# the invoice counter and the sale's stock decrement go through `repository`
+# (always a MongoRepository); every other route uses db directly, so the app
+# still needs MongoDB. SQLiteRepository keeps JSON documents in SQLite (WAL
+# mode). tests/test_repository.py checks both against the same behaviour and
+# benchmarks/repository_benchmark.py times them.
+REPOSITORY_FILTER_OPERATORS = {"$in", "$ne", "$gt", "$gte", "$lt", "$lte"}
+REPOSITORY_FIELD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def check_repository_filter(filter: dict):
+    for field, condition in filter.items():
+        if not REPOSITORY_FIELD_PATTERN.fullmatch(field):
+            raise ValueError(f"Unsupported field {field!r}")
+        if isinstance(condition, dict) and not set(condition) <= REPOSITORY_FILTER_OPERATORS:
+            raise ValueError(f"Unsupported operators in {condition!r}")
+
+class Repository(abc.ABC):
+    @abc.abstractmethod
+    async def find(self, collection: str, filter: dict, sort: Optional[List[tuple]] = None, limit: Optional[int] = None, fields: Optional[List[str]] = None, skip: int = 0) -> List[dict]:
+        raise NotImplementedError
+    
+    async def find_one(self, collection: str, filter: dict) -> Optional[dict]:
+        rows = await self.find(collection, filter, limit=1)
+        return rows[0] if rows else None
+    
+    @abc.abstractmethod
+    async def insert_many(self, collection: str, documents: List[dict]):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def update_one(self, collection: str, filter: dict, fields: dict) -> bool:
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def list_page(self, collection: str, filter: dict, sort_field: str, page: int, page_size: int) -> tuple:
+        # Returns (documents on the page, total matching documents)
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def summarize(self, collection: str, filter: dict, group_by: Optional[str], sums: Dict[str, List[str]]) -> List[dict]:
+        # sums maps an output name to the fields multiplied per document, e.g.
+        # {"value": ["quantity", "purchase_price"]}; rows carry the group in _id
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def decrement_stock(self, product_id: str, quantity: int, fields: Optional[dict] = None) -> Optional[dict]:
+        # Takes quantity off a product only if that much is in stock and returns
+        # the updated product, or None when the product is missing or short
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def next_sequence(self, name: str, count: int = 1) -> int:
+        # Advances a named counter by count and returns its new value
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def seed_sequence(self, name: str, value: int):
+        # Raises a counter to at least value
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    async def ensure_index(self, collection: str, fields: List[str]):
+        raise NotImplementedError
+
+class MongoRepository(Repository):
+    def __init__(self, database):
+        self.database = database
+    
+    async def find(self, collection, filter, sort=None, limit=None, fields=None, skip=0):
+        check_repository_filter(filter)
+        projection = {"_id": 0, **{field: 1 for field in fields}} if fields else {"_id": 0}
+        cursor = self.database[collection].find(filter, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(limit)
+    
+    async def insert_many(self, collection, documents):
+        if documents:
+            # insert_many adds _id to the documents it is given
+            await self.database[collection].insert_many([dict(document) for document in documents])
+    
+    async def update_one(self, collection, filter, fields):
+        check_repository_filter(filter)
+        result = await self.database[collection].update_one(filter, {"$set": fields})
+        return result.matched_count > 0
+    
+    async def list_page(self, collection, filter, sort_field, page, page_size):
+        check_repository_filter(filter)
+        documents, total = await asyncio.gather(
+            self.find(collection, filter, sort=[(sort_field, 1)], limit=page_size, skip=(page - 1) * page_size),
+            self.database[collection].count_documents(filter)
+        )
+        return documents, total
+    
+    async def summarize(self, collection, filter, group_by, sums):
+        check_repository_filter(filter)
+        group = {"_id": f"${group_by}" if group_by else None}
+        for name, factors in sums.items():
+            group[name] = {"$sum": {"$multiply": [f"${factor}" for factor in factors]} if len(factors) > 1 else f"${factors[0]}"}
+        return await self.database[collection].aggregate([{"$match": filter}, {"$group": group}, {"$sort": {"_id": 1}}]).to_list(None)
+    
+    async def decrement_stock(self, product_id, quantity, fields=None):
+        return await self.database.products.find_one_and_update(
+            {"id": product_id, "quantity": {"$gte": quantity}},
+            {"$inc": {"quantity": -quantity}, **({"$set": fields} if fields else {})},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def next_sequence(self, name, count=1):
+        counter = await self.database.counters.find_one_and_update(
+            {"_id": name}, {"$inc": {"seq": count}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"]
+    
+    async def seed_sequence(self, name, value):
+        await self.database.counters.update_one({"_id": name}, {"$max": {"seq": value}}, upsert=True)
+    
+    async def ensure_index(self, collection, fields):
+        await self.database[collection].create_index([(field, 1) for field in fields])
+
+class SQLiteRepository(Repository):
+    # One table per collection holding (id, JSON document). Datetimes are
+    # stored as {"$date": ISO-8601}, which sorts and compares correctly.
+    # aiosqlite runs one connection on one thread; the lock keeps a statement
+    # and its fetch or commit together so concurrent callers cannot interleave.
+    SQL_OPERATORS = {"$ne": "IS NOT", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.lock = asyncio.Lock()
+        self.tables: Set[str] = set()
+    
+    async def open(self):
+        import aiosqlite
+        self.connection = await aiosqlite.connect(self.path)
+        await self.connection.execute("PRAGMA journal_mode=WAL")
+        await self.connection.execute("PRAGMA synchronous=NORMAL")
+        await self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        await self.connection.commit()
+        return self
+    
+    async def close(self):
+        await self.connection.close()
+    
+    async def query(self, sql: str, params=(), commit: bool = False) -> list:
+        async with self.lock:
+            async with self.connection.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+            if commit:
+                await self.connection.commit()
+            return rows
+    
+    @staticmethod
+    def encode(document: dict) -> str:
+        def default(value):
+            if isinstance(value, datetime):
+                return {"$date": value.isoformat(timespec="microseconds")}
+            raise TypeError(f"Cannot store {type(value).__name__}")
+        return json.dumps(document, default=default)
+    
+    @staticmethod
+    def decode(text: str) -> dict:
+        def object_hook(value):
+            if len(value) == 1 and "$date" in value:
+                return datetime.fromisoformat(value["$date"])
+            return value
+        return json.loads(text, object_hook=object_hook)
+    
+    @staticmethod
+    def sql_value(value):
+        if isinstance(value, datetime):
+            return value.isoformat(timespec="microseconds")
+        if isinstance(value, bool):
+            return int(value)
+        return value
+    
+    @staticmethod
+    def field_sql(field: str) -> str:
+        if field == "id":
+            return "id"  # the primary key column mirrors the document id
+        # Plain values and {"$date": ...} values read through one expression
+        return f"""COALESCE(json_extract(doc, '$.{field}."$date"'), json_extract(doc, '$.{field}'))"""
+    
+    async def table(self, collection: str) -> str:
+        if not REPOSITORY_FIELD_PATTERN.fullmatch(collection):
+            raise ValueError(f"Unsupported collection {collection!r}")
+        if collection not in self.tables:
+            await self.query(f"CREATE TABLE IF NOT EXISTS {collection} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)", commit=True)
+            self.tables.add(collection)
+        return collection
+    
+    def where(self, filter: dict) -> tuple:
+        check_repository_filter(filter)
+        clauses, params = [], []
+        for field, condition in filter.items():
+            column = self.field_sql(field)
+            conditions = condition if isinstance(condition, dict) else {None: condition}
+            for operator, value in conditions.items():
+                if operator == "$in":
+                    clauses.append(f"{column} IN ({', '.join('?' * len(value))})" if value else "0")
+                    params.extend(self.sql_value(item) for item in value)
+                elif operator is None:
+                    clauses.append(f"{column} IS ?")
+                    params.append(self.sql_value(value))
+                else:
+                    clauses.append(f"{column} {self.SQL_OPERATORS[operator]} ?")
+                    params.append(self.sql_value(value))
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+    
+    async def find(self, collection, filter, sort=None, limit=None, fields=None, skip=0):
+        table = await self.table(collection)
+        where, params = self.where(filter)
+        sql = f"SELECT doc FROM {table}{where}"
+        if sort:
+            sql += " ORDER BY " + ", ".join(f"{self.field_sql(field)} {'DESC' if direction < 0 else 'ASC'}" for field, direction in sort)
+        if limit or skip:
+            sql += f" LIMIT {int(limit) if limit else -1} OFFSET {int(skip)}"
+        documents = [self.decode(row[0]) for row in await self.query(sql, params)]
+        if fields:
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        return documents
+    
+    async def insert_many(self, collection, documents):
+        table = await self.table(collection)
+        async with self.lock:
+            await self.connection.executemany(
+                f"INSERT INTO {table} (id, doc) VALUES (?, ?)",
+                [(document.get("id") or str(uuid.uuid4()), self.encode(document)) for document in documents]
+            )
+            await self.connection.commit()
+    
+    async def update_one(self, collection, filter, fields):
+        table = await self.table(collection)
+        where, params = self.where(filter)
+        assignments, values = self.json_set(fields)
+        rows = await self.query(
+            f"UPDATE {table} SET doc = {assignments} WHERE id = (SELECT id FROM {table}{where} LIMIT 1) RETURNING id",
+            [*values, *params], commit=True
+        )
+        return bool(rows)
+    
+    def json_set(self, fields: dict, base: str = "doc") -> tuple:
+        assignments, values = base, []
+        for field, value in fields.items():
+            check_repository_filter({field: None})
+            assignments = f"json_set({assignments}, '$.{field}', json(?))"
+            values.append(self.encode(value))
+        return assignments, values
+    
+    async def list_page(self, collection, filter, sort_field, page, page_size):
+        documents = await self.find(collection, filter, sort=[(sort_field, 1)], limit=page_size, skip=(page - 1) * page_size)
+        table = await self.table(collection)
+        where, params = self.where(filter)
+        total = (await self.query(f"SELECT COUNT(*) FROM {table}{where}", params))[0][0]
+        return documents, total
+    
+    async def summarize(self, collection, filter, group_by, sums):
+        table = await self.table(collection)
+        where, params = self.where(filter)
+        for field in [group_by or "id", *(factor for factors in sums.values() for factor in factors)]:
+            check_repository_filter({field: None})
+        totals = ", ".join(
+            f"TOTAL({' * '.join(self.field_sql(factor) for factor in factors)})" for factors in sums.values()
+        )
+        key = self.field_sql(group_by) if group_by else "NULL"
+        # Match Mongo: no matching documents, no summary row
+        rows = await self.query(f"SELECT {key}, {totals} FROM {table}{where} GROUP BY 1 HAVING COUNT(*) > 0 ORDER BY 1", params)
+        return [{"_id": row[0], **dict(zip(sums, row[1:]))} for row in rows]
+    
+    async def decrement_stock(self, product_id, quantity, fields=None):
+        table = await self.table("products")
+        # A single UPDATE is atomic, so concurrent sales cannot oversell
+        assignments, values = self.json_set(fields or {}, "json_set(doc, '$.quantity', json_extract(doc, '$.quantity') - ?)")
+        rows = await self.query(
+            f"UPDATE {table} SET doc = {assignments} WHERE id = ? AND json_extract(doc, '$.quantity') >= ? RETURNING doc",
+            [quantity, *values, product_id, quantity], commit=True
+        )
+        return self.decode(rows[0][0]) if rows else None
+    
+    async def next_sequence(self, name, count=1):
+        rows = await self.query(
+            "INSERT INTO counters (name, seq) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET seq = seq + excluded.seq RETURNING seq",
+            (name, count), commit=True
+        )
+        return rows[0][0]
+    
+    async def seed_sequence(self, name, value):
+        await self.query(
+            "INSERT INTO counters (name, seq) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET seq = MAX(seq, excluded.seq)",
+            (name, value), commit=True
+        )
+    
+    async def ensure_index(self, collection, fields):
+        table = await self.table(collection)
+        for field in fields:
+            check_repository_filter({field: None})
+        name = f"{table}_{'_'.join(fields)}"
+        await self.query(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(self.field_sql(field) for field in fields)})", commit=True)
+
+repository: Repository = MongoRepository(db)
 
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
 
+# Fan-out Configuration
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 8))
+SHARD_BY_BRANCH = os.environ.get('SHARD_BY_BRANCH', 'false').lower() == 'true'
+
+# Audit log Configuration
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.environ.get('AUDIT_FLUSH_INTERVAL_SECONDS', 1))
+AUDIT_ENQUEUE_TIMEOUT_SECONDS = float(os.environ.get('AUDIT_ENQUEUE_TIMEOUT_SECONDS', 0.05))
+AUDIT_RETENTION_DAYS = int(os.environ.get('AUDIT_RETENTION_DAYS', 365))
+
+# Startup Configuration
+STARTUP_LEASE_SECONDS = float(os.environ.get('STARTUP_LEASE_SECONDS', 300))
+
+# Batch Configuration
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 500))
+
+# Sync Configuration
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 500))
+# A write still pending after this long is treated as abandoned by readers
+SYNC_PENDING_TIMEOUT_SECONDS = int(os.environ.get('SYNC_PENDING_TIMEOUT_SECONDS', 120))
+
+# Stock summary Configuration
+STOCK_PAGE_SIZE = int(os.environ.get('STOCK_PAGE_SIZE', 1000))
+
+# Inventory ledger Configuration
+STOCK_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get('STOCK_SNAPSHOT_INTERVAL_HOURS', 24))
+STOCK_SNAPSHOT_LEASE_SECONDS = float(os.environ.get('STOCK_SNAPSHOT_LEASE_SECONDS', 300))
+# Snapshots stop this far in the past so movements still being written are counted
+STOCK_SNAPSHOT_SAFETY_LAG_SECONDS = int(os.environ.get('STOCK_SNAPSHOT_SAFETY_LAG_SECONDS', 300))
+
+# Reorder point Configuration
+REORDER_INTERVAL_HOURS = float(os.environ.get('REORDER_INTERVAL_HOURS', 24))
+REORDER_WINDOW_DAYS = int(os.environ.get('REORDER_WINDOW_DAYS', 56))
+REORDER_LEAD_TIME_DAYS = float(os.environ.get('REORDER_LEAD_TIME_DAYS', 7))
+REORDER_REVIEW_DAYS = float(os.environ.get('REORDER_REVIEW_DAYS', 7))
+REORDER_SERVICE_Z = float(os.environ.get('REORDER_SERVICE_Z', 1.65))  # ~95% service level
+REORDER_BATCH_PRODUCTS = int(os.environ.get('REORDER_BATCH_PRODUCTS', 1000))
+REORDER_FULL_INTERVAL_HOURS = float(os.environ.get('REORDER_FULL_INTERVAL_HOURS', 168))
+REORDER_LEASE_SECONDS = float(os.environ.get('REORDER_LEASE_SECONDS', 300))
+
+# Product search Configuration
+PRODUCT_SEARCH_CACHE_TTL_SECONDS = float(os.environ.get('PRODUCT_SEARCH_CACHE_TTL_SECONDS', 60))
+PRODUCT_SEARCH_CACHE_MAX_BRANCHES = int(os.environ.get('PRODUCT_SEARCH_CACHE_MAX_BRANCHES', 32))
+PRODUCT_SEARCH_CACHE_MAX_PRODUCTS = int(os.environ.get('PRODUCT_SEARCH_CACHE_MAX_PRODUCTS', 200000))
+
+# Reference data cache Configuration
+REFERENCE_CACHE_TTL_SECONDS = float(os.environ.get('REFERENCE_CACHE_TTL_SECONDS', 300))
+REFERENCE_LIST_CACHE_TTL_SECONDS = float(os.environ.get('REFERENCE_LIST_CACHE_TTL_SECONDS', 30))
+# Invalidation is per worker; other workers see a branch change after this long
+REFERENCE_BRANCHES_CACHE_TTL_SECONDS = float(os.environ.get('REFERENCE_BRANCHES_CACHE_TTL_SECONDS', 15))
+REFERENCE_CACHE_MAX_ENTRIES = int(os.environ.get('REFERENCE_CACHE_MAX_ENTRIES', 512))
+
+# Customer lookup Configuration
+PHONE_DEFAULT_COUNTRY_CODE = os.environ.get('PHONE_DEFAULT_COUNTRY_CODE', '91')
+PHONE_LOCAL_DIGITS = int(os.environ.get('PHONE_LOCAL_DIGITS', 10))
+
+# Live events Configuration
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 5000))
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 100))
+SSE_HEARTBEAT_SECONDS = int(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_CHANGE_STREAMS = os.environ.get('SSE_CHANGE_STREAMS', 'auto')  # 'auto' or 'off'
+
+# Sales archive Configuration
+SALES_HOT_DAYS = int(os.environ.get('SALES_HOT_DAYS', 365))
+SALES_ARCHIVE_BATCH_SIZE = int(os.environ.get('SALES_ARCHIVE_BATCH_SIZE', 5000))
+SALES_ARCHIVE_INTERVAL_HOURS = float(os.environ.get('SALES_ARCHIVE_INTERVAL_HOURS', 24))
+SALES_ARCHIVE_COMPRESSOR = os.environ.get('SALES_ARCHIVE_COMPRESSOR', 'zstd')
+SALES_ARCHIVE_LEASE_SECONDS = float(os.environ.get('SALES_ARCHIVE_LEASE_SECONDS', 600))
+
+# Margin analytics Configuration
+ANALYTICS_WORKERS = int(os.environ.get('ANALYTICS_WORKERS', 2))
+ANALYTICS_CHUNK_ROWS = int(os.environ.get('ANALYTICS_CHUNK_ROWS', 100000))
+
+# Parquet export Configuration
+EXPORT_DIR = Path(os.environ.get('EXPORT_DIR', ROOT_DIR / 'exports'))
+EXPORT_INTERVAL_HOURS = float(os.environ.get('EXPORT_INTERVAL_HOURS', 24))
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 50000))
+EXPORT_SAFETY_LAG_SECONDS = int(os.environ.get('EXPORT_SAFETY_LAG_SECONDS', 300))
+EXPORT_LEASE_SECONDS = float(os.environ.get('EXPORT_LEASE_SECONDS', 600))
+
+# Idempotency Configuration
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', 24 * 60 * 60))
+
 # Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -95,6 +1066,7 @@ class Vendor(BaseModel):
     phone: str
     branch_id: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = 0  # sync version, see versioned_write
 
 class VendorCreate(BaseModel):
     name: str
@@ -108,6 +1080,7 @@ class Customer(BaseModel):
     phone: str
     branch_id: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = 0  # sync version, see versioned_write
 
 class CustomerCreate(BaseModel):
     name: str
@@ -121,8 +1094,10 @@ class Product(BaseModel):
     quantity: int
     purchase_price: float
     selling_price: float
+    reorder_level: Optional[int] = None  # low-stock threshold, None disables alerts
     branch_id: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = 0  # sync version, see versioned_write
 
 class ProductCreate(BaseModel):
     name: str
@@ -130,6 +1105,7 @@ class ProductCreate(BaseModel):
     quantity: int
     purchase_price: float
     selling_price: float
+    reorder_level: Optional[int] = None
 
 class Sale(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -139,89 +1115,1960 @@ class Sale(BaseModel):
     branch_id: str
     invoice_number: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = 0  # sync version, see versioned_write
+
+class SaleCreate(BaseModel):
+    customer_id: str
+    items: List[Dict[str, Any]]
+
+class BatchOperation(BaseModel):
+    op: str  # 'create' or 'update'
+    collection: str  # 'products', 'customers' or 'vendors'
+    id: Optional[str] = None  # required for 'update'
+    data: Dict[str, Any]
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+# Utility functions
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        token = credentials.credentials
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        
+        user = await db.users.find_one({"username": username})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        
+        return User(**user)
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+async def get_stream_user(token: Optional[str] = None, credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    # EventSource cannot send headers, so streams also accept ?token=
+    if credentials is None:
+        if not token:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    return await get_current_user(credentials)
+
+def require_admin(current_user: User = Depends(get_current_user)):
+    if current_user.role != 'admin':
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+def get_user_branch_filter(user: User):
+    if user.role == 'admin':
+        return {}  # Admin can see all branches
+    return {"branch_id": user.branch_id}
+
+async def resolve_branch_id(user: User) -> str:
+    # For non-admin users, use their assigned branch
+    if user.role != 'admin':
+        if not user.branch_id:
+            raise HTTPException(status_code=400, detail="User must be assigned to a branch")
+        return user.branch_id
+    # For admin users, use the first available branch as default
+    branches = await cached_branches()
+    if not branches:
+        raise HTTPException(status_code=400, detail="No branches available")
+    return branches[0]["id"]
+
+# Reference data cache
+# Company, branches and the vendor/customer lists are read on nearly every
+# request and change rarely, so they are served from a per-worker read-through
+# cache. Concurrent misses for a key share one load, and the write routes
+# invalidate the keys they affect. Writes made by other workers are only
+# picked up when the entry expires, which bounds staleness to the key's TTL.
+class ReadThroughCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expires_at, value), least recently used first
+        self.entries: OrderedDict = OrderedDict()
+        self.loading: Dict[str, asyncio.Future] = {}
+        # Counters per namespace, the part of the key before the first ':'
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    
+    async def get(self, key: str, loader, ttl: Optional[float] = None):
+        counters = self.stats[key.partition(":")[0]]
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            counters["hits"] += 1
+            return entry[1]
+        future = self.loading.get(key)
+        if future is None:
+            counters["misses"] += 1
+            # Started in an empty context so the first caller's deadline does not
+            # apply to the load every coalesced caller waits on
+            future = contextvars.Context().run(asyncio.ensure_future, self._load(key, loader, self.ttl if ttl is None else ttl))
+            self.loading[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            counters["coalesced"] += 1
+        # Shielded so a cancelled caller does not cancel the load other callers wait on
+        return await asyncio.shield(future)
+    
+    async def _load(self, key: str, loader, ttl: float):
+        try:
+            value = await loader()
+        except Exception:
+            self.stats[key.partition(":")[0]]["load_errors"] += 1
+            raise
+        # Drop the result if the key was invalidated while we were loading
+        if self.loading.get(key) is asyncio.current_task():
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.stats[evicted.partition(":")[0]]["evictions"] += 1
+        return value
+    
+    def _finish(self, key: str, done: asyncio.Future):
+        if self.loading.get(key) is done:
+            del self.loading[key]
+        if not done.cancelled():
+            done.exception()  # retrieved, so an unawaited failure is not logged as lost
+    
+    def invalidate(self, prefix: str):
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+            self.stats[key.partition(":")[0]]["invalidations"] += 1
+        for key in [key for key in self.loading if key.startswith(prefix)]:
+            del self.loading[key]
+    
+    def snapshot(self) -> dict:
+        namespaces = {}
+        for namespace, counters in self.stats.items():
+            lookups = counters["hits"] + counters["misses"] + counters["coalesced"]
+            namespaces[namespace] = {
+                **counters,
+                "lookups": lookups,
+                # Coalesced lookups waited on another request's load instead of querying
+                "hit_ratio": round((counters["hits"] + counters["coalesced"]) / lookups, 4) if lookups else None,
+                "entries": sum(1 for key in self.entries if key.partition(":")[0] == namespace),
+            }
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "loading": len(self.loading),
+            "namespaces": namespaces,
+        }
+
+reference_cache = ReadThroughCache(REFERENCE_CACHE_TTL_SECONDS, REFERENCE_CACHE_MAX_ENTRIES)
+
+# List routes served from reference_cache; products change with every sale
+REFERENCE_LISTS = {"vendors", "customers"}
+
+async def cached_company() -> Optional[dict]:
+    return await reference_cache.get("company", lambda: db.company.find_one({}, {"_id": 0}))
+
+async def cached_branches() -> List[dict]:
+    return await reference_cache.get(
+        "branches", lambda: db.branches.find({}, {"_id": 0}).to_list(None), REFERENCE_BRANCHES_CACHE_TTL_SECONDS
+    )
+
+async def warm_reference_cache():
+    try:
+        await asyncio.gather(
+            cached_company(),
+            cached_branches(),
+            *(conditional_list(collection_name, BATCH_COLLECTIONS[collection_name][0], {}, None, None) for collection_name in REFERENCE_LISTS)
+        )
+    except Exception as e:
+        # A cold cache only costs the first requests a query
+        logger.warning(f"Reference cache warm-up failed: {e}")
+
+# Cross-branch fan-out
+# Admin-scope reads run one branch_id-prefixed query per branch, concurrently
+# and capped at FANOUT_CONCURRENCY, and merge the partial results with the
+# combinators below. With a branch_id shard key each query hits one shard.
+BRANCH_SCOPED_COLLECTIONS = ["products", "customers", "vendors", "sales", "stock_movements"]
+
+async def get_branch_ids() -> List[str]:
+    return [branch["id"] for branch in await cached_branches()]
+
+async def scope_branch_ids(user: User) -> List[str]:
+    if user.role == 'admin':
+        return await get_branch_ids()
+    return [user.branch_id]
+
+async def fan_out(branch_ids: List[str], query) -> list:
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    
+    async def run(branch_id: str):
+        async with semaphore:
+            return await query(branch_id)
+    
+    return await asyncio.gather(*(run(branch_id) for branch_id in branch_ids))
+
+def merge_sums(parts: List[dict], fields: List[str]) -> dict:
+    return {field: sum(part.get(field, 0) for part in parts) for field in fields}
+
+def merge_grouped(parts: List[List[dict]], key: str, fields: List[str]) -> List[dict]:
+    # Adds up rows sharing the same key, e.g. monthly totals from several branches
+    merged: Dict[Any, dict] = {}
+    for rows in parts:
+        for row in rows:
+            target = merged.setdefault(row[key], {key: row[key], **{field: 0 for field in fields}})
+            for field in fields:
+                target[field] += row.get(field, 0)
+    return list(merged.values())
+
+def merge_top_n(parts: List[List[dict]], n: int, key: str, reverse: bool = True) -> List[dict]:
+    rows = (row for rows in parts for row in rows)
+    if reverse:
+        return heapq.nlargest(n, rows, key=lambda row: row[key])
+    return heapq.nsmallest(n, rows, key=lambda row: row[key])
+
+def merge_sorted(parts: List[List[dict]], key: str, reverse: bool = False, limit: Optional[int] = None) -> List[dict]:
+    # Each part must already be sorted by key in the same direction
+    merged = heapq.merge(*parts, key=lambda row: row[key], reverse=reverse)
+    if limit is None:
+        return list(merged)
+    return [row for _, row in zip(range(limit), merged)]
+
+async def shard_collections():
+    # Only meaningful against mongos; branch_id leads every per-branch index
+    hello = await client.admin.command("hello")
+    if hello.get("msg") != "isdbgrid":
+        return
+    await client.admin.command("enableSharding", db.name)
+    for collection_name in BRANCH_SCOPED_COLLECTIONS:
+        await client.admin.command("shardCollection", f"{db.name}.{collection_name}", key={"branch_id": 1, "id": 1})
+
+# Sync versions
+# Every write to a synced collection stamps the document with a version taken
+# from a single global counter, so clients can ask for "everything after N".
+SYNC_COLLECTIONS = {
+    "products": Product,
+    "customers": Customer,
+    "vendors": Vendor,
+    "sales": Sale,
+}
+
+async def current_version() -> int:
+    counter = await db.counters.find_one({"_id": "sync_version"})
+    return counter["seq"] if counter else 0
+
+# Versions are allocated before the write that uses them lands, so a reader
+# must not move past a version that is still being written. The allocation
+# itself records a pending marker (its first version) on the counter
+# document, in the same atomic update, and the marker is removed once the
+# write is done; stable_version() stops below the oldest live marker.
+@asynccontextmanager
+async def versioned_write(count: int = 1):
+    token = uuid.uuid4().hex
+    seq = {"$ifNull": ["$seq", 0]}
+    counter = await db.counters.find_one_and_update(
+        {"_id": "sync_version"},
+        [{"$set": {
+            "seq": {"$add": [seq, count]},
+            f"pending.{token}": {
+                "floor": {"$add": [seq, 1]},
+                "expires_at": datetime.utcnow() + timedelta(seconds=SYNC_PENDING_TIMEOUT_SECONDS)
+            }
+        }}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    try:
+        yield counter["pending"][token]["floor"]
+    finally:
+        await db.counters.update_one({"_id": "sync_version"}, {"$unset": {f"pending.{token}": ""}})
+
+async def stable_version() -> int:
+    # The highest version below which every write has landed; the counter and
+    # its markers are read together from one document
+    counter = await db.counters.find_one({"_id": "sync_version"})
+    if not counter:
+        return 0
+    now = datetime.utcnow()
+    pending = counter.get("pending", {})
+    expired = [token for token, marker in pending.items() if marker["expires_at"] <= now]
+    if expired:
+        # Left behind by a worker that died mid-write
+        await db.counters.update_one({"_id": "sync_version"}, {"$unset": {f"pending.{token}": "" for token in expired}})
+    floors = [marker["floor"] for token, marker in pending.items() if token not in expired]
+    return min(counter["seq"], min(floors) - 1) if floors else counter["seq"]
+
+async def record_tombstones(collection_name: str, documents: List[dict]):
+    if not documents:
+        return
+    async with versioned_write(len(documents)) as first_version:
+        await db.sync_tombstones.insert_many([
+            {
+                "collection": collection_name,
+                "id": document["id"],
+                "branch_id": document.get("branch_id"),
+                "version": first_version + offset,
+                "deleted_at": datetime.utcnow()
+            }
+            for offset, document in enumerate(documents)
+        ])
+
+async def backfill_sync_versions(batch_size: int = 1000):
+    # Documents written before versioning existed get a version once
+    for collection_name in SYNC_COLLECTIONS:
+        collection = db[collection_name]
+        while True:
+            documents = await collection.find({"version": {"$exists": False}}, {"id": 1}).to_list(batch_size)
+            if not documents:
+                break
+            async with versioned_write(len(documents)) as first_version:
+                await collection.bulk_write([
+                    UpdateOne({"_id": document["_id"]}, {"$set": {"version": first_version + offset}})
+                    for offset, document in enumerate(documents)
+                ], ordered=False)
+
+# Conditional list reads
+# List routes accept ?fields=a,b (a projection; id is always included) and
+# answer with a weak ETag built from the highest sync version in the caller's
+# scope, counting tombstones so deletions change it too. Both maxima come
+# from the (branch_id, version) and version indexes, so a request whose
+# If-None-Match still matches gets a 304 without any document being read.
+# While a version at or below that maximum is still being written the list
+# can change without the maximum moving, so no ETag is given until
+# stable_version() has caught up.
+LIST_LIMIT = 100
+
+def parse_fields(fields: Optional[str], model) -> Optional[List[str]]:
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id", *dict.fromkeys(field for field in requested if field != "id")]
+
+async def collection_version(collection_name: str, branch_filter: dict) -> Optional[int]:
+    # None while a write at or below the collection's highest version is pending
+    latest, deleted, stable = await asyncio.gather(
+        db[collection_name].find(branch_filter, {"_id": 0, "version": 1}).sort("version", -1).limit(1).to_list(1),
+        db.sync_tombstones.find({**branch_filter, "collection": collection_name}, {"_id": 0, "version": 1}).sort("version", -1).limit(1).to_list(1),
+        stable_version()
+    )
+    version = max((row.get("version", 0) for row in latest + deleted), default=0)
+    return version if version <= stable else None
+
+def list_etag(collection_name: str, branch_filter: dict, fields: Optional[List[str]], version: Optional[int]) -> Optional[str]:
+    if version is None:
+        return None
+    variant = f"{collection_name}|{branch_filter.get('branch_id', '*')}|{','.join(fields or [])}|{LIST_LIMIT}"
+    return f'W/"{version}-{hashlib.sha1(variant.encode()).hexdigest()[:12]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    # If-None-Match uses weak comparison
+    if not if_none_match or not etag:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
+async def read_list(collection_name: str, model, branch_filter: dict, projection: Optional[List[str]]) -> list:
+    documents = await repository.find(collection_name, branch_filter, limit=LIST_LIMIT, fields=projection)
+    return jsonable_encoder(documents if projection else [model(**document).dict() for document in documents])
+
+async def load_list(collection_name: str, model, branch_filter: dict, projection: Optional[List[str]]):
+    # Read the version before the documents, so a concurrent write can only make the tag stale, never too new
+    etag = list_etag(collection_name, branch_filter, projection, await collection_version(collection_name, branch_filter))
+    return etag, await read_list(collection_name, model, branch_filter, projection)
+
+async def conditional_list(collection_name: str, model, branch_filter: dict, fields: Optional[str], if_none_match: Optional[str]) -> Response:
+    projection = parse_fields(fields, model)
+    content = None
+    if collection_name in REFERENCE_LISTS:
+        key = f"{collection_name}:{branch_filter.get('branch_id', '*')}:{','.join(projection or [])}"
+        etag, content = await reference_cache.get(
+            key, lambda: load_list(collection_name, model, branch_filter, projection), REFERENCE_LIST_CACHE_TTL_SECONDS
+        )
+    else:
+        etag = list_etag(collection_name, branch_filter, projection, await collection_version(collection_name, branch_filter))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else {"Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if content is None:
+        content = await read_list(collection_name, model, branch_filter, projection)
+    return JSONResponse(content, headers=headers)
+
+# Idempotency keys
+# Responses of create endpoints are stored per (user, route, key) so retried
+# requests replay the first response instead of repeating the write path.
+# Duplicates arriving while the first request is still running in this worker
+# wait on the same future; duplicates from other workers get a 409.
+_idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+def _request_fingerprint(payload: Any) -> str:
+    encoded = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def _replay_response(record: dict) -> JSONResponse:
+    return JSONResponse(
+        status_code=record.get("status_code", 200),
+        content=record["response"],
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+async def run_idempotent(idempotency_key: Optional[str], scope: str, user: User, payload: Any, handler):
+    if not idempotency_key:
+        return await handler()
+    
+    record_key = f"{user.id}:{scope}:{idempotency_key}"
+    fingerprint = _request_fingerprint(payload)
+    
+    inflight = _idempotency_inflight.get(record_key)
+    if inflight is not None:
+        try:
+            record = await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise
+            raise HTTPException(status_code=409, detail="The original request with this Idempotency-Key was cancelled")
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+        return _replay_response(record)
+    
+    # Registered before the first await, so a concurrent duplicate in this worker always waits on it
+    future = asyncio.get_running_loop().create_future()
+    _idempotency_inflight[record_key] = future
+    try:
+        stored = await db.idempotency_keys.find_one({"key": record_key})
+        if stored:
+            if stored.get("status") == "completed":
+                # Duplicates waiting on this request compare their own bodies against it
+                future.set_result(stored)
+            if stored["fingerprint"] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+            if stored.get("status") != "completed":
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is already in progress")
+            return _replay_response(stored)
+        
+        try:
+            await db.idempotency_keys.insert_one({
+                "key": record_key,
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is already in progress")
+        
+        try:
+            result = await handler()
+        except BaseException:
+            # Failed requests are not cached so the client can retry them
+            await db.idempotency_keys.delete_one({"key": record_key, "status": "in_progress"})
+            raise
+        
+        record = {
+            "fingerprint": fingerprint,
+            "status": "completed",
+            "status_code": 200,
+            "response": jsonable_encoder(result)
+        }
+        await db.idempotency_keys.update_one({"key": record_key}, {"$set": record})
+        future.set_result(record)
+        return result
+    except BaseException as e:
+        if not future.done():
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                # Mark retrieved so an exception nobody awaited is not logged
+                future.exception()
+            else:
+                future.cancel()
+        raise
+    finally:
+        _idempotency_inflight.pop(record_key, None)
+
+# Stock summary
+# stock_summary holds one 'item' row per (branch_id, product name) plus one
+# 'branch_total' row per branch. Write routes apply $inc deltas to it
+# alongside every product quantity change, so GET /api/stock reads
+# precomputed rows instead of regrouping the products collection.
+def stock_change(product: dict, quantity: int, product_count: int = 0) -> dict:
+    return {
+        "branch_id": product["branch_id"],
+        "name": product["name"],
+        "total_quantity": quantity,
+        "total_value": quantity * product["purchase_price"],
+        "selling_value": quantity * product["selling_price"],
+        "product_count": product_count
+    }
+
+async def apply_stock_changes(changes: List[dict]):
+    # Coalesce per row so a sale of N lines is still a single bulk_write
+    increments: Dict[tuple, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for change in changes:
+        fields = ("total_quantity", "total_value", "selling_value", "product_count")
+        for key in ((change["branch_id"], "item", change["name"]), (change["branch_id"], "branch_total", None)):
+            for field in fields:
+                increments[key][field] += change[field]
+    if not increments:
+        return
+    await db.stock_summary.bulk_write([
+        UpdateOne(
+            {"branch_id": branch_id, "kind": kind, "name": name},
+            {"$inc": {field: int(value) if field in ("total_quantity", "product_count") else value for field, value in inc.items()}},
+            upsert=True
+        )
+        for (branch_id, kind, name), inc in increments.items()
+    ], ordered=False)
+
+async def verify_stock_summary(repair: bool = False, branch_id: Optional[str] = None, tolerance: float = 0.01) -> dict:
+    branch_filter = {"branch_id": branch_id} if branch_id else {}
+    source_pipeline = [
+        {"$match": branch_filter},
+        {"$group": {
+            "_id": {"branch_id": "$branch_id", "name": "$name"},
+            "total_quantity": {"$sum": "$quantity"},
+            "total_value": {"$sum": {"$multiply": ["$quantity", "$purchase_price"]}},
+            "selling_value": {"$sum": {"$multiply": ["$quantity", "$selling_price"]}},
+            "product_count": {"$sum": 1}
+        }}
+    ]
+    expected: Dict[tuple, dict] = {}
+    async for row in db.products.aggregate(source_pipeline):
+        key = (row["_id"]["branch_id"], "item", row["_id"]["name"])
+        expected[key] = {field: row[field] for field in ("total_quantity", "total_value", "selling_value", "product_count")}
+        total = expected.setdefault((key[0], "branch_total", None), defaultdict(float))
+        for field in ("total_quantity", "total_value", "selling_value", "product_count"):
+            total[field] += row[field]
+    
+    actual: Dict[tuple, dict] = {}
+    async for row in db.stock_summary.find(branch_filter, {"_id": 0}):
+        actual[(row["branch_id"], row["kind"], row["name"])] = row
+    
+    empty = {"total_quantity": 0, "total_value": 0, "selling_value": 0, "product_count": 0}
+    mismatches = []
+    for key in set(expected) | set(actual):
+        want = dict(expected.get(key, empty))
+        have = actual.get(key, empty)
+        if any(abs(want[field] - have.get(field, 0)) > tolerance for field in want):
+            mismatches.append({"branch_id": key[0], "kind": key[1], "name": key[2], "expected": want, "actual": {field: have.get(field, 0) for field in want}})
+    
+    if repair and mismatches:
+        await db.stock_summary.bulk_write([
+            UpdateOne(
+                {"branch_id": mismatch["branch_id"], "kind": mismatch["kind"], "name": mismatch["name"]},
+                {"$set": mismatch["expected"]},
+                upsert=True
+            )
+            for mismatch in mismatches
+        ], ordered=False)
+    
+    return {
+        "checked": len(set(expected) | set(actual)),
+        "mismatches": mismatches,
+        "repaired": repair and bool(mismatches)
+    }
+
+async def backfill_stock_summary():
+    # Build the summary once for databases that predate it
+    if await db.stock_summary.find_one({}) is None and await db.products.find_one({}) is not None:
+        await verify_stock_summary(repair=True)
+
+# Inventory ledger
+# Every quantity change is appended to stock_movements. Periodic per-branch
+# snapshots (stock_snapshots headers plus stock_snapshot_items rows) let an
+# as-of-date query start from the nearest snapshot and only scan the
+# movements between it and the requested date. Snapshots are built from the
+# ledger alone, as of STOCK_SNAPSHOT_SAFETY_LAG_SECONDS ago, so every
+# snapshot is exactly the sum of the movements up to its taken_at.
+snapshot_task: Optional[asyncio.Task] = None
+
+def stock_movement(product: dict, quantity_delta: int, kind: str, reference_id: Optional[str] = None) -> dict:
+    # kind is 'purchase', 'sale' or 'adjustment'
+    return {
+        "id": str(uuid.uuid4()),
+        "branch_id": product["branch_id"],
+        "product_id": product["id"],
+        "name": product["name"],
+        "quantity_delta": quantity_delta,
+        "kind": kind,
+        "reference_id": reference_id,
+        "created_at": datetime.utcnow()
+    }
+
+async def record_stock_changes(changes: List[dict], movements: List[dict]):
+    # Summary and ledger writes go out together instead of one after the other
+    writes = [apply_stock_changes(changes)]
+    if movements:
+        writes.append(db.stock_movements.insert_many(movements, ordered=False))
+    await asyncio.gather(*writes)
+
+async def movement_deltas(branch_id: str, after: datetime, until: datetime) -> Dict[str, dict]:
+    pipeline = [
+        {"$match": {"branch_id": branch_id, "created_at": {"$gt": after, "$lte": until}}},
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": "$product_id", "delta": {"$sum": "$quantity_delta"}, "name": {"$last": "$name"}}}
+    ]
+    return {row["_id"]: row async for row in db.stock_movements.aggregate(pipeline)}
+
+async def backfill_opening_movements():
+    # Products that predate the ledger and never moved since get one opening
+    # movement, so the ledger alone accounts for their stock. Only needed
+    # before the first snapshot; later products start with a purchase movement.
+    if await db.stock_snapshots.find_one({}, {"_id": 1}) is not None:
+        return
+    moved = set(await db.stock_movements.distinct("product_id"))
+    movements = []
+    async for product in db.products.find({}, {"_id": 0, "id": 1, "branch_id": 1, "name": 1, "quantity": 1, "created_at": 1}):
+        if product["id"] not in moved and product.get("quantity"):
+            movement = stock_movement(product, product["quantity"], "adjustment")
+            movement["created_at"] = product.get("created_at") or datetime(1970, 1, 1)
+            movements.append(movement)
+    for start in range(0, len(movements), 1000):
+        await db.stock_movements.insert_many(movements[start:start + 1000], ordered=False)
+
+async def take_stock_snapshot(branch_id: str) -> dict:
+    taken_at = datetime.utcnow() - timedelta(seconds=STOCK_SNAPSHOT_SAFETY_LAG_SECONDS)
+    previous = await db.stock_snapshots.find_one({"branch_id": branch_id, "complete": True}, sort=[("taken_at", -1)])
+    quantities: Dict[str, dict] = {}
+    if previous:
+        async for row in db.stock_snapshot_items.find({"snapshot_id": previous["id"]}, {"_id": 0}):
+            quantities[row["product_id"]] = {"name": row["name"], "quantity": row["quantity"]}
+    # Roll the previous snapshot (or, for the first one, nothing) forward through the ledger
+    for product_id, row in (await movement_deltas(branch_id, previous["taken_at"] if previous else datetime.min, taken_at)).items():
+        entry = quantities.setdefault(product_id, {"name": row["name"], "quantity": 0})
+        entry["name"] = row["name"]
+        entry["quantity"] += row["delta"]
+    
+    snapshot = {"id": str(uuid.uuid4()), "branch_id": branch_id, "taken_at": taken_at, "item_count": len(quantities), "complete": False}
+    await db.stock_snapshots.insert_one(snapshot)
+    rows = [
+        {"snapshot_id": snapshot["id"], "product_id": product_id, "name": entry["name"], "quantity": entry["quantity"]}
+        for product_id, entry in quantities.items()
+    ]
+    for start in range(0, len(rows), 1000):
+        await db.stock_snapshot_items.insert_many(rows[start:start + 1000], ordered=False)
+    # Readers ignore a snapshot until all of its rows are written
+    await db.stock_snapshots.update_one({"id": snapshot["id"]}, {"$set": {"complete": True}})
+    snapshot["complete"] = True
+    snapshot.pop("_id", None)
+    return snapshot
+
+async def stock_as_of(branch_id: str, as_of: datetime) -> dict:
+    base = await reporting_db.stock_snapshots.find_one(
+        {"branch_id": branch_id, "complete": True, "taken_at": {"$lte": as_of}}, sort=[("taken_at", -1)]
+    )
+    direction = 1
+    if base is None:
+        # Nothing that old: walk back from the earliest later snapshot instead
+        base = await reporting_db.stock_snapshots.find_one(
+            {"branch_id": branch_id, "complete": True, "taken_at": {"$gt": as_of}}, sort=[("taken_at", 1)]
+        )
+        direction = -1
+    
+    quantities: Dict[str, dict] = {}
+    if base:
+        async for row in reporting_db.stock_snapshot_items.find({"snapshot_id": base["id"]}, {"_id": 0}):
+            quantities[row["product_id"]] = {"name": row["name"], "quantity": row["quantity"]}
+        base_time = base["taken_at"]
+    else:
+        # No snapshots yet: walk back from the live quantities
+        async for product in reporting_db.products.find({"branch_id": branch_id}, {"id": 1, "name": 1, "quantity": 1}):
+            quantities[product["id"]] = {"name": product["name"], "quantity": product["quantity"]}
+        base_time = datetime.utcnow()
+    
+    if direction == 1:
+        deltas = await movement_deltas(branch_id, base_time, as_of)
+    else:
+        deltas = await movement_deltas(branch_id, as_of, base_time)
+    for product_id, row in deltas.items():
+        entry = quantities.setdefault(product_id, {"name": row["name"], "quantity": 0})
+        entry["quantity"] += direction * row["delta"]
+    
+    return {
+        "branch_id": branch_id,
+        "as_of": as_of,
+        "snapshot_taken_at": base["taken_at"] if base else None,
+        "items": sorted(
+            ({"product_id": product_id, **entry} for product_id, entry in quantities.items()),
+            key=lambda item: item["name"]
+        )
+    }
+
+async def run_snapshot_scheduler():
+    interval = timedelta(hours=STOCK_SNAPSHOT_INTERVAL_HOURS)
+    while True:
+        try:
+            # Only one worker takes each round of snapshots
+            token = await acquire_lease("stock_snapshots", STOCK_SNAPSHOT_LEASE_SECONDS)
+            if token:
+                async with keep_lease("stock_snapshots", token, STOCK_SNAPSHOT_LEASE_SECONDS):
+                    async for branch in db.branches.find({}, {"id": 1}):
+                        latest = await db.stock_snapshots.find_one({"branch_id": branch["id"], "complete": True}, sort=[("taken_at", -1)])
+                        if latest is None or datetime.utcnow() - latest["taken_at"] >= interval:
+                            await take_stock_snapshot(branch["id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Stock snapshot run failed: {e}")
+        await asyncio.sleep(min(interval.total_seconds(), 3600))
+
+# Reorder points
+# A scheduled job turns the sale movements of the last REORDER_WINDOW_DAYS
+# into a products x days matrix per batch and computes, per product, the
+# mean daily velocity, its variability, a reorder point (lead-time demand
+# plus safety stock) and a suggested order quantity. Results are upserted
+# into reorder_points; a partial index over the rows at or below their
+# reorder point keeps GET /api/stock/reorder proportional to its result.
+# Between full runs (every REORDER_FULL_INTERVAL_HOURS) only products whose
+# stock moved since the previous run, or whose sales have since aged out of
+# the window, are recomputed.
+reorder_task: Optional[asyncio.Task] = None
+
+def compute_reorder_points(products: List[dict], movements: List[dict], now: datetime) -> List[dict]:
+    import numpy as np
+    
+    index = {(product["branch_id"], product["id"]): position for position, product in enumerate(products)}
+    daily = np.zeros((len(products), REORDER_WINDOW_DAYS))
+    rows = np.fromiter((index[(m["branch_id"], m["product_id"])] for m in movements), dtype=np.int64, count=len(movements))
+    days = np.fromiter(((now - m["created_at"]).days for m in movements), dtype=np.int64, count=len(movements))
+    sold = np.fromiter((-m["quantity_delta"] for m in movements), dtype=np.float64, count=len(movements))
+    in_window = (days >= 0) & (days < REORDER_WINDOW_DAYS)
+    np.add.at(daily, (rows[in_window], days[in_window]), sold[in_window])
+    
+    velocity = daily.mean(axis=1)
+    deviation = daily.std(axis=1)
+    on_hand = np.array([product["quantity"] for product in products], dtype=np.float64)
+    safety_stock = REORDER_SERVICE_Z * deviation * np.sqrt(REORDER_LEAD_TIME_DAYS)
+    reorder_point = np.ceil(velocity * REORDER_LEAD_TIME_DAYS + safety_stock)
+    target_level = velocity * (REORDER_LEAD_TIME_DAYS + REORDER_REVIEW_DAYS) + safety_stock
+    suggested = np.maximum(0, np.ceil(target_level - on_hand))
+    days_of_cover = np.divide(np.maximum(on_hand, 0), velocity, out=np.full(len(products), np.inf), where=velocity > 0)
+    days_of_cover[on_hand <= 0] = 0
+    below = on_hand <= reorder_point
+    
+    return [
+        {
+            "branch_id": product["branch_id"],
+            "product_id": product["id"],
+            "name": product["name"],
+            "quantity": int(on_hand[position]),
+            "daily_velocity": round(float(velocity[position]), 3),
+            "velocity_std": round(float(deviation[position]), 3),
+            "reorder_point": int(reorder_point[position]),
+            "suggested_order_quantity": int(suggested[position]),
+            "days_of_cover": None if np.isinf(days_of_cover[position]) else round(float(days_of_cover[position]), 1),
+            "below_reorder_point": bool(below[position]),
+            "computed_at": now,
+        }
+        for position, product in enumerate(products)
+    ]
+
+async def recompute_reorder_batch(products: List[dict], now: datetime) -> int:
+    if not products:
+        return 0
+    movements = await db.stock_movements.find(
+        {
+            "product_id": {"$in": [product["id"] for product in products]},
+            "kind": "sale",
+            "created_at": {"$gt": now - timedelta(days=REORDER_WINDOW_DAYS), "$lte": now},
+        },
+        {"_id": 0, "branch_id": 1, "product_id": 1, "quantity_delta": 1, "created_at": 1}
+    ).to_list(None)
+    known = {(product["branch_id"], product["id"]) for product in products}
+    movements = [m for m in movements if (m["branch_id"], m["product_id"]) in known]
+    results = await asyncio.to_thread(compute_reorder_points, products, movements, now)
+    await db.reorder_points.bulk_write([
+        UpdateOne({"branch_id": row["branch_id"], "product_id": row["product_id"]}, {"$set": row}, upsert=True)
+        for row in results
+    ], ordered=False)
+    return len(results)
+
+async def run_reorder_job(full: bool = False) -> dict:
+    now = datetime.utcnow()
+    state = await db.reorder_state.find_one({"_id": "reorder"})
+    product_fields = {"_id": 0, "id": 1, "branch_id": 1, "name": 1, "quantity": 1}
+    full = full or state is None or state.get("last_full_at") is None or \
+        now - state["last_full_at"] >= timedelta(hours=REORDER_FULL_INTERVAL_HOURS)
+    if full:
+        product_filter = {}
+    else:
+        # Any movement changes on-hand stock; a sale leaving the window changes velocity
+        since = state["last_run_at"]
+        window = timedelta(days=REORDER_WINDOW_DAYS)
+        changed = await db.stock_movements.aggregate([
+            {"$match": {"$or": [
+                {"created_at": {"$gt": since, "$lte": now}},
+                {"kind": "sale", "created_at": {"$gt": since - window, "$lte": now - window}},
+            ]}},
+            {"$group": {"_id": "$product_id"}},
+        ]).to_list(None)
+        product_filter = {"id": {"$in": [row["_id"] for row in changed]}}
+    
+    recomputed = 0
+    batch: List[dict] = []
+    if product_filter.get("id") != {"$in": []}:
+        async for product in db.products.find(product_filter, product_fields).batch_size(REORDER_BATCH_PRODUCTS):
+            batch.append(product)
+            if len(batch) >= REORDER_BATCH_PRODUCTS:
+                recomputed += await recompute_reorder_batch(batch, now)
+                batch = []
+        recomputed += await recompute_reorder_batch(batch, now)
+    
+    update = {"last_run_at": now, "recomputed": recomputed}
+    if full:
+        update["last_full_at"] = now
+    await db.reorder_state.update_one({"_id": "reorder"}, {"$set": update}, upsert=True)
+    return {"recomputed": recomputed, "full": full, "computed_at": now}
+
+async def run_reorder_scheduler():
+    interval = timedelta(hours=REORDER_INTERVAL_HOURS)
+    while True:
+        try:
+            token = await acquire_lease("reorder_points", REORDER_LEASE_SECONDS)
+            if token:
+                async with keep_lease("reorder_points", token, REORDER_LEASE_SECONDS):
+                    state = await db.reorder_state.find_one({"_id": "reorder"})
+                    if state is None or datetime.utcnow() - state["last_run_at"] >= interval:
+                        await run_reorder_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Reorder point run failed: {e}")
+        await asyncio.sleep(min(interval.total_seconds(), 3600))
+
+# Product search
+# Typeahead matches a prefix of the normalised product name. Each branch's
+# names are held sorted in memory so a lookup is a bisect. Write routes insert
+# or move products in the sorted list (and patch quantities after a sale).
+# Entries older than PRODUCT_SEARCH_CACHE_TTL_SECONDS are reloaded in the
+# background, so writes made by other workers show up, while searches keep
+# using the stale entry. Branches not loaded yet, or too large for the
+# cache, are served from the (branch_id, name_normalized) index.
+PRODUCT_SEARCH_FIELDS = {"_id": 0, "id": 1, "name": 1, "name_normalized": 1, "vendor_id": 1, "quantity": 1, "purchase_price": 1, "selling_price": 1, "branch_id": 1}
+
+def normalize_name(name: str) -> str:
+    folded = unicodedata.normalize('NFKD', name)
+    folded = ''.join(ch for ch in folded if not unicodedata.combining(ch))
+    return ' '.join(folded.casefold().split())
+
+def is_low_stock(quantity: int, reorder_level: Optional[int]) -> bool:
+    return reorder_level is not None and quantity <= reorder_level
+
+def product_document(product: Product) -> dict:
+    return {
+        **product.dict(),
+        "name_normalized": normalize_name(product.name),
+        "low_stock": is_low_stock(product.quantity, product.reorder_level)
+    }
+
+class ProductSearchCache:
+    def __init__(self, ttl: float, max_branches: int, max_products: int):
+        self.ttl = ttl
+        self.max_branches = max_branches
+        self.max_products = max_products
+        # branch_id -> (loaded_at, sorted normalised names, rows in the same order, rows by id)
+        self.entries: OrderedDict = OrderedDict()
+        self.loading: Dict[str, asyncio.Task] = {}
+        # Rows written while a branch is loading, replayed onto the loaded entry
+        self.written_while_loading: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        # Branches that were too large or failed to load are not retried before this time
+        self.retry_after: Dict[str, float] = {}
+    
+    @staticmethod
+    def _place(entry: tuple, row: dict):
+        _, names, rows, by_id = entry
+        previous = by_id.get(row["id"])
+        if previous is not None:
+            position = bisect.bisect_left(names, previous["name_normalized"])
+            while rows[position]["id"] != row["id"]:
+                position += 1
+            del names[position]
+            del rows[position]
+        position = bisect.bisect_right(names, row["name_normalized"])
+        names.insert(position, row["name_normalized"])
+        rows.insert(position, row)
+        by_id[row["id"]] = row
+    
+    def upsert(self, branch_id: str, document: dict):
+        # Created or updated products go into the sorted list in place
+        row = {field: document[field] for field in PRODUCT_SEARCH_FIELDS if field != "_id"}
+        if branch_id in self.loading:
+            self.written_while_loading[branch_id][row["id"]] = row
+        entry = self.entries.get(branch_id)
+        if entry:
+            self._place(entry, row)
+            if len(entry[2]) > self.max_products:
+                del self.entries[branch_id]
+                self.retry_after[branch_id] = time.monotonic() + self.ttl
+    
+    def apply_quantity(self, branch_id: str, product_id: str, delta: int):
+        entry = self.entries.get(branch_id)
+        if entry and product_id in entry[3]:
+            entry[3][product_id]["quantity"] += delta
+    
+    async def _load(self, branch_id: str):
+        cursor = db.products.find({"branch_id": branch_id}, PRODUCT_SEARCH_FIELDS).limit(self.max_products + 1)
+        rows = await cursor.to_list(None)
+        if len(rows) > self.max_products:
+            self.entries.pop(branch_id, None)
+            self.retry_after[branch_id] = time.monotonic() + self.ttl
+            return
+        for row in rows:
+            row.setdefault("name_normalized", normalize_name(row["name"]))
+        rows.sort(key=lambda row: row["name_normalized"])
+        entry = (time.monotonic(), [row["name_normalized"] for row in rows], rows, {row["id"]: row for row in rows})
+        for row in self.written_while_loading.pop(branch_id, {}).values():
+            self._place(entry, row)
+        self.entries[branch_id] = entry
+        self.entries.move_to_end(branch_id)
+        while len(self.entries) > self.max_branches:
+            self.entries.popitem(last=False)
+    
+    def _loaded(self, branch_id: str, task: asyncio.Task):
+        self.loading.pop(branch_id, None)
+        self.written_while_loading.pop(branch_id, None)
+        if not task.cancelled() and task.exception():
+            # Keep serving what we have (or the index) and try again later
+            self.retry_after[branch_id] = time.monotonic() + self.ttl
+            logger.warning(f"Product search cache load for branch {branch_id} failed: {task.exception()!r}")
+    
+    def _refresh(self, branch_id: str):
+        if branch_id in self.loading or time.monotonic() < self.retry_after.get(branch_id, 0):
+            return
+        # Started in an empty context so the request's deadline does not apply
+        task = contextvars.Context().run(asyncio.create_task, self._load(branch_id))
+        self.loading[branch_id] = task
+        task.add_done_callback(lambda done: self._loaded(branch_id, done))
+    
+    def search(self, branch_id: str, prefix: str, limit: int) -> Optional[List[dict]]:
+        entry = self.entries.get(branch_id)
+        if entry is None:
+            # Loads happen in the background; until one finishes the caller uses the index
+            self._refresh(branch_id)
+            return None
+        self.entries.move_to_end(branch_id)
+        if time.monotonic() - entry[0] >= self.ttl:
+            self._refresh(branch_id)
+        _, names, rows, _ = entry
+        start = bisect.bisect_left(names, prefix)
+        matches = []
+        for position in range(start, min(start + limit, len(names))):
+            if not names[position].startswith(prefix):
+                break
+            matches.append(rows[position])
+        return matches
+
+product_search_cache = ProductSearchCache(
+    PRODUCT_SEARCH_CACHE_TTL_SECONDS, PRODUCT_SEARCH_CACHE_MAX_BRANCHES, PRODUCT_SEARCH_CACHE_MAX_PRODUCTS
+)
+
+async def search_branch_products(branch_id: str, prefix: str, limit: int, fuzzy: bool, text: str) -> List[dict]:
+    matches = product_search_cache.search(branch_id, prefix, limit)
+    if matches is None:
+        cursor = db.products.find(
+            {"branch_id": branch_id, "name_normalized": {"$regex": f"^{re.escape(prefix)}"}},
+            PRODUCT_SEARCH_FIELDS
+        ).sort("name_normalized", 1).limit(limit)
+        matches = await cursor.to_list(limit)
+    if fuzzy and len(matches) < limit:
+        seen = {row["id"] for row in matches}
+        cursor = db.products.find(
+            {"branch_id": branch_id, "$text": {"$search": text}},
+            {**PRODUCT_SEARCH_FIELDS, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+        # The best-scoring fuzzy matches fill the page...
+        extra = []
+        for row in await cursor.to_list(limit):
+            if row["id"] not in seen and len(matches) + len(extra) < limit:
+                row.pop("score", None)
+                extra.append(row)
+        # ...which is returned in name order, like the prefix hits, so branch parts merge
+        matches = sorted([*matches, *extra], key=lambda row: row["name_normalized"])
+    return matches
+
+async def backfill_name_normalized(batch_size: int = 1000):
+    while True:
+        products = await db.products.find({"name_normalized": {"$exists": False}}, {"name": 1}).to_list(batch_size)
+        if not products:
+            break
+        await db.products.bulk_write([
+            UpdateOne({"_id": product["_id"]}, {"$set": {"name_normalized": normalize_name(product["name"])}})
+            for product in products
+        ], ordered=False)
+
+# Customer lookup
+# Customers are unique per (branch_id, phone_normalized). Creating a customer
+# whose phone already exists in the branch updates that record instead. A
+# blank or junk phone normalises to "" and means "no phone": such customers
+# are always inserted and are left out of the unique index and lookups.
+def normalize_phone(phone: str) -> str:
+    digits = re.sub(r'\D', '', phone)
+    if digits.startswith('00'):
+        digits = digits[2:]
+    elif len(digits) == PHONE_LOCAL_DIGITS + 1 and digits.startswith('0'):
+        digits = digits[1:]
+    if len(digits) == PHONE_LOCAL_DIGITS and PHONE_DEFAULT_COUNTRY_CODE:
+        digits = PHONE_DEFAULT_COUNTRY_CODE + digits
+    return digits
+
+def customer_document(customer: Customer) -> dict:
+    return {**customer.dict(), "phone_normalized": normalize_phone(customer.phone)}
+
+async def upsert_customer(customer: Customer) -> Customer:
+    document = customer_document(customer)
+    if not document["phone_normalized"]:
+        await db.customers.insert_one(document)
+        return customer
+    set_fields = {field: document[field] for field in ("name", "address", "phone", "version")}
+    insert_fields = {field: value for field, value in document.items() if field not in set_fields}
+    for attempt in range(2):
+        try:
+            stored = await db.customers.find_one_and_update(
+                {"branch_id": customer.branch_id, "phone_normalized": document["phone_normalized"]},
+                {"$set": set_fields, "$setOnInsert": insert_fields},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return Customer(**stored)
+        except DuplicateKeyError:
+            # Lost an upsert race against the unique index; the retry matches the winner
+            if attempt:
+                raise
+
+CUSTOMER_PHONE_INDEX = "branch_id_1_phone_normalized_1"
+
+async def create_customer_phone_index() -> bool:
+    keys = [("branch_id", 1), ("phone_normalized", 1)]
+    # Customers without a phone ("") are left out of the index
+    options = {"name": CUSTOMER_PHONE_INDEX, "unique": True, "partialFilterExpression": {"phone_normalized": {"$gt": ""}}}
+    try:
+        existing = (await db.customers.index_information()).get(CUSTOMER_PHONE_INDEX)
+        if existing and existing.get("partialFilterExpression") != options["partialFilterExpression"]:
+            # Built by an older release with a filter that included ""
+            await db.customers.drop_index(CUSTOMER_PHONE_INDEX)
+        await db.customers.create_index(keys, **options)
+        return True
+    except (DuplicateKeyError, OperationFailure) as e:
+        logger.warning(f"Customer phone index not created, run POST /api/customers/dedup first: {e}")
+        return False
+
+async def backfill_phone_normalized(batch_size: int = 1000):
+    while True:
+        customers = await db.customers.find({"phone_normalized": {"$exists": False}}, {"phone": 1}).to_list(batch_size)
+        if not customers:
+            break
+        await db.customers.bulk_write([
+            UpdateOne({"_id": customer["_id"]}, {"$set": {"phone_normalized": normalize_phone(customer.get("phone", ""))}})
+            for customer in customers
+        ], ordered=False)
+
+async def dedup_customers(dry_run: bool = False, batch_size: int = 500) -> dict:
+    await backfill_phone_normalized()
+    pipeline = [
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": {"branch_id": "$branch_id", "phone": "$phone_normalized"},
+            "ids": {"$push": "$id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}, "_id.phone": {"$ne": ""}}}
+    ]
+    groups = await db.customers.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    summary = {"groups": len(groups), "merged": sum(group["count"] - 1 for group in groups), "sales_updated": 0, "dry_run": dry_run}
+    if dry_run or not groups:
+        if not dry_run:
+            summary["unique_index"] = await create_customer_phone_index()
+        return summary
+    
+    for start in range(0, len(groups), batch_size):
+        chunk = groups[start:start + batch_size]
+        # The oldest record in each group survives and inherits the others' sales
+        async with versioned_write(len(chunk)) as first_version:
+            for tier in ["sales"] + await sales_archive_collections():
+                result = await db[tier].bulk_write([
+                    UpdateMany(
+                        {"branch_id": group["_id"]["branch_id"], "customer_id": {"$in": group["ids"][1:]}},
+                        {"$set": {"customer_id": group["ids"][0], "version": first_version + offset}}
+                    )
+                    for offset, group in enumerate(chunk)
+                ], ordered=False)
+                summary["sales_updated"] += result.modified_count
+        
+        duplicate_ids = [customer_id for group in chunk for customer_id in group["ids"][1:]]
+        duplicates = await db.customers.find({"id": {"$in": duplicate_ids}}, {"id": 1, "branch_id": 1}).to_list(None)
+        await db.customers.delete_many({"id": {"$in": duplicate_ids}})
+        await record_tombstones("customers", duplicates)
+        reference_cache.invalidate("customers:")
+    
+    summary["unique_index"] = await create_customer_phone_index()
+    return summary
+
+# Live events
+# Write routes publish per-branch deltas to subscribers of /api/events. With
+# a replica set the deltas come from Mongo change streams instead, so every
+# worker sees writes made by the others.
+class EventBroker:
+    def __init__(self, max_clients: int, queue_size: int):
+        self.max_clients = max_clients
+        self.queue_size = queue_size
+        # branch_id -> subscriber queues; None holds admins watching every branch
+        self.subscribers: Dict[Optional[str], Set[asyncio.Queue]] = defaultdict(set)
+        self.client_count = 0
+        self.next_event_id = 0
+        self.change_streams_active = False
+    
+    def subscribe(self, branch_id: Optional[str]) -> asyncio.Queue:
+        if self.client_count >= self.max_clients:
+            raise HTTPException(status_code=503, detail="Too many event stream clients", headers={"Retry-After": "30"})
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[branch_id].add(queue)
+        self.client_count += 1
+        return queue
+    
+    def unsubscribe(self, branch_id: Optional[str], queue: asyncio.Queue):
+        if queue in self.subscribers[branch_id]:
+            self.subscribers[branch_id].discard(queue)
+            self.client_count -= 1
+    
+    def publish(self, branch_id: str, event_type: str, data: dict):
+        self.next_event_id += 1
+        event = {"id": self.next_event_id, "type": event_type, "branch_id": branch_id, "data": data}
+        for queue in (*self.subscribers.get(branch_id, ()), *self.subscribers.get(None, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow consumer: drop its backlog and ask it to refetch instead
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"id": self.next_event_id, "type": "resync", "branch_id": branch_id, "data": {}})
+    
+    def close(self):
+        for queues in self.subscribers.values():
+            for queue in queues:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+event_broker = EventBroker(SSE_MAX_CLIENTS, SSE_QUEUE_SIZE)
+change_stream_task: Optional[asyncio.Task] = None
+
+def publish_event(branch_id: str, event_type: str, data: dict):
+    # Change stream mode publishes from the watcher, not from the routes
+    if not event_broker.change_streams_active:
+        event_broker.publish(branch_id, event_type, jsonable_encoder(data))
+
+def low_stock_event(product: dict) -> dict:
+    return {
+        "product_id": product["id"],
+        "name": product["name"],
+        "quantity": product["quantity"],
+        "reorder_level": product.get("reorder_level")
+    }
+
+def publish_change(change: dict):
+    document = change.get("fullDocument")
+    if not document:
+        return
+    branch_id = document.get("branch_id")
+    collection_name = change["ns"]["coll"]
+    if collection_name == "sales" and change["operationType"] == "insert":
+        event_broker.publish(branch_id, "sale_created", jsonable_encoder({
+            "sale_id": document["id"],
+            "invoice_number": document["invoice_number"],
+            "total_amount": document["total_amount"]
+        }))
+        event_broker.publish(branch_id, "totals_changed", {"total_sales_delta": document["total_amount"]})
+    elif collection_name == "products":
+        updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+        if updated_fields.get("low_stock") is True:
+            event_broker.publish(branch_id, "low_stock", low_stock_event(document))
+        if change["operationType"] == "update" and "quantity" not in updated_fields:
+            return
+        event_broker.publish(branch_id, "quantity_changed", {
+            "product_id": document["id"],
+            "name": document["name"],
+            "quantity": document["quantity"]
+        })
+
+async def watch_change_streams():
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "ns.coll": {"$in": ["products", "sales"]}
+    }}]
+    resume_token = None
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    publish_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Change stream interrupted, restarting: {e}")
+            await asyncio.sleep(5)
+
+async def start_event_source():
+    global change_stream_task
+    if SSE_CHANGE_STREAMS == 'off':
+        return
+    try:
+        hello = await client.admin.command("hello")
+    except Exception:
+        return
+    # Change streams need a replica set or sharded cluster
+    if hello.get("setName") or hello.get("msg") == "isdbgrid":
+        event_broker.change_streams_active = True
+        change_stream_task = asyncio.create_task(watch_change_streams())
+
+# Audit log
+# Write routes hand audit events to a bounded in-memory queue and move on.
+# A background task drains it with insert_many whenever AUDIT_BATCH_SIZE
+# events are waiting or AUDIT_FLUSH_INTERVAL_SECONDS has passed. Events go to
+# monthly audit_log_YYYYMM collections, each with a TTL index, and whole
+# partitions past the retention window are dropped.
+class AuditWriter:
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float, enqueue_timeout: float):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.task: Optional[asyncio.Task] = None
+        self.partitions: Set[str] = set()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+    
+    async def record(self, user: Optional[User], action: str, entity: str, entity_id: Optional[str], branch_id: Optional[str] = None, details: Optional[dict] = None):
+        event_id = str(uuid.uuid4())
+        event = {
+            # The id doubles as _id, so rewriting an event that already landed is a no-op
+            "_id": event_id,
+            "id": event_id,
+            "actor_id": user.id if user else None,
+            "actor": user.username if user else None,
+            "action": action,
+            "entity": entity,
+            "entity_id": entity_id,
+            "branch_id": branch_id,
+            "details": jsonable_encoder(details) if details else None,
+            "request_id": request_id.get(),
+            "created_at": datetime.utcnow()
+        }
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Backpressure: make the writer wait briefly for the flusher, then drop
+            try:
+                await asyncio.wait_for(self.queue.put(event), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning(f"Audit queue full, {self.dropped} events dropped so far")
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        # Flush whatever is still queued before the process exits
+        while not self.queue.empty():
+            await self._flush(self._drain(self.batch_size))
+    
+    def _drain(self, limit: int) -> List[dict]:
+        # Takes at most limit events that are already queued, without waiting
+        batch = []
+        while len(batch) < limit and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self.queue.get())
+                flush_at = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = flush_at - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+                batch.extend(self._drain(self.batch_size - len(batch)))
+                await self._flush(batch)
+            except asyncio.CancelledError:
+                # Put the batch being collected or written back so stop() writes it;
+                # events the cancelled insert already stored are skipped as duplicates
+                for event in batch:
+                    if self.queue.full():
+                        self.dropped += 1
+                    else:
+                        self.queue.put_nowait(event)
+                raise
+    
+    async def _flush(self, batch: List[dict]):
+        partitions: Dict[str, List[dict]] = defaultdict(list)
+        for event in batch:
+            partitions[f"audit_log_{event['created_at']:%Y%m}"].append(event)
+        for name, events in partitions.items():
+            for attempt in range(3):
+                try:
+                    if name not in self.partitions:
+                        await self._open_partition(name)
+                    try:
+                        await db[name].insert_many(events, ordered=False)
+                    except BulkWriteError as e:
+                        # Duplicates were stored by an attempt cancelled or failed after the insert
+                        if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                            raise
+                    self.written += len(events)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if attempt == 2:
+                        self.failed += len(events)
+                        logger.error(f"Dropping {len(events)} audit events after write failures: {e}")
+                    else:
+                        await asyncio.sleep(0.5 * (attempt + 1))
+    
+    async def _open_partition(self, name: str):
+        await db[name].create_index("created_at", expireAfterSeconds=AUDIT_RETENTION_DAYS * 24 * 60 * 60)
+        await db[name].create_index([("entity", 1), ("entity_id", 1)])
+        await db[name].create_index([("branch_id", 1), ("created_at", -1)])
+        self.partitions.add(name)
+        # A new month is also a good moment to drop partitions past retention
+        oldest_kept = f"audit_log_{datetime.utcnow() - timedelta(days=AUDIT_RETENTION_DAYS):%Y%m}"
+        for collection_name in await db.list_collection_names(filter={"name": {"$regex": r"^audit_log_\d{6}$"}}):
+            if collection_name < oldest_kept:
+                await db.drop_collection(collection_name)
+    
+    def snapshot(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
+
+audit_log = AuditWriter(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL_SECONDS, AUDIT_ENQUEUE_TIMEOUT_SECONDS)
+
+# Sales archive
+# Sales older than SALES_HOT_DAYS move, in batches per branch, from sales to
+# monthly sales_archive_YYYYMM collections created with a stronger block
+# compressor, so the hot collection and its indexes stay small enough to
+# stay in RAM. Each batch is inserted into the archive before it is deleted
+# from sales, and archive inserts ignore duplicate ids, so an interrupted
+# run can simply be repeated. sales_archive_totals keeps per-branch monthly
+# amounts of archived sales for the dashboard; months written to are marked
+# dirty until their totals are recomputed. Reads that need history (sales
+# list, invoices, dashboard, margin analytics, customer merges) go through
+# the helpers below and cover both tiers.
+SALES_ARCHIVE_PREFIX = "sales_archive_"
+SALES_ARCHIVE_PATTERN = re.compile(r"sales_archive_(\d{6})")
+sales_archive_task: Optional[asyncio.Task] = None
+sales_archive_names: Optional[tuple] = None  # (listed_at, names newest first)
+
+async def sales_archive_collections() -> List[str]:
+    global sales_archive_names
+    # Listed at most once a minute; archives only appear when the job runs
+    if sales_archive_names is None or time.monotonic() - sales_archive_names[0] > 60:
+        names = [name for name in await db.list_collection_names() if SALES_ARCHIVE_PATTERN.fullmatch(name)]
+        sales_archive_names = (time.monotonic(), sorted(names, reverse=True))
+    return sales_archive_names[1]
+
+async def find_recent_sales(branch_id: str, limit: int) -> List[dict]:
+    # Newest first; older tiers are only read when the hot tier runs short
+    sales = await db.sales.find({"branch_id": branch_id}).sort("created_at", -1).to_list(limit)
+    for name in await sales_archive_collections():
+        if len(sales) >= limit:
+            break
+        sales += await db[name].find({"branch_id": branch_id}).sort("created_at", -1).to_list(limit - len(sales))
+    return sales
+
+async def find_sale(sale_id: str) -> Optional[dict]:
+    sale = await db.sales.find_one({"id": sale_id})
+    if sale:
+        return sale
+    archives = await sales_archive_collections()
+    found = await asyncio.gather(*(db[name].find_one({"id": sale_id}) for name in archives))
+    return next((sale for sale in found if sale), None)
+
+async def next_invoice_sequence(branch_id: str) -> int:
+    # Counting sales would go backwards once old ones are archived
+    counter_id = f"invoice:{branch_id}"
+    if await db.counters.find_one({"_id": counter_id}) is None:
+        archived = await repository.summarize("sales_archive_totals", {"branch_id": branch_id}, None, {"count": ["count"]})
+        existing = await db.sales.count_documents({"branch_id": branch_id}) + (archived[0]["count"] if archived else 0)
+        await repository.seed_sequence(counter_id, existing)
+    return await repository.next_sequence(counter_id)
+
+async def ensure_sales_archive(name: str):
+    global sales_archive_names
+    if name in await sales_archive_collections():
+        return
+    try:
+        await db.create_collection(name, storageEngine={"wiredTiger": {"configString": f"block_compressor={SALES_ARCHIVE_COMPRESSOR}"}})
+    except OperationFailure:
+        pass  # created by an earlier, interrupted run
+    await db[name].create_index("id", unique=True)
+    await db[name].create_index([("branch_id", 1), ("created_at", -1)])
+    sales_archive_names = None
+
+async def recompute_archive_totals(month: str):
+    name = f"{SALES_ARCHIVE_PREFIX}{month.replace('-', '')}"
+    totals = await db[name].aggregate([
+        {"$group": {"_id": "$branch_id", "amount": {"$sum": "$total_amount"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    if totals:
+        await db.sales_archive_totals.bulk_write([
+            UpdateOne(
+                {"branch_id": row["_id"], "month": month},
+                {"$set": {"amount": row["amount"], "count": row["count"]}},
+                upsert=True
+            )
+            for row in totals
+        ], ordered=False)
+    await db.sales_archive_state.update_one({"_id": "state"}, {"$pull": {"dirty_months": month}})
+
+async def archive_sales() -> dict:
+    cutoff = datetime.utcnow() - timedelta(days=SALES_HOT_DAYS)
+    state = await db.sales_archive_state.find_one({"_id": "state"}) or {}
+    for month in state.get("dirty_months", []):
+        await recompute_archive_totals(month)
+    
+    moved = 0
+    months = set()
+    for branch_id in await get_branch_ids():
+        while True:
+            batch = await db.sales.find(
+                {"branch_id": branch_id, "created_at": {"$lt": cutoff}}, {"_id": 0}
+            ).sort("created_at", 1).limit(SALES_ARCHIVE_BATCH_SIZE).to_list(SALES_ARCHIVE_BATCH_SIZE)
+            if not batch:
+                break
+            by_month: Dict[str, list] = defaultdict(list)
+            for sale in batch:
+                by_month[f"{sale['created_at']:%Y-%m}"].append(sale)
+            await db.sales_archive_state.update_one(
+                {"_id": "state"}, {"$addToSet": {"dirty_months": {"$each": list(by_month)}}}, upsert=True
+            )
+            for month, sales in by_month.items():
+                name = f"{SALES_ARCHIVE_PREFIX}{month.replace('-', '')}"
+                await ensure_sales_archive(name)
+                try:
+                    await db[name].insert_many(sales, ordered=False)
+                except BulkWriteError as e:
+                    # Already archived by an interrupted run; anything else is a real failure
+                    if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                        raise
+            await db.sales.delete_many({"branch_id": branch_id, "id": {"$in": [sale["id"] for sale in batch]}})
+            moved += len(batch)
+            months.update(by_month)
+    
+    for month in sorted(months):
+        await recompute_archive_totals(month)
+    return {"moved": moved, "months": sorted(months), "cutoff": cutoff}
+
+async def run_sales_archive_scheduler():
+    interval = timedelta(hours=SALES_ARCHIVE_INTERVAL_HOURS)
+    while True:
+        try:
+            token = await acquire_lease("sales_archive", SALES_ARCHIVE_LEASE_SECONDS)
+            if token:
+                async with keep_lease("sales_archive", token, SALES_ARCHIVE_LEASE_SECONDS):
+                    await archive_sales()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Sales archive run failed: {e}")
+        await asyncio.sleep(interval.total_seconds())
+
+# Margin analytics
+# Margin reports run in a process pool with a synchronous client of their own,
+# so loading millions of sale items and grouping them never blocks the API
+# loop. Sale items are flattened by an $unwind pipeline and collected into
+# NumPy column chunks, then costed and aggregated with pandas in vectorised
+# passes. Items carry the purchase price at the time of sale; older sales
+# without one fall back to the product's current purchase price.
+MARGIN_GROUPS = {"product": "product_id", "customer": "customer_id", "branch": "branch_id"}
+MARGIN_SORTS = ("margin", "revenue", "cost", "quantity", "margin_pct")
+MARGIN_COLUMNS = ("branch_id", "customer_id", "created_at", "product_id", "quantity", "selling_price", "purchase_price")
+analytics_executor = None
+analytics_database = None
+
+def init_analytics_worker(url: str, db_name: str, options: dict):
+    global analytics_database
+    from pymongo import MongoClient
+    analytics_database = MongoClient(url, **options)[db_name]
+
+def get_analytics_executor():
+    global analytics_executor
+    if analytics_executor is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn, not fork: forking would copy the event loop and Motor's threads
+        options = {
+            **mongo_settings.client_options(),
+            'readPreference': mongo_settings.report_read_preference,
+            'maxPoolSize': 4,
+        }
+        analytics_executor = ProcessPoolExecutor(
+            max_workers=ANALYTICS_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_analytics_worker,
+            initargs=(mongo_settings.url, mongo_settings.db_name, options)
+        )
+    return analytics_executor
+
+def load_sale_items(database, branch_ids: List[str], start: Optional[datetime], end: Optional[datetime], max_time_ms: Optional[int]):
+    import numpy as np
+    import pandas as pd
+    
+    sale_filter: Dict[str, Any] = {"branch_id": {"$in": branch_ids}}
+    if start or end:
+        sale_filter["created_at"] = {key: value for key, value in (("$gte", start), ("$lt", end)) if value}
+    pipeline = [
+        {"$match": sale_filter},
+        {"$unwind": "$items"},
+        {"$project": {
+            "_id": 0, "branch_id": 1, "customer_id": 1, "created_at": 1,
+            "product_id": "$items.product_id",
+            "quantity": "$items.quantity",
+            "selling_price": "$items.selling_price",
+            "purchase_price": "$items.purchase_price",
+        }},
+    ]
+    options = {"batchSize": 10000}
+    if max_time_ms:
+        options["maxTimeMS"] = max_time_ms
+    
+    # Rows are gathered per column and turned into arrays every chunk, so
+    # peak memory is one chunk of Python objects plus the arrays so far
+    chunks: Dict[str, list] = {column: [] for column in MARGIN_COLUMNS}
+    pending: Dict[str, list] = {column: [] for column in MARGIN_COLUMNS}
+    
+    def close_chunk():
+        chunks["branch_id"].append(np.array(pending["branch_id"], dtype=object))
+        chunks["customer_id"].append(np.array(pending["customer_id"], dtype=object))
+        chunks["product_id"].append(np.array(pending["product_id"], dtype=object))
+        chunks["created_at"].append(np.array(pending["created_at"], dtype="datetime64[ms]"))
+        chunks["quantity"].append(np.array(pending["quantity"], dtype=np.float64))
+        chunks["selling_price"].append(np.array(pending["selling_price"], dtype=np.float64))
+        # None becomes NaN and is filled from current product costs later
+        chunks["purchase_price"].append(np.array(pending["purchase_price"], dtype=np.float64))
+        for values in pending.values():
+            values.clear()
+    
+    # The hot collection plus every archive month that overlaps the range
+    tiers = ["sales"] + [
+        name for name in database.list_collection_names()
+        if SALES_ARCHIVE_PATTERN.fullmatch(name)
+        and (start is None or name[-6:] >= f"{start:%Y%m}")
+        and (end is None or name[-6:] <= f"{end:%Y%m}")
+    ]
+    for tier in tiers:
+        for row in database[tier].aggregate(pipeline, **options):
+            for column in MARGIN_COLUMNS:
+                pending[column].append(row.get(column))
+            if len(pending["product_id"]) >= ANALYTICS_CHUNK_ROWS:
+                close_chunk()
+    if pending["product_id"] or not chunks["product_id"]:
+        close_chunk()
+    
+    frame = pd.DataFrame({column: np.concatenate(arrays) for column, arrays in chunks.items()})
+    for column in ("branch_id", "customer_id", "product_id"):
+        frame[column] = frame[column].astype("category")
+    return frame
+
+def load_product_costs(database, branch_ids: List[str]):
+    import pandas as pd
+    products = list(database.products.find({"branch_id": {"$in": branch_ids}}, {"_id": 0, "id": 1, "purchase_price": 1}))
+    return pd.Series(
+        [product.get("purchase_price") for product in products],
+        index=[product["id"] for product in products],
+        dtype="float64"
+    )
+
+def compute_margins(frame, costs, group_by: str, sort: str, top: int) -> dict:
+    import numpy as np
+    
+    cost_per_unit = frame["purchase_price"].to_numpy()
+    missing = np.isnan(cost_per_unit)
+    if missing.any():
+        current_costs = frame["product_id"].astype(object).map(costs).to_numpy(dtype=np.float64)
+        cost_per_unit = np.where(missing, current_costs, cost_per_unit)
+    known_cost = ~np.isnan(cost_per_unit)
+    
+    quantity = frame["quantity"].to_numpy()
+    frame = frame.assign(
+        revenue=quantity * frame["selling_price"].to_numpy(),
+        cost=np.where(known_cost, quantity * np.nan_to_num(cost_per_unit), 0.0),
+        month=frame["created_at"].dt.strftime("%Y-%m"),
+    )
+    # Items whose product no longer exists count towards revenue only
+    frame["margin"] = np.where(known_cost, frame["revenue"] - frame["cost"], 0.0)
+    frame["costed_revenue"] = np.where(known_cost, frame["revenue"], 0.0)
+    measures = ["quantity", "revenue", "cost", "margin", "costed_revenue"]
+    
+    def with_ratios(table):
+        revenue = table["costed_revenue"].to_numpy()
+        table["margin_pct"] = np.divide(table["margin"] * 100, revenue, out=np.full(len(table), np.nan), where=revenue != 0)
+        return table.drop(columns="costed_revenue")
+    
+    groups = with_ratios(frame.groupby(MARGIN_GROUPS[group_by], observed=True)[measures].sum())
+    groups = groups.sort_values(sort, ascending=False, na_position="last").head(top)
+    
+    monthly = with_ratios(frame.groupby("month")[measures].sum()).sort_index()
+    monthly["revenue_change_pct"] = monthly["revenue"].pct_change(fill_method=None) * 100
+    monthly["margin_change_pct"] = monthly["margin"].pct_change(fill_method=None) * 100
+    
+    totals = with_ratios(frame[measures].sum().to_frame().T).iloc[0]
+    
+    def records(table, key: str) -> List[dict]:
+        table = table.replace([np.inf, -np.inf], np.nan).round(2).reset_index(names=key)
+        return table.astype(object).where(table.notna(), None).to_dict("records")
+    
+    return {
+        "totals": {
+            **{key: (None if np.isnan(value) else round(float(value), 2)) for key, value in totals.items()},
+            "items": int(len(frame)),
+            "uncosted_items": int((~known_cost).sum()),
+        },
+        "groups": records(groups, "key"),
+        "monthly": records(monthly, "month"),
+    }
 
-class SaleCreate(BaseModel):
-    customer_id: str
-    items: List[Dict[str, Any]]
+def run_margin_report(branch_ids: List[str], start: Optional[datetime], end: Optional[datetime], group_by: str, sort: str, top: int, max_time_ms: Optional[int]) -> dict:
+    # Runs inside an analytics worker process
+    frame = load_sale_items(analytics_database, branch_ids, start, end, max_time_ms)
+    costs = load_product_costs(analytics_database, branch_ids)
+    return compute_margins(frame, costs, group_by, sort, top)
 
-# Utility functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# Parquet export
+# Sales, flattened sale items, products and stock movements are written to
+# EXPORT_DIR/<dataset>/branch_id=<id>/month=<YYYY-MM>/part-*.parquet, a hive
+# layout that pyarrow, pandas, Spark and DuckDB read as one partitioned
+# dataset. Each run reads only rows past the dataset's watermark in
+# export_state, in sorted chunked cursors per branch, and appends new part
+# files. The upper bound of a run is saved before any file is written, so a
+# run that dies halfway is redone over the same range with the same file
+# names. Append-only datasets are cut off EXPORT_SAFETY_LAG_SECONDS in the
+# past so in-flight writes and secondary lag are not skipped; products are
+# exported by sync version, as a new row per changed product, partitioned by
+# the month of the run. Every worker serving downloads needs the same
+# EXPORT_DIR, e.g. a shared volume.
+EXPORT_DATASETS: Dict[str, dict] = {
+    "sales": {
+        "collection": "sales",
+        "key": "created_at",
+        "columns": {
+            "id": "string", "branch_id": "string", "customer_id": "string", "invoice_number": "string",
+            "total_amount": "double", "created_at": "timestamp[ms]", "version": "int64",
+        },
+    },
+    "sale_items": {
+        "collection": "sales",
+        "key": "created_at",
+        "columns": {
+            "sale_id": "string", "line": "int64", "branch_id": "string", "customer_id": "string",
+            "product_id": "string", "quantity": "double", "selling_price": "double",
+            "purchase_price": "double", "created_at": "timestamp[ms]",
+        },
+    },
+    "products": {
+        "collection": "products",
+        "key": "version",
+        "columns": {
+            "id": "string", "branch_id": "string", "name": "string", "vendor_id": "string",
+            "quantity": "int64", "purchase_price": "double", "selling_price": "double",
+            "created_at": "timestamp[ms]", "version": "int64", "exported_at": "timestamp[ms]",
+        },
+    },
+    "stock_movements": {
+        "collection": "stock_movements",
+        "key": "created_at",
+        "columns": {
+            "id": "string", "branch_id": "string", "product_id": "string", "name": "string",
+            "quantity_delta": "int64", "kind": "string", "reference_id": "string", "created_at": "timestamp[ms]",
+        },
+    },
+}
+EXPORT_FILE_PATTERN = re.compile(r"part-[A-Za-z0-9]+-\d+\.parquet")
+EXPORT_PATH_SEGMENT = re.compile(r"[A-Za-z0-9_-]+")
+export_lock = asyncio.Lock()
+export_task: Optional[asyncio.Task] = None
+export_scheduler_task: Optional[asyncio.Task] = None
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+def export_rows(dataset: str, document: dict, exported_at: datetime) -> List[dict]:
+    if dataset == "sale_items":
+        return [
+            {**item, "sale_id": document["id"], "line": line, "branch_id": document["branch_id"],
+             "customer_id": document["customer_id"], "created_at": document["created_at"]}
+            for line, item in enumerate(document.get("items", []))
+        ]
+    if dataset == "products":
+        return [{**document, "exported_at": exported_at}]
+    return [document]
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+def write_export_part(path: Path, columns: Dict[str, str], rows: List[dict]):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    schema = pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in columns.items()])
+    table = pa.Table.from_pylist([{name: row.get(name) for name in columns} for row in rows], schema=schema)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per write so an overlapping run never shares a temporary file
+    temporary = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    pq.write_table(table, temporary, compression="zstd")
+    os.replace(temporary, path)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
+async def export_dataset(dataset: str) -> dict:
+    spec = EXPORT_DATASETS[dataset]
+    key = spec["key"]
+    state = await db.export_state.find_one({"_id": dataset}) or {}
+    lower = state.get("watermark")
+    upper = state.get("pending_until")
+    if upper is None:
+        if key == "version":
+            # Stop below versions whose writes have not landed yet
+            upper = await stable_version()
+        else:
+            upper = datetime.utcnow() - timedelta(seconds=EXPORT_SAFETY_LAG_SECONDS)
+        await db.export_state.update_one({"_id": dataset}, {"$set": {"pending_until": upper}}, upsert=True)
+    exported_at = state.get("pending_exported_at") or datetime.utcnow()
+    if "pending_exported_at" not in state:
+        await db.export_state.update_one({"_id": dataset}, {"$set": {"pending_exported_at": exported_at}})
+    tag = f"v{upper}" if key == "version" else f"{upper:%Y%m%dT%H%M%S%f}"
+    # Versions must be read from the primary; time-keyed reads can tolerate lag
+    source = db if key == "version" else reporting_db
+    key_range = {"$lte": upper} if lower is None else {"$gt": lower, "$lte": upper}
+    
+    files = 0
+    rows_written = 0
+    for branch_id in await get_branch_ids():
+        buffer: List[dict] = []
+        month = None
+        part = 0
         
-        user = await db.users.find_one({"username": username})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
+        async def flush():
+            nonlocal files, rows_written, part
+            path = EXPORT_DIR / dataset / f"branch_id={branch_id}" / f"month={month}" / f"part-{tag}-{part:05d}.parquet"
+            await asyncio.to_thread(write_export_part, path, spec["columns"], buffer)
+            files += 1
+            rows_written += len(buffer)
+            part += 1
+            buffer.clear()
         
-        return User(**user)
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        cursor = source[spec["collection"]].find({"branch_id": branch_id, key: key_range}, {"_id": 0}).sort(key, 1).batch_size(EXPORT_CHUNK_ROWS)
+        async for document in cursor:
+            for row in export_rows(dataset, document, exported_at):
+                row_month = f"{exported_at if key == 'version' else row['created_at']:%Y-%m}"
+                if buffer and (row_month != month or len(buffer) >= EXPORT_CHUNK_ROWS):
+                    await flush()
+                month = row_month
+                buffer.append(row)
+        if buffer:
+            await flush()
+    
+    result = {"dataset": dataset, "files": files, "rows": rows_written, "watermark": upper, "finished_at": datetime.utcnow()}
+    await db.export_state.update_one(
+        {"_id": dataset},
+        {"$set": {"watermark": upper, "last_run": result}, "$unset": {"pending_until": "", "pending_exported_at": ""}}
+    )
+    return result
 
-def require_admin(current_user: User = Depends(get_current_user)):
-    if current_user.role != 'admin':
-        raise HTTPException(status_code=403, detail="Admin access required")
-    return current_user
+async def run_exports(force: bool = False) -> List[dict]:
+    results = []
+    async with export_lock:
+        for dataset in EXPORT_DATASETS:
+            state = await db.export_state.find_one({"_id": dataset}) or {}
+            last_run = state.get("last_run")
+            due = last_run is None or datetime.utcnow() - last_run["finished_at"] >= timedelta(hours=EXPORT_INTERVAL_HOURS)
+            # An interrupted run is always finished first
+            if force or due or "pending_until" in state:
+                results.append(await export_dataset(dataset))
+    return results
 
-def get_user_branch_filter(user: User):
-    if user.role == 'admin':
-        return {}  # Admin can see all branches
-    return {"branch_id": user.branch_id}
+async def run_export_scheduler():
+    while True:
+        try:
+            token = await acquire_lease("exports", EXPORT_LEASE_SECONDS)
+            if token:
+                async with keep_lease("exports", token, EXPORT_LEASE_SECONDS):
+                    await run_exports()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Parquet export run failed: {e}")
+        await asyncio.sleep(min(EXPORT_INTERVAL_HOURS * 3600, 3600))
+
+def list_export_files(dataset: Optional[str], branch_id: Optional[str], month: Optional[str]) -> List[dict]:
+    files = []
+    for path in sorted(EXPORT_DIR.glob(f"{dataset or '*'}/branch_id={branch_id or '*'}/month={month or '*'}/part-*.parquet")):
+        stat = path.stat()
+        files.append({
+            "dataset": path.parts[-4],
+            "branch_id": path.parts[-3].split("=", 1)[1],
+            "month": path.parts[-2].split("=", 1)[1],
+            "name": path.name,
+            "size": stat.st_size,
+            "modified_at": datetime.utcfromtimestamp(stat.st_mtime),
+        })
+    return files
+
+# Database indexes
+async def create_indexes():
+    await db.leases.create_index("expires_at")
+    await create_unique_index("users", "username")
+    await create_unique_index("branches", "code")
+    await db.idempotency_keys.create_index("key", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+    for collection_name in SYNC_COLLECTIONS:
+        await db[collection_name].create_index([("branch_id", 1), ("version", 1)])
+        await db[collection_name].create_index("version")
+    await db.sync_tombstones.create_index([("branch_id", 1), ("version", 1)])
+    await db.sync_tombstones.create_index("version")
+    await db.stock_summary.create_index([("branch_id", 1), ("kind", 1), ("name", 1)], unique=True)
+    for collection_name in BRANCH_SCOPED_COLLECTIONS:
+        await db[collection_name].create_index([("branch_id", 1), ("id", 1)])
+    await db.sales.create_index([("branch_id", 1), ("created_at", -1)])
+    await db.products.create_index([("branch_id", 1), ("name_normalized", 1)])
+    await db.products.create_index([("branch_id", 1), ("name", "text")])
+    await db.products.create_index(
+        [("branch_id", 1), ("quantity", 1)],
+        partialFilterExpression={"low_stock": True}
+    )
+    await db.stock_movements.create_index([("branch_id", 1), ("created_at", 1)])
+    await db.stock_movements.create_index([("product_id", 1), ("created_at", 1)])
+    await db.stock_snapshots.create_index([("branch_id", 1), ("complete", 1), ("taken_at", 1)])
+    await db.stock_snapshot_items.create_index("snapshot_id")
+    await db.reorder_points.create_index([("branch_id", 1), ("product_id", 1)], unique=True)
+    await db.sales_archive_totals.create_index([("branch_id", 1), ("month", 1)], unique=True)
+    await db.reorder_points.create_index(
+        [("branch_id", 1), ("days_of_cover", 1)],
+        partialFilterExpression={"below_reorder_point": True}
+    )
+
+# Leases
+# A lease is a lock document with an expiry, so one worker can own a job
+# (seeding, snapshots) and a crashed owner's lease simply runs out. Each
+# acquisition gets its own token, so a second run on the same worker is
+# refused like any other and only the holder can renew or release it.
+# keep_lease renews the lease while a long job runs and releases it after.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def acquire_lease(name: str, ttl_seconds: float) -> Optional[str]:
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+    try:
+        await db.leases.update_one(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"owner": WORKER_ID, "token": token, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return token
+    except DuplicateKeyError:
+        # The lease document exists and a live holder owns it
+        return None
+
+async def renew_lease(name: str, token: str, ttl_seconds: float) -> bool:
+    result = await db.leases.update_one(
+        {"_id": name, "token": token},
+        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds)}}
+    )
+    return result.matched_count == 1
+
+async def release_lease(name: str, token: str):
+    await db.leases.delete_one({"_id": name, "token": token})
+
+@asynccontextmanager
+async def keep_lease(name: str, token: str, ttl_seconds: float):
+    async def renew():
+        while True:
+            await asyncio.sleep(ttl_seconds / 3)
+            try:
+                if not await renew_lease(name, token, ttl_seconds):
+                    logger.warning(f"Lease {name} expired before it could be renewed")
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lease {name} renewal failed: {e}")
+    
+    # Started in an empty context so a request's deadline does not apply
+    renewal = contextvars.Context().run(asyncio.create_task, renew())
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        await release_lease(name, token)
+
+async def create_unique_index(collection_name: str, keys, **kwargs) -> bool:
+    try:
+        await db[collection_name].create_index(keys, unique=True, **kwargs)
+        return True
+    except (DuplicateKeyError, OperationFailure) as e:
+        logger.warning(f"Unique index on {collection_name} {keys} not created: {e}")
+        return False
 
 # Initialize default data
+# Every step is an upsert so re-running it, or racing another worker, never
+# creates duplicates; startup_event still runs it under a lease.
 async def init_default_data():
     # Create default admin
-    admin_exists = await db.users.find_one({"role": "admin"})
+    admin_exists = await db.users.find_one({"role": "admin"}, {"_id": 1})
     if not admin_exists:
         admin_user = User(
             username="admin",
             email="admin@abc.com",
-            password_hash=hash_password("admin123"),
+            password_hash=await asyncio.to_thread(hash_password, "admin123"),
             role="admin"
         )
-        await db.users.insert_one(admin_user.dict())
+        await db.users.update_one({"username": admin_user.username}, {"$setOnInsert": admin_user.dict()}, upsert=True)
     
     # Create default branches
-    branch_a_exists = await db.branches.find_one({"code": "BRA"})
-    if not branch_a_exists:
-        branch_a = Branch(name="Branch A", code="BRA", address="Branch A Address")
-        await db.branches.insert_one(branch_a.dict())
-    
-    branch_b_exists = await db.branches.find_one({"code": "BRB"})
-    if not branch_b_exists:
-        branch_b = Branch(name="Branch B", code="BRB", address="Branch B Address")
-        await db.branches.insert_one(branch_b.dict())
+    default_branches = [
+        Branch(name="Branch A", code="BRA", address="Branch A Address"),
+        Branch(name="Branch B", code="BRB", address="Branch B Address"),
+    ]
+    await db.branches.bulk_write([
+        UpdateOne({"code": branch.code}, {"$setOnInsert": branch.dict()}, upsert=True)
+        for branch in default_branches
+    ], ordered=False)
     
     # Create default company
-    company_exists = await db.company.find_one({})
-    if not company_exists:
-        company = Company(
-            name="ABC Pvt Ltd",
-            address="Singur, Hooghly",
-            phone="+917545212547"
-        )
-        await db.company.insert_one(company.dict())
+    company = Company(
+        name="ABC Pvt Ltd",
+        address="Singur, Hooghly",
+        phone="+917545212547"
+    )
+    await db.company.update_one({}, {"$setOnInsert": company.dict()}, upsert=True)
 
 # Routes
 @api_router.post("/login")
+@priority("critical")
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"username": user_data.username})
     if not user or not verify_password(user_data.password, user["password_hash"]):
@@ -244,29 +3091,25 @@ async def login(user_data: UserLogin):
     }
 
 @api_router.get("/me")
+@priority("critical")
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
 
 # Dashboard routes
-@api_router.get("/dashboard")
-async def get_dashboard(current_user: User = Depends(get_current_user)):
-    branch_filter = get_user_branch_filter(current_user)
+async def branch_dashboard(branch_id: str) -> dict:
+    branch_filter = {"branch_id": branch_id}
     
     # Get total sales
     sales_pipeline = [
         {"$match": branch_filter},
         {"$group": {"_id": None, "total": {"$sum": "$total_amount"}}}
     ]
-    total_sales_result = await db.sales.aggregate(sales_pipeline).to_list(1)
-    total_sales = total_sales_result[0]["total"] if total_sales_result else 0
     
     # Get total purchase value (products * purchase_price * quantity)
     products_pipeline = [
         {"$match": branch_filter},
         {"$group": {"_id": None, "total": {"$sum": {"$multiply": ["$purchase_price", "$quantity"]}}}}
     ]
-    total_purchase_result = await db.products.aggregate(products_pipeline).to_list(1)
-    total_purchase = total_purchase_result[0]["total"] if total_purchase_result else 0
     
     # Get monthly sales (last 12 months)
     monthly_sales_pipeline = [
@@ -278,26 +3121,53 @@ async def get_dashboard(current_user: User = Depends(get_current_user)):
         {"$sort": {"_id": 1}},
         {"$limit": 12}
     ]
-    monthly_sales = await db.sales.aggregate(monthly_sales_pipeline).to_list(12)
     
-    # Get stock count
-    stock_count = await db.products.count_documents(branch_filter)
+    total_sales_result, total_purchase_result, monthly_sales, stock_count, archived = await asyncio.gather(
+        reporting_db.sales.aggregate(sales_pipeline).to_list(1),
+        reporting_db.products.aggregate(products_pipeline).to_list(1),
+        reporting_db.sales.aggregate(monthly_sales_pipeline).to_list(12),
+        reporting_db.products.count_documents(branch_filter),
+        # Archived months come from precomputed totals
+        reporting_db.sales_archive_totals.find(branch_filter, {"_id": 0, "month": 1, "amount": 1}).sort("month", 1).to_list(None)
+    )
+    archived_monthly = [{"_id": row["month"], "amount": row["amount"]} for row in archived]
     
     return {
-        "total_sales": total_sales,
-        "total_purchase": total_purchase,
+        "total_sales": (total_sales_result[0]["total"] if total_sales_result else 0) + sum(row["amount"] for row in archived),
+        "total_purchase": total_purchase_result[0]["total"] if total_purchase_result else 0,
         "stock_count": stock_count,
+        # The oldest month may be split between the archive and the hot tier
+        "monthly_sales": merge_top_n([merge_grouped([archived_monthly, monthly_sales], "_id", ["amount"])], 12, "_id", reverse=False)
+    }
+
+@api_router.get("/dashboard")
+@priority("best_effort")
+async def get_dashboard(current_user: User = Depends(get_current_user)):
+    parts = await fan_out(await scope_branch_ids(current_user), branch_dashboard)
+    
+    # Every branch reports its first 12 months, so the merged first 12 are exact
+    monthly_sales = merge_grouped([part["monthly_sales"] for part in parts], "_id", ["amount"])
+    monthly_sales = merge_top_n([monthly_sales], 12, "_id", reverse=False)
+    
+    return {
+        **merge_sums(parts, ["total_sales", "total_purchase", "stock_count"]),
         "monthly_sales": monthly_sales
     }
 
 # Branch management (Admin only)
 @api_router.get("/branches", response_model=List[Branch])
 async def get_branches(admin_user: User = Depends(require_admin)):
-    branches = await db.branches.find().to_list(100)
-    return [Branch(**branch) for branch in branches]
+    branches = await cached_branches()
+    return [Branch(**branch) for branch in branches[:100]]
 
 @api_router.post("/branches", response_model=Branch)
-async def create_branch(branch_data: BranchCreate, admin_user: User = Depends(require_admin)):
+async def create_branch(branch_data: BranchCreate, admin_user: User = Depends(require_admin), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "branches", admin_user, branch_data,
+        lambda: _create_branch(branch_data, admin_user)
+    )
+
+async def _create_branch(branch_data: BranchCreate, admin_user: User):
     # Check if code already exists
     existing = await db.branches.find_one({"code": branch_data.code})
     if existing:
@@ -305,6 +3175,8 @@ async def create_branch(branch_data: BranchCreate, admin_user: User = Depends(re
     
     branch = Branch(**branch_data.dict())
     await db.branches.insert_one(branch.dict())
+    reference_cache.invalidate("branches")
+    await audit_log.record(admin_user, "create", "branches", branch.id, branch.id)
     return branch
 
 @api_router.put("/branches/{branch_id}", response_model=Branch)
@@ -320,6 +3192,8 @@ async def update_branch(branch_id: str, branch_data: BranchCreate, admin_user: U
     
     updated_branch = Branch(id=branch_id, **branch_data.dict())
     await db.branches.update_one({"id": branch_id}, {"$set": updated_branch.dict()})
+    reference_cache.invalidate("branches")
+    await audit_log.record(admin_user, "update", "branches", branch_id, branch_id, branch_data.dict())
     return updated_branch
 
 @api_router.delete("/branches/{branch_id}")
@@ -334,6 +3208,8 @@ async def delete_branch(branch_id: str, admin_user: User = Depends(require_admin
     result = await db.branches.delete_one({"id": branch_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Branch not found")
+    reference_cache.invalidate("branches")
+    await audit_log.record(admin_user, "delete", "branches", branch_id, branch_id)
     return {"message": "Branch deleted successfully"}
 
 # User management (Admin only)
@@ -343,7 +3219,13 @@ async def get_users(admin_user: User = Depends(require_admin)):
     return [User(**user) for user in users]
 
 @api_router.post("/users", response_model=User)
-async def create_user(user_data: UserCreate, admin_user: User = Depends(require_admin)):
+async def create_user(user_data: UserCreate, admin_user: User = Depends(require_admin), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "users", admin_user, user_data,
+        lambda: _create_user(user_data, admin_user)
+    )
+
+async def _create_user(user_data: UserCreate, admin_user: User):
     # Check if username exists
     existing = await db.users.find_one({"username": user_data.username})
     if existing:
@@ -357,12 +3239,13 @@ async def create_user(user_data: UserCreate, admin_user: User = Depends(require_
         branch_id=user_data.branch_id
     )
     await db.users.insert_one(user.dict())
+    await audit_log.record(admin_user, "create", "users", user.id, user.branch_id, {"username": user.username, "role": user.role})
     return user
 
 # Company management
 @api_router.get("/company")
 async def get_company(current_user: User = Depends(get_current_user)):
-    company = await db.company.find_one({})
+    company = await cached_company()
     return Company(**company) if company else None
 
 @api_router.put("/company")
@@ -374,246 +3257,927 @@ async def update_company(company_data: CompanyUpdate, admin_user: User = Depends
     else:
         updated_company = Company(**company_data.dict())
         await db.company.insert_one(updated_company.dict())
+    reference_cache.invalidate("company")
+    await audit_log.record(admin_user, "update", "company", updated_company.id)
     return updated_company
 
 # Vendor management
 @api_router.get("/vendors", response_model=List[Vendor])
-async def get_vendors(current_user: User = Depends(get_current_user)):
-    branch_filter = get_user_branch_filter(current_user)
-    vendors = await db.vendors.find(branch_filter).to_list(100)
-    return [Vendor(**vendor) for vendor in vendors]
+async def get_vendors(fields: Optional[str] = None, if_none_match: Optional[str] = Header(None), current_user: User = Depends(get_current_user)):
+    return await conditional_list("vendors", Vendor, get_user_branch_filter(current_user), fields, if_none_match)
 
 @api_router.post("/vendors", response_model=Vendor)
-async def create_vendor(vendor_data: VendorCreate, current_user: User = Depends(get_current_user)):
-    # For non-admin users, use their assigned branch
-    if current_user.role != 'admin':
-        if not current_user.branch_id:
-            raise HTTPException(status_code=400, detail="User must be assigned to a branch")
-        branch_id = current_user.branch_id
-    else:
-        # For admin users, use the first available branch as default
-        branches = await db.branches.find().to_list(1)
-        if not branches:
-            raise HTTPException(status_code=400, detail="No branches available")
-        branch_id = branches[0]["id"]
-    
-    vendor = Vendor(branch_id=branch_id, **vendor_data.dict())
-    await db.vendors.insert_one(vendor.dict())
+async def create_vendor(vendor_data: VendorCreate, current_user: User = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "vendors", current_user, vendor_data,
+        lambda: _create_vendor(vendor_data, current_user)
+    )
+
+async def _create_vendor(vendor_data: VendorCreate, current_user: User):
+    branch_id = await resolve_branch_id(current_user)
+    
+    async with versioned_write() as version:
+        vendor = Vendor(branch_id=branch_id, version=version, **vendor_data.dict())
+        await db.vendors.insert_one(vendor.dict())
+    reference_cache.invalidate("vendors:")
+    await audit_log.record(current_user, "create", "vendors", vendor.id, branch_id)
     return vendor
 
 # Customer management
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers(current_user: User = Depends(get_current_user)):
-    branch_filter = get_user_branch_filter(current_user)
-    customers = await db.customers.find(branch_filter).to_list(100)
-    return [Customer(**customer) for customer in customers]
+async def get_customers(fields: Optional[str] = None, if_none_match: Optional[str] = Header(None), current_user: User = Depends(get_current_user)):
+    return await conditional_list("customers", Customer, get_user_branch_filter(current_user), fields, if_none_match)
 
 @api_router.post("/customers", response_model=Customer)
-async def create_customer(customer_data: CustomerCreate, current_user: User = Depends(get_current_user)):
-    # For non-admin users, use their assigned branch
-    if current_user.role != 'admin':
-        if not current_user.branch_id:
-            raise HTTPException(status_code=400, detail="User must be assigned to a branch")
-        branch_id = current_user.branch_id
-    else:
-        # For admin users, use the first available branch as default
-        branches = await db.branches.find().to_list(1)
-        if not branches:
-            raise HTTPException(status_code=400, detail="No branches available")
-        branch_id = branches[0]["id"]
-    
-    customer = Customer(branch_id=branch_id, **customer_data.dict())
-    await db.customers.insert_one(customer.dict())
+async def create_customer(customer_data: CustomerCreate, current_user: User = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "customers", current_user, customer_data,
+        lambda: _create_customer(customer_data, current_user)
+    )
+
+async def _create_customer(customer_data: CustomerCreate, current_user: User):
+    branch_id = await resolve_branch_id(current_user)
+    
+    async with versioned_write() as version:
+        customer = Customer(branch_id=branch_id, version=version, **customer_data.dict())
+        customer = await upsert_customer(customer)
+    reference_cache.invalidate("customers:")
+    await audit_log.record(current_user, "upsert", "customers", customer.id, branch_id)
     return customer
 
+@api_router.get("/customers/lookup", response_model=Customer)
+@priority("critical")
+async def lookup_customer(phone: str, branch_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    if current_user.role != 'admin' or not branch_id:
+        branch_id = await resolve_branch_id(current_user)
+    phone_normalized = normalize_phone(phone)
+    customer = await db.customers.find_one({"branch_id": branch_id, "phone_normalized": phone_normalized}) if phone_normalized else None
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return Customer(**customer)
+
+@api_router.post("/customers/dedup")
+@priority("best_effort")
+async def dedup_customer_records(dry_run: bool = False, admin_user: User = Depends(require_admin)):
+    summary = await dedup_customers(dry_run=dry_run)
+    if not dry_run:
+        await audit_log.record(admin_user, "merge", "customers", None, None, summary)
+    return summary
+
 # Product management
 @api_router.get("/products", response_model=List[Product])
-async def get_products(current_user: User = Depends(get_current_user)):
-    branch_filter = get_user_branch_filter(current_user)
-    products = await db.products.find(branch_filter).to_list(100)
-    return [Product(**product) for product in products]
+async def get_products(fields: Optional[str] = None, if_none_match: Optional[str] = Header(None), current_user: User = Depends(get_current_user)):
+    return await conditional_list("products", Product, get_user_branch_filter(current_user), fields, if_none_match)
 
-@api_router.post("/products", response_model=Product)
-async def create_product(product_data: ProductCreate, current_user: User = Depends(get_current_user)):
-    # For non-admin users, use their assigned branch
+@api_router.get("/products/search")
+@priority("critical")
+async def search_products(q: str, limit: int = 20, fuzzy: bool = False, branch_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    prefix = normalize_name(q)
+    limit = max(1, min(limit, 100))
+    if not prefix:
+        return []
     if current_user.role != 'admin':
-        if not current_user.branch_id:
-            raise HTTPException(status_code=400, detail="User must be assigned to a branch")
-        branch_id = current_user.branch_id
+        branch_ids = [current_user.branch_id]
     else:
-        # For admin users, use the first available branch as default
-        branches = await db.branches.find().to_list(1)
-        if not branches:
-            raise HTTPException(status_code=400, detail="No branches available")
-        branch_id = branches[0]["id"]
-    
-    product = Product(branch_id=branch_id, **product_data.dict())
-    await db.products.insert_one(product.dict())
+        branch_ids = [branch_id] if branch_id else await get_branch_ids()
+    
+    parts = await fan_out(branch_ids, lambda branch: search_branch_products(branch, prefix, limit, fuzzy, q))
+    if len(parts) == 1:
+        return parts[0]
+    return merge_sorted(parts, "name_normalized", limit=limit)
+
+@api_router.post("/products", response_model=Product)
+async def create_product(product_data: ProductCreate, current_user: User = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "products", current_user, product_data,
+        lambda: _create_product(product_data, current_user)
+    )
+
+async def _create_product(product_data: ProductCreate, current_user: User):
+    branch_id = await resolve_branch_id(current_user)
+    
+    async with versioned_write() as version:
+        product = Product(branch_id=branch_id, version=version, **product_data.dict())
+        await db.products.insert_one(product_document(product))
+    product_search_cache.upsert(branch_id, product_document(product))
+    await audit_log.record(current_user, "create", "products", product.id, branch_id)
+    await record_stock_changes(
+        [stock_change(product.dict(), product.quantity, product_count=1)],
+        [stock_movement(product.dict(), product.quantity, "purchase", product.id)]
+    )
+    publish_event(branch_id, "quantity_changed", {"product_id": product.id, "name": product.name, "quantity": product.quantity})
+    publish_event(branch_id, "totals_changed", {
+        "total_purchase_delta": product.quantity * product.purchase_price,
+        "stock_count_delta": 1
+    })
     return product
 
+# Batch operations
+# collection -> (document model, create payload model)
+BATCH_COLLECTIONS = {
+    "products": (Product, ProductCreate),
+    "customers": (Customer, CustomerCreate),
+    "vendors": (Vendor, VendorCreate),
+}
+
+@api_router.post("/batch")
+async def batch_operations(batch: BatchRequest, current_user: User = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    if len(batch.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {BATCH_MAX_OPERATIONS} operations")
+    return await run_idempotent(
+        idempotency_key, "batch", current_user, batch,
+        lambda: _batch_operations(batch, current_user)
+    )
+
+async def resolve_customer_creates(entries: list, results: list, branch_filter: dict) -> list:
+    # Creating a customer whose phone already exists updates that customer instead
+    creates = [(index, target) for index, kind, target in entries if kind == "create"]
+    if not creates:
+        return entries
+    phones = {normalize_phone(target.phone) for _, target in creates} - {""}
+    cursor = db.customers.find(
+        {"branch_id": creates[0][1].branch_id, "phone_normalized": {"$in": list(phones)}, **branch_filter},
+        {"id": 1, "phone_normalized": 1}
+    )
+    existing = {doc["phone_normalized"]: doc["id"] for doc in await cursor.to_list(len(phones))}
+    
+    resolved = []
+    seen = set()
+    for index, kind, target in entries:
+        if kind != "create":
+            resolved.append((index, kind, target))
+            continue
+        phone = normalize_phone(target.phone)
+        if not phone:
+            # No phone to match on, so this is always a new customer
+            resolved.append((index, kind, target))
+            continue
+        if phone in seen:
+            results[index] = {"index": index, "status": 409, "detail": "Duplicate customer phone in batch"}
+            continue
+        seen.add(phone)
+        if phone in existing:
+            resolved.append((index, "update", (existing[phone], {"name": target.name, "address": target.address, "phone": target.phone})))
+        else:
+            resolved.append((index, kind, target))
+    return resolved
+
+async def _batch_operations(batch: BatchRequest, current_user: User):
+    results: List[Optional[dict]] = [None] * len(batch.operations)
+    # collection -> [(operation index, 'create' or 'update', document or (id, fields))]
+    writes: Dict[str, list] = defaultdict(list)
+    branch_filter = get_user_branch_filter(current_user)
+    branch_id = None
+    changed_branches = set()
+    stock_changes = []
+    movements = []
+    
+    for index, operation in enumerate(batch.operations):
+        if operation.collection not in BATCH_COLLECTIONS:
+            results[index] = {"index": index, "status": 400, "detail": f"Unsupported collection {operation.collection}"}
+            continue
+        model, create_model = BATCH_COLLECTIONS[operation.collection]
+        try:
+            payload = create_model(**operation.data)
+        except ValidationError as e:
+            results[index] = {"index": index, "status": 422, "detail": jsonable_encoder(e.errors())}
+            continue
+        
+        if operation.op == "create":
+            if branch_id is None:
+                branch_id = await resolve_branch_id(current_user)
+            writes[operation.collection].append((index, "create", model(branch_id=branch_id, **payload.dict())))
+        elif operation.op == "update":
+            if not operation.id:
+                results[index] = {"index": index, "status": 400, "detail": "id is required for update"}
+                continue
+            writes[operation.collection].append((index, "update", (operation.id, payload.dict())))
+        else:
+            results[index] = {"index": index, "status": 400, "detail": f"Unsupported op {operation.op}"}
+    
+    for collection_name, entries in writes.items():
+        collection = db[collection_name]
+        
+        if collection_name == "customers":
+            entries = await resolve_customer_creates(entries, results, branch_filter)
+        
+        # Resolve which update targets exist in one query so each update gets its own result
+        update_ids = [target[0] for _, kind, target in entries if kind == "update"]
+        existing: Dict[str, dict] = {}
+        if update_ids:
+            cursor = collection.find({"id": {"$in": update_ids}, **branch_filter}, {"_id": 0})
+            existing = {doc["id"]: doc for doc in await cursor.to_list(len(update_ids))}
+        
+        pending = []
+        for index, kind, target in entries:
+            if kind == "update" and target[0] not in existing:
+                results[index] = {"index": index, "status": 404, "detail": f"{collection_name[:-1].capitalize()} {target[0]} not found"}
+            else:
+                pending.append((index, kind, target))
+        if not pending:
+            continue
+        
+        async with versioned_write(len(pending)) as first_version:
+            requests = []
+            for offset, (index, kind, target) in enumerate(pending):
+                if kind == "create":
+                    target.version = first_version + offset
+                    if collection_name == "products":
+                        requests.append(InsertOne(product_document(target)))
+                    elif collection_name == "customers":
+                        requests.append(InsertOne(customer_document(target)))
+                    else:
+                        requests.append(InsertOne(target.dict()))
+                else:
+                    document_id, fields = target
+                    if collection_name == "products":
+                        fields = {
+                            **fields,
+                            "name_normalized": normalize_name(fields["name"]),
+                            "low_stock": is_low_stock(fields["quantity"], fields["reorder_level"])
+                        }
+                    elif collection_name == "customers":
+                        fields = {**fields, "phone_normalized": normalize_phone(fields["phone"])}
+                    requests.append(UpdateOne(
+                        {"id": document_id, **branch_filter},
+                        {"$set": {**fields, "version": first_version + offset}}
+                    ))
+        
+            failed = {}
+            try:
+                await collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                failed = {error["index"]: error.get("errmsg", "Write failed") for error in e.details.get("writeErrors", [])}
+        
+        for position, (index, kind, target) in enumerate(pending):
+            if position in failed:
+                results[index] = {"index": index, "status": 409, "detail": failed[position]}
+            elif kind == "create":
+                results[index] = {"index": index, "status": 201, "id": target.id, "data": target}
+                await audit_log.record(current_user, "create", collection_name, target.id, target.branch_id, {"batch": True})
+                if collection_name == "products":
+                    product_search_cache.upsert(target.branch_id, product_document(target))
+                    stock_changes.append(stock_change(target.dict(), target.quantity, product_count=1))
+                    movements.append(stock_movement(target.dict(), target.quantity, "purchase", target.id))
+                    publish_event(target.branch_id, "quantity_changed", {"product_id": target.id, "name": target.name, "quantity": target.quantity})
+            else:
+                results[index] = {"index": index, "status": 200, "id": target[0]}
+                await audit_log.record(current_user, "update", collection_name, target[0], None, {"batch": True})
+                if collection_name == "products":
+                    previous = existing[target[0]]
+                    current = {**previous, **target[1]}
+                    product_search_cache.upsert(current["branch_id"], {**current, "name_normalized": normalize_name(current["name"])})
+                    stock_changes.append(stock_change(previous, -previous["quantity"], product_count=-1))
+                    stock_changes.append(stock_change(current, current["quantity"], product_count=1))
+                    if current["quantity"] != previous["quantity"]:
+                        movements.append(stock_movement(current, current["quantity"] - previous["quantity"], "adjustment"))
+                    changed_branches.add(previous["branch_id"])
+    
+    await record_stock_changes(stock_changes, movements)
+    for collection_name in REFERENCE_LISTS.intersection(writes):
+        reference_cache.invalidate(f"{collection_name}:")
+    
+    # Updated products may have a new quantity or price; let dashboards refetch
+    for changed_branch in changed_branches:
+        publish_event(changed_branch, "resync", {"collection": "products"})
+    
+    succeeded = sum(1 for result in results if result["status"] < 400)
+    return {
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    }
+
+# Delta sync
+@api_router.get("/sync")
+@priority("best_effort")
+async def sync_changes(since: int = 0, limit: int = SYNC_PAGE_SIZE, current_user: User = Depends(get_current_user)):
+    limit = max(1, min(limit, SYNC_PAGE_SIZE))
+    branch_filter = get_user_branch_filter(current_user)
+    # Bound the page below any write still in flight; it and later writes are left for the next sync
+    latest_version = await stable_version()
+    version_filter = {"version": {"$gt": since, "$lte": latest_version}, **branch_filter}
+    
+    async def fetch(collection_name: str):
+        cursor = db[collection_name].find(version_filter, {"_id": 0}).sort("version", 1).limit(limit)
+        return await cursor.to_list(limit)
+    
+    names = list(SYNC_COLLECTIONS)
+    *changed, tombstones = await asyncio.gather(*(fetch(name) for name in names), fetch("sync_tombstones"))
+    
+    # A full page may have more behind it; resume from the lowest version any full page reached
+    token = latest_version
+    for documents in (*changed, tombstones):
+        if len(documents) == limit:
+            token = min(token, documents[-1]["version"])
+    
+    deleted: Dict[str, List[str]] = {name: [] for name in names}
+    for tombstone in tombstones:
+        if tombstone["version"] <= token and tombstone["collection"] in deleted:
+            deleted[tombstone["collection"]].append(tombstone["id"])
+    
+    return {
+        "since": since,
+        "token": token,
+        "has_more": token < latest_version,
+        "changes": {
+            name: [SYNC_COLLECTIONS[name](**doc) for doc in documents if doc["version"] <= token]
+            for name, documents in zip(names, changed)
+        },
+        "deleted": deleted
+    }
+
+# Live events stream
+@api_router.get("/events")
+@priority("stream")
+async def stream_events(request: Request, current_user: User = Depends(get_stream_user)):
+    branch_id = None if current_user.role == 'admin' else current_user.branch_id
+    queue = event_broker.subscribe(branch_id)
+    
+    async def event_stream():
+        try:
+            yield f"retry: {SSE_HEARTBEAT_SECONDS * 1000}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": heartbeat\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            event_broker.unsubscribe(branch_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Stock management
 @api_router.get("/stock")
-async def get_stock(current_user: User = Depends(get_current_user)):
+@priority("best_effort")
+async def get_stock(page: int = 1, page_size: int = STOCK_PAGE_SIZE, current_user: User = Depends(get_current_user)):
     branch_filter = get_user_branch_filter(current_user)
+    page = max(1, page)
+    page_size = max(1, min(page_size, STOCK_PAGE_SIZE))
+    item_filter = {**branch_filter, "kind": "item", "product_count": {"$gt": 0}}
     
-    stock_pipeline = [
-        {"$match": branch_filter},
-        {"$group": {
-            "_id": "$name",
-            "total_quantity": {"$sum": "$quantity"},
-            "total_value": {"$sum": {"$multiply": ["$quantity", "$purchase_price"]}},
-            "selling_value": {"$sum": {"$multiply": ["$quantity", "$selling_price"]}}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    
-    stock_data = await db.products.aggregate(stock_pipeline).to_list(1000)
+    if branch_filter:
+        cursor = reporting_db.stock_summary.find(
+            item_filter,
+            {"_id": 0, "name": 1, "total_quantity": 1, "total_value": 1, "selling_value": 1}
+        ).sort("name", 1).skip((page - 1) * page_size).limit(page_size)
+        stock_data = [
+            {
+                "_id": row["name"],
+                "total_quantity": row["total_quantity"],
+                "total_value": row["total_value"],
+                "selling_value": row["selling_value"]
+            }
+            for row in await cursor.to_list(page_size)
+        ]
+        total_items = await reporting_db.stock_summary.count_documents(item_filter)
+    else:
+        # Admins see products merged by name across branches: read each
+        # branch's sorted rows up to the end of the page and merge them
+        fields = ["total_quantity", "total_value", "selling_value"]
+        
+        async def branch_rows(branch_id: str):
+            cursor = reporting_db.stock_summary.find(
+                {**item_filter, "branch_id": branch_id},
+                {"_id": 0, "name": 1, **{field: 1 for field in fields}}
+            ).sort("name", 1).limit(page * page_size)
+            return await cursor.to_list(page * page_size)
+        
+        count_pipeline = [
+            {"$match": item_filter},
+            {"$group": {"_id": "$name"}},
+            {"$count": "total"}
+        ]
+        parts, count_result = await asyncio.gather(
+            fan_out(await get_branch_ids(), branch_rows),
+            reporting_db.stock_summary.aggregate(count_pipeline).to_list(1)
+        )
+        # merge_grouped keeps first-seen order, which is name order after merge_sorted
+        merged = merge_grouped([merge_sorted(parts, "name")], "name", fields)
+        stock_data = [
+            {"_id": row["name"], **{field: row[field] for field in fields}}
+            for row in merged[(page - 1) * page_size:page * page_size]
+        ]
+        total_items = count_result[0]["total"] if count_result else 0
     
-    total_stock_value = sum(item["total_value"] for item in stock_data)
+    totals = await reporting_db.stock_summary.find({**branch_filter, "kind": "branch_total"}).to_list(None)
+    total_stock_value = sum(row["total_value"] for row in totals)
     
     return {
         "stock_items": stock_data,
-        "total_stock_value": total_stock_value
+        "total_stock_value": total_stock_value,
+        "total_items": total_items,
+        "page": page,
+        "page_size": page_size
     }
 
+@api_router.get("/stock/verify")
+@priority("best_effort")
+async def verify_stock(branch_id: Optional[str] = None, admin_user: User = Depends(require_admin)):
+    return await verify_stock_summary(branch_id=branch_id)
+
+@api_router.post("/stock/verify")
+@priority("best_effort")
+async def repair_stock(branch_id: Optional[str] = None, admin_user: User = Depends(require_admin)):
+    # Verifies and rewrites mismatched summary rows from the products collection
+    summary = await verify_stock_summary(repair=True, branch_id=branch_id)
+    await audit_log.record(admin_user, "repair", "stock_summary", None, branch_id, {"mismatches": len(summary["mismatches"])})
+    return summary
+
+@api_router.get("/stock/as-of")
+@priority("best_effort")
+async def get_stock_as_of(date: datetime, branch_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    if current_user.role != 'admin':
+        branch_id = current_user.branch_id
+    branch_ids = [branch_id] if branch_id else await get_branch_ids()
+    return await fan_out(branch_ids, lambda branch: stock_as_of(branch, date))
+
+@api_router.get("/stock/movements")
+@priority("best_effort")
+async def get_stock_movements(product_id: Optional[str] = None, limit: int = 100, current_user: User = Depends(get_current_user)):
+    movement_filter = get_user_branch_filter(current_user)
+    if product_id:
+        movement_filter["product_id"] = product_id
+    movements = await db.stock_movements.find(movement_filter, {"_id": 0}).sort("created_at", -1).to_list(min(limit, 1000))
+    return movements
+
+@api_router.post("/stock/snapshots")
+@priority("best_effort")
+async def create_stock_snapshots(branch_id: Optional[str] = None, admin_user: User = Depends(require_admin)):
+    branch_ids = [branch_id] if branch_id else await get_branch_ids()
+    return await fan_out(branch_ids, take_stock_snapshot)
+
+@api_router.get("/stock/low")
+@priority("best_effort")
+async def get_low_stock(branch_id: Optional[str] = None, limit: int = 100, current_user: User = Depends(get_current_user)):
+    if current_user.role != 'admin':
+        branch_id = current_user.branch_id
+    branch_ids = [branch_id] if branch_id else await get_branch_ids()
+    limit = max(1, min(limit, 1000))
+    
+    async def branch_low_stock(branch: str):
+        # Served by the partial index, which only holds low-stock products
+        return await db.products.find(
+            {"branch_id": branch, "low_stock": True},
+            {"_id": 0, "id": 1, "name": 1, "quantity": 1, "reorder_level": 1, "branch_id": 1}
+        ).sort("quantity", 1).to_list(limit)
+    
+    parts = await fan_out(branch_ids, branch_low_stock)
+    return merge_sorted(parts, "quantity", limit=limit)
+
+@api_router.get("/stock/reorder")
+@priority("best_effort")
+async def get_reorder_suggestions(branch_id: Optional[str] = None, limit: int = 100, current_user: User = Depends(get_current_user)):
+    if current_user.role != 'admin':
+        branch_id = current_user.branch_id
+    branch_ids = [branch_id] if branch_id else await get_branch_ids()
+    limit = max(1, min(limit, 1000))
+    
+    async def branch_reorder(branch: str):
+        return await db.reorder_points.find(
+            {"branch_id": branch, "below_reorder_point": True},
+            {"_id": 0}
+        ).sort("days_of_cover", 1).to_list(limit)
+    
+    parts = await fan_out(branch_ids, branch_reorder)
+    return merge_sorted(parts, "days_of_cover", limit=limit)
+
+@api_router.post("/stock/reorder/run")
+@priority("best_effort")
+async def run_reorder_points(full: bool = False, admin_user: User = Depends(require_admin)):
+    token = await acquire_lease("reorder_points", REORDER_LEASE_SECONDS)
+    if not token:
+        raise HTTPException(status_code=409, detail="A reorder point run is already in progress")
+    async with keep_lease("reorder_points", token, REORDER_LEASE_SECONDS):
+        return await run_reorder_job(full=full)
+
 # Sales management
 @api_router.get("/sales", response_model=List[Sale])
 async def get_sales(current_user: User = Depends(get_current_user)):
-    branch_filter = get_user_branch_filter(current_user)
-    sales = await db.sales.find(branch_filter).sort("created_at", -1).to_list(100)
+    parts = await fan_out(await scope_branch_ids(current_user), lambda branch_id: find_recent_sales(branch_id, 100))
+    sales = merge_sorted(parts, "created_at", reverse=True, limit=100)
     return [Sale(**sale) for sale in sales]
 
+@api_router.post("/sales/archive")
+@priority("best_effort")
+async def run_sales_archive(admin_user: User = Depends(require_admin)):
+    token = await acquire_lease("sales_archive", SALES_ARCHIVE_LEASE_SECONDS)
+    if not token:
+        raise HTTPException(status_code=409, detail="A sales archive run is already in progress")
+    async with keep_lease("sales_archive", token, SALES_ARCHIVE_LEASE_SECONDS):
+        return await archive_sales()
+
 @api_router.post("/sales", response_model=Sale)
-async def create_sale(sale_data: SaleCreate, current_user: User = Depends(get_current_user)):
-    # For non-admin users, use their assigned branch
-    if current_user.role != 'admin':
-        if not current_user.branch_id:
-            raise HTTPException(status_code=400, detail="User must be assigned to a branch")
-        branch_id = current_user.branch_id
-    else:
-        # For admin users, use the first available branch as default
-        branches = await db.branches.find().to_list(1)
-        if not branches:
-            raise HTTPException(status_code=400, detail="No branches available")
-        branch_id = branches[0]["id"]
-    
-    # Calculate total amount and update stock
-    total_amount = 0
+@priority("critical")
+async def create_sale(sale_data: SaleCreate, current_user: User = Depends(get_current_user), idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        idempotency_key, "sales", current_user, sale_data,
+        lambda: _create_sale(sale_data, current_user)
+    )
+
+async def restore_stock(taken: List[tuple]):
+    # Undoes conditional decrements of a sale that did not complete. The
+    # restored products get new versions so sync and list ETags see the change.
+    if taken:
+        async with versioned_write(len(taken)) as first_version:
+            await db.products.bulk_write([
+                UpdateOne({"id": product_id}, {"$inc": {"quantity": quantity}, "$set": {"version": first_version + offset}})
+                for offset, (product_id, quantity) in enumerate(taken)
+            ], ordered=False)
+
+async def _create_sale(sale_data: SaleCreate, current_user: User):
+    branch_id = await resolve_branch_id(current_user)
+    
+    # Validate every item with one read before any stock is taken
+    product_ids = list({item["product_id"] for item in sale_data.items})
+    products = await db.products.find({"id": {"$in": product_ids}, "branch_id": branch_id}, {"_id": 0}).to_list(None)
+    products = {product["id"]: product for product in products}
+    requested: Dict[str, int] = defaultdict(int)
     for item in sale_data.items:
-        product = await db.products.find_one({"id": item["product_id"], "branch_id": branch_id})
+        product = products.get(item["product_id"])
         if not product:
             raise HTTPException(status_code=404, detail=f"Product {item['product_id']} not found")
-        
-        if product["quantity"] < item["quantity"]:
+        requested[product["id"]] += item["quantity"]
+        if product["quantity"] < requested[product["id"]]:
             raise HTTPException(status_code=400, detail=f"Insufficient stock for product {product['name']}")
-        
-        total_amount += item["quantity"] * item["selling_price"]
-        
-        # Update product quantity
-        await db.products.update_one(
-            {"id": item["product_id"]},
-            {"$inc": {"quantity": -item["quantity"]}}
-        )
     
-    # Generate invoice number
-    sales_count = await db.sales.count_documents({"branch_id": branch_id})
-    invoice_number = f"INV-{branch_id[-3:]}-{sales_count + 1:04d}"
+    # One version per touched product plus one for the sale itself
+    async with versioned_write(len(sale_data.items) + 1) as first_version:
+        applied = []
+        try:
+            for offset, item in enumerate(sale_data.items):
+                # Conditional decrement: a concurrent sale may have taken the stock since the check above
+                updated = await repository.decrement_stock(item["product_id"], item["quantity"], {"version": first_version + offset})
+                if updated is None:
+                    raise HTTPException(status_code=400, detail=f"Insufficient stock for product {products[item['product_id']]['name']}")
+                applied.append((item, updated))
+                # Cost at the time of sale, for margin analytics
+                item["purchase_price"] = updated["purchase_price"]
+            
+            # Generate invoice number
+            invoice_number = f"INV-{branch_id[-3:]}-{await next_invoice_sequence(branch_id):04d}"
+            total_amount = sum(item["quantity"] * item["selling_price"] for item in sale_data.items)
+            sale = Sale(
+                customer_id=sale_data.customer_id,
+                items=sale_data.items,
+                total_amount=total_amount,
+                branch_id=branch_id,
+                invoice_number=invoice_number,
+                version=first_version + len(sale_data.items)
+            )
+            await db.sales.insert_one(sale.dict())
+        except BaseException:
+            # Put back what this sale already took, so products, the stock
+            # summary and the ledger agree and a retry starts from scratch
+            await asyncio.shield(restore_stock([(item["product_id"], item["quantity"]) for item, _ in applied]))
+            raise
     
-    sale = Sale(
-        customer_id=sale_data.customer_id,
-        items=sale_data.items,
-        total_amount=total_amount,
-        branch_id=branch_id,
-        invoice_number=invoice_number
-    )
+    purchase_value_sold = 0
+    quantity_events = []
+    stock_changes = []
+    movements = []
+    for item, updated in applied:
+        purchase_value_sold += item["quantity"] * updated["purchase_price"]
+        stock_changes.append(stock_change(updated, -item["quantity"]))
+        movements.append(stock_movement(updated, -item["quantity"], "sale"))
+        quantity_events.append({
+            "product_id": updated["id"],
+            "name": updated["name"],
+            "quantity": updated["quantity"],
+            "delta": -item["quantity"]
+        })
+        low_stock = is_low_stock(updated["quantity"], updated.get("reorder_level"))
+        if low_stock != updated.get("low_stock", False):
+            await db.products.update_one({"id": updated["id"]}, {"$set": {"low_stock": low_stock}})
+        # Alert once, on the sale that takes the product to or below its level
+        if low_stock and updated["quantity"] + item["quantity"] > updated["reorder_level"]:
+            publish_event(branch_id, "low_stock", low_stock_event(updated))
+    
+    await audit_log.record(current_user, "create", "sales", sale.id, branch_id, {"invoice_number": invoice_number, "total_amount": total_amount})
+    for movement in movements:
+        movement["reference_id"] = sale.id
+    await record_stock_changes(stock_changes, movements)
     
-    await db.sales.insert_one(sale.dict())
+    for event in quantity_events:
+        product_search_cache.apply_quantity(branch_id, event["product_id"], event["delta"])
+        publish_event(branch_id, "quantity_changed", event)
+    publish_event(branch_id, "sale_created", {
+        "sale_id": sale.id,
+        "invoice_number": sale.invoice_number,
+        "total_amount": sale.total_amount
+    })
+    publish_event(branch_id, "totals_changed", {
+        "total_sales_delta": total_amount,
+        "total_purchase_delta": -purchase_value_sold
+    })
     return sale
 
-# PDF Invoice generation
-@api_router.get("/sales/{sale_id}/invoice")
-async def generate_invoice(sale_id: str, current_user: User = Depends(get_current_user)):
-    sale = await db.sales.find_one({"id": sale_id})
-    if not sale:
-        raise HTTPException(status_code=404, detail="Sale not found")
-    
-    # Check branch access
-    if current_user.role != 'admin' and sale["branch_id"] != current_user.branch_id:
-        raise HTTPException(status_code=403, detail="Access denied")
+# Margin analytics
+MARGIN_GROUP_NAMES = {"product": "products", "customer": "customers", "branch": "branches"}
+
+@api_router.get("/analytics/margins")
+@priority("best_effort")
+async def get_margin_analytics(
+    group_by: str = "product",
+    sort: str = "margin",
+    top: int = 20,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    branch_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if group_by not in MARGIN_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(MARGIN_GROUPS)}")
+    if sort not in MARGIN_SORTS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(MARGIN_SORTS)}")
+    branch_ids = await scope_branch_ids(current_user)
+    if branch_id:
+        if branch_id not in branch_ids:
+            raise HTTPException(status_code=403, detail="Branch not accessible")
+        branch_ids = [branch_id]
     
-    # Get related data
-    customer = await db.customers.find_one({"id": sale["customer_id"]})
-    company = await db.company.find_one({})
+    report = await asyncio.get_running_loop().run_in_executor(
+        get_analytics_executor(), run_margin_report,
+        branch_ids, start, end, group_by, sort, max(1, min(top, 500)), remaining_ms()
+    )
     
-    # Create PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    story = []
-    styles = getSampleStyleSheet()
+    # Only the top groups need names, so they are looked up here
+    keys = [group["key"] for group in report["groups"]]
+    names = await db[MARGIN_GROUP_NAMES[group_by]].find({"id": {"$in": keys}}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    names = {document["id"]: document["name"] for document in names}
+    for group in report["groups"]:
+        group["name"] = names.get(group["key"])
+    return {"group_by": group_by, "sort": sort, **report}
+
+# Parquet export
+@api_router.get("/exports")
+@priority("best_effort")
+async def get_exports(dataset: Optional[str] = None, branch_id: Optional[str] = None, month: Optional[str] = None, admin_user: User = Depends(require_admin)):
+    if dataset and dataset not in EXPORT_DATASETS:
+        raise HTTPException(status_code=400, detail=f"dataset must be one of {', '.join(EXPORT_DATASETS)}")
+    if branch_id and not EXPORT_PATH_SEGMENT.fullmatch(branch_id):
+        raise HTTPException(status_code=400, detail="Invalid branch_id")
+    if month and not re.fullmatch(r"\d{4}-\d{2}", month):
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    state = await db.export_state.find().to_list(None)
+    files = await asyncio.to_thread(list_export_files, dataset, branch_id, month)
+    return {
+        "running": export_lock.locked(),
+        "datasets": [{"dataset": entry["_id"], "watermark": entry.get("watermark"), "last_run": entry.get("last_run")} for entry in state],
+        "files": files
+    }
+
+@api_router.post("/exports/run", status_code=202)
+async def start_exports(admin_user: User = Depends(require_admin)):
+    global export_task
+    token = None if export_lock.locked() else await acquire_lease("exports", EXPORT_LEASE_SECONDS)
+    if not token:
+        raise HTTPException(status_code=409, detail="An export is already running")
     
-    # Company header
-    if company:
-        title_style = ParagraphStyle('Title', parent=styles['Title'], spaceAfter=20)
-        story.append(Paragraph(f"<b>{company['name']}</b>", title_style))
-        story.append(Paragraph(f"{company['address']}<br/>Phone: {company['phone']}", styles['Normal']))
-        story.append(Spacer(1, 20))
+    async def run():
+        try:
+            async with keep_lease("exports", token, EXPORT_LEASE_SECONDS):
+                await run_exports(force=True)
+        except Exception as e:
+            logger.warning(f"Parquet export run failed: {e}")
     
-    # Invoice details
-    story.append(Paragraph(f"<b>INVOICE #{sale['invoice_number']}</b>", styles['Heading2']))
-    story.append(Paragraph(f"Date: {sale['created_at'].strftime('%Y-%m-%d')}", styles['Normal']))
-    story.append(Spacer(1, 20))
+    # Started in an empty context so the request's deadline does not apply
+    export_task = contextvars.Context().run(asyncio.create_task, run())
+    return {"started": True}
+
+@api_router.get("/exports/{dataset}/{branch_id}/{month}/{file_name}")
+@priority("best_effort")
+async def download_export(dataset: str, branch_id: str, month: str, file_name: str, admin_user: User = Depends(require_admin)):
+    if (dataset not in EXPORT_DATASETS or not EXPORT_PATH_SEGMENT.fullmatch(branch_id)
+            or not re.fullmatch(r"\d{4}-\d{2}", month) or not EXPORT_FILE_PATTERN.fullmatch(file_name)):
+        raise HTTPException(status_code=404, detail="Export file not found")
+    path = EXPORT_DIR / dataset / f"branch_id={branch_id}" / f"month={month}" / file_name
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Export file not found")
+    return FileResponse(path, media_type="application/vnd.apache.parquet", filename=f"{dataset}-{branch_id}-{month}-{file_name}")
+
+# PDF Invoice generation
+# Styles, the items table style and the letterhead depend only on the company,
+# so they are compiled once per company version (id, updated_at) and cached in
+# reference_cache. The letterhead is laid out into plain lines at compile time
+# and drawn on every page by the page callback, so renders only build the
+# invoice-specific flowables. Long item tables split across pages with the
+# column header repeated and a "Page n of m" footer.
+INVOICE_MARGIN = 54
+INVOICE_COLUMN_WIDTHS = (3.0, 1.0, 1.5, 1.5)  # inches
+
+@functools.lru_cache(maxsize=1)
+def invoice_canvas_class():
+    # ReportLab is imported here so it does not slow down worker start-up
+    from reportlab.pdfgen.canvas import Canvas
     
-    # Customer details
-    if customer:
-        story.append(Paragraph("<b>Bill To:</b>", styles['Heading3']))
-        story.append(Paragraph(f"{customer['name']}<br/>{customer['address']}<br/>Phone: {customer['phone']}", styles['Normal']))
-        story.append(Spacer(1, 20))
+    class NumberedCanvas(Canvas):
+        # Pages are buffered until save() so each footer can show the page count
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.page_states = []
+        
+        def showPage(self):
+            self.page_states.append(dict(self.__dict__))
+            self._startPage()
+        
+        def save(self):
+            page_count = len(self.page_states)
+            for state in self.page_states:
+                self.__dict__.update(state)
+                self.setFont("Helvetica", 8)
+                self.drawRightString(self._pagesize[0] - INVOICE_MARGIN, INVOICE_MARGIN / 2, f"Page {self._pageNumber} of {page_count}")
+                Canvas.showPage(self)
+            Canvas.save(self)
     
-    # Items table
-    table_data = [['Product', 'Quantity', 'Price', 'Total']]
-    
-    for item in sale['items']:
-        product = await db.products.find_one({"id": item["product_id"]})
-        product_name = product['name'] if product else 'Unknown Product'
-        table_data.append([
-            product_name,
-            str(item['quantity']),
-            f"₹{item['selling_price']:.2f}",
-            f"₹{item['quantity'] * item['selling_price']:.2f}"
+    return NumberedCanvas
+
+class InvoiceTemplate:
+    def __init__(self, company: Optional[dict]):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.platypus import TableStyle
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        from reportlab.lib.utils import simpleSplit
+        from reportlab.lib import colors
+        
+        self.page_size = A4
+        styles = getSampleStyleSheet()
+        self.heading = styles['Heading2']
+        self.subheading = styles['Heading3']
+        self.normal = styles['Normal']
+        self.cell = ParagraphStyle('InvoiceCell', parent=styles['Normal'], fontSize=10, leading=12)
+        self.column_widths = [width * inch for width in INVOICE_COLUMN_WIDTHS]
+        # Names narrower than this are plain cells; only longer ones pay for a wrapping paragraph
+        self.name_width = self.column_widths[0] - 12
+        self.table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('ALIGN', (0, 1), (0, -1), 'LEFT'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 14),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
         ])
+        
+        # (font, size, text) per letterhead line, wrapped to the frame width
+        width = A4[0] - 2 * INVOICE_MARGIN
+        self.letterhead = []
+        if company:
+            for line in simpleSplit(company['name'], 'Helvetica-Bold', 18, width):
+                self.letterhead.append(('Helvetica-Bold', 18, line))
+            for text in (company['address'], f"Phone: {company['phone']}"):
+                for line in simpleSplit(text, 'Helvetica', 10, width):
+                    self.letterhead.append(('Helvetica', 10, line))
+        self.letterhead_height = sum(size * 1.2 for _, size, _ in self.letterhead)
     
-    table_data.append(['', '', 'Total:', f"₹{sale['total_amount']:.2f}"])
-    
-    table = Table(table_data, colWidths=[3*inch, 1*inch, 1.5*inch, 1.5*inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 14),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
+    def draw_page(self, canvas, doc):
+        canvas.saveState()
+        y = self.page_size[1] - INVOICE_MARGIN
+        for font, size, text in self.letterhead:
+            y -= size * 1.2
+            canvas.setFont(font, size)
+            canvas.drawCentredString(self.page_size[0] / 2, y, text)
+        if self.letterhead:
+            canvas.line(INVOICE_MARGIN, y - 8, self.page_size[0] - INVOICE_MARGIN, y - 8)
+        canvas.setFont('Helvetica', 8)
+        canvas.drawString(INVOICE_MARGIN, INVOICE_MARGIN / 2, f"Invoice #{doc.invoice_number}")
+        canvas.restoreState()
     
-    story.append(table)
-    doc.build(story)
+    def render(self, sale: dict, customer: Optional[dict], product_names: Dict[str, str]) -> bytes:
+        from reportlab.platypus import SimpleDocTemplate, Table, Paragraph, Spacer
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        from xml.sax.saxutils import escape
+        
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(
+            buffer, pagesize=self.page_size,
+            leftMargin=INVOICE_MARGIN, rightMargin=INVOICE_MARGIN, bottomMargin=INVOICE_MARGIN,
+            topMargin=INVOICE_MARGIN + self.letterhead_height + (20 if self.letterhead else 0)
+        )
+        doc.invoice_number = sale['invoice_number']
+        story = []
+        
+        # Invoice details
+        story.append(Paragraph(f"<b>INVOICE #{escape(str(sale['invoice_number']))}</b>", self.heading))
+        story.append(Paragraph(f"Date: {sale['created_at'].strftime('%Y-%m-%d')}", self.normal))
+        story.append(Spacer(1, 20))
+        
+        # Customer details
+        if customer:
+            story.append(Paragraph("<b>Bill To:</b>", self.subheading))
+            story.append(Paragraph(
+                f"{escape(customer['name'])}<br/>{escape(customer['address'])}<br/>Phone: {escape(customer['phone'])}",
+                self.normal
+            ))
+            story.append(Spacer(1, 20))
+        
+        # Items table; long product names become paragraphs so they wrap instead of overflowing
+        table_data = [['Product', 'Quantity', 'Price', 'Total']]
+        for item in sale['items']:
+            name = product_names.get(item['product_id'], 'Unknown Product')
+            if stringWidth(name, self.cell.fontName, self.cell.fontSize) > self.name_width:
+                name = Paragraph(escape(name), self.cell)
+            table_data.append([
+                name,
+                str(item['quantity']),
+                f"₹{item['selling_price']:.2f}",
+                f"₹{item['quantity'] * item['selling_price']:.2f}"
+            ])
+        table_data.append(['', '', 'Total:', f"₹{sale['total_amount']:.2f}"])
+        
+        table = Table(table_data, colWidths=self.column_widths, repeatRows=1)
+        table.setStyle(self.table_style)
+        story.append(table)
+        doc.build(story, onFirstPage=self.draw_page, onLaterPages=self.draw_page, canvasmaker=invoice_canvas_class())
+        return buffer.getvalue()
+
+async def get_invoice_template(company: Optional[dict]) -> InvoiceTemplate:
+    key = f"invoice:{company['id']}:{company['updated_at'].isoformat()}" if company else "invoice:none"
+    return await reference_cache.get(key, lambda: asyncio.to_thread(InvoiceTemplate, company))
+
+@api_router.get("/sales/{sale_id}/invoice")
+@priority("best_effort")
+async def generate_invoice(sale_id: str, current_user: User = Depends(get_current_user)):
+    sale = await find_sale(sale_id)
+    if not sale:
+        raise HTTPException(status_code=404, detail="Sale not found")
     
-    buffer.seek(0)
+    # Check branch access
+    if current_user.role != 'admin' and sale["branch_id"] != current_user.branch_id:
+        raise HTTPException(status_code=403, detail="Access denied")
     
-    # Save to file system temporarily
-    invoice_path = f"/tmp/invoice_{sale_id}.pdf"
-    with open(invoice_path, "wb") as f:
-        f.write(buffer.getvalue())
+    # Get related data
+    product_ids = list({item["product_id"] for item in sale["items"]})
+    customer, products = await asyncio.gather(
+        db.customers.find_one({"id": sale["customer_id"]}),
+        db.products.find({"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    )
+    template = await get_invoice_template(await cached_company())
     
-    return FileResponse(
-        invoice_path,
+    # Rendering is CPU-bound; keep it off the event loop
+    pdf = await asyncio.to_thread(template.render, sale, customer, {product["id"]: product["name"] for product in products})
+    return Response(
+        pdf,
         media_type="application/pdf",
-        filename=f"invoice_{sale['invoice_number']}.pdf"
+        headers={"Content-Disposition": f'attachment; filename="invoice_{sale["invoice_number"]}.pdf"'}
     )
 
+# Metrics
+@api_router.get("/metrics/pool")
+async def get_pool_metrics(admin_user: User = Depends(require_admin)):
+    return pool_metrics.snapshot()
+
+@api_router.get("/audit")
+@priority("best_effort")
+async def get_audit_log(month: Optional[str] = None, entity: Optional[str] = None, entity_id: Optional[str] = None, limit: int = 100, admin_user: User = Depends(require_admin)):
+    # month is YYYY-MM and selects the partition; defaults to the current month
+    partition = (month or f"{datetime.utcnow():%Y-%m}").replace('-', '')
+    if not re.fullmatch(r"\d{6}", partition):
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    audit_filter = {}
+    if entity:
+        audit_filter["entity"] = entity
+    if entity_id:
+        audit_filter["entity_id"] = entity_id
+    cursor = db[f"audit_log_{partition}"].find(audit_filter, {"_id": 0}).sort("created_at", -1).limit(min(limit, 1000))
+    return await cursor.to_list(min(limit, 1000))
+
+@api_router.get("/metrics/audit")
+async def get_audit_metrics(admin_user: User = Depends(require_admin)):
+    return audit_log.snapshot()
+
+@api_router.get("/metrics/cache")
+async def get_cache_metrics(admin_user: User = Depends(require_admin)):
+    return reference_cache.snapshot()
+
+@api_router.get("/metrics/admission")
+async def get_admission_metrics(admin_user: User = Depends(require_admin)):
+    return admission.snapshot()
+
 # Include router
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(admit_request)])
+
+@app.exception_handler(ExecutionTimeout)
+async def execution_timeout_handler(request: Request, exc: ExecutionTimeout):
+    return deadline_exceeded_response()
+
+app.add_middleware(DeadlineMiddleware)
+# Wraps DeadlineMiddleware so timeouts are logged with the request ID
+app.add_middleware(RequestIdMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -621,20 +4185,51 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "ETag"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
 @app.on_event("startup")
 async def startup_event():
-    await init_default_data()
-    logger.info("Default data initialized")
+    await create_indexes()
+    if SHARD_BY_BRANCH:
+        await shard_collections()
+    # Seeding and backfills only need one worker; the others skip them
+    token = await acquire_lease("startup", STARTUP_LEASE_SECONDS)
+    if token:
+        async with keep_lease("startup", token, STARTUP_LEASE_SECONDS):
+            await init_default_data()
+            await backfill_sync_versions()
+            await backfill_stock_summary()
+            await backfill_opening_movements()
+            await backfill_name_normalized()
+            await backfill_phone_normalized()
+            await create_customer_phone_index()
+            logger.info("Default data initialized")
+    else:
+        logger.info("Another worker is initializing default data, skipping")
+    await warm_reference_cache()
+    await start_event_source()
+    audit_log.start()
+    global snapshot_task, loop_lag_task, export_scheduler_task, reorder_task, sales_archive_task
+    snapshot_task = asyncio.create_task(run_snapshot_scheduler())
+    loop_lag_task = asyncio.create_task(admission.monitor_loop_lag())
+    export_scheduler_task = asyncio.create_task(run_export_scheduler())
+    reorder_task = asyncio.create_task(run_reorder_scheduler())
+    sales_archive_task = asyncio.create_task(run_sales_archive_scheduler())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    event_broker.close()
+    await audit_log.stop()
+    if change_stream_task:
+        change_stream_task.cancel()
+    if snapshot_task:
+        snapshot_task.cancel()
+    if loop_lag_task:
+        loop_lag_task.cancel()
+    for task in (export_scheduler_task, export_task, reorder_task, sales_archive_task):
+        if task:
+            task.cancel()
+    if analytics_executor:
+        analytics_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
@@ -0,0 +1,96 @@
+"""Invoice rendering benchmark.
+
+Renders synthetic 1, 50 and 500 line invoices with a precompiled
+InvoiceTemplate and reports renders per second per core. --cold also
+compiles the template for every render, which is what each request paid
+before templates were cached. With --processes N the renders run in N
+processes at once and the per-core figure is the total divided by N.
+
+    python benchmarks/invoice_benchmark.py
+    python benchmarks/invoice_benchmark.py --lines 500 --cold --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+COMPANY = {
+    "id": "company-1",
+    "name": "ABC Pvt Ltd",
+    "address": "12 Market Road, Bengaluru 560001",
+    "phone": "+91 80 1234 5678",
+    "updated_at": datetime(2024, 1, 1),
+}
+CUSTOMER = {"name": "Walk-in Customer", "address": "1 Main Street", "phone": "9876543210"}
+
+
+def import_server():
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    import server
+    return server
+
+
+def make_sale(lines: int):
+    items = [
+        {"product_id": f"product-{index}", "quantity": 1 + index % 5, "selling_price": 10.0 + index % 90}
+        for index in range(lines)
+    ]
+    names = {item["product_id"]: f"Product {index:04d} {'with a long descriptive name ' * (index % 3)}" for index, item in enumerate(items)}
+    sale = {
+        "id": str(uuid.uuid4()),
+        "invoice_number": "INV-BEN-0001",
+        "created_at": datetime(2024, 1, 1),
+        "items": items,
+        "total_amount": sum(item["quantity"] * item["selling_price"] for item in items),
+    }
+    return sale, names
+
+
+def measure(args):
+    lines, duration, cold = args
+    server = import_server()
+    sale, names = make_sale(lines)
+    template = server.InvoiceTemplate(COMPANY)
+    pdf = template.render(sale, CUSTOMER, names)  # warm-up, also imports ReportLab
+    pages = len(re.findall(rb"/Type /Page\b", pdf))
+
+    renders = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        if cold:
+            template = server.InvoiceTemplate(COMPANY)
+        template.render(sale, CUSTOMER, names)
+        renders += 1
+    return renders, time.perf_counter() - started, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, action="append", help="items per invoice, may be repeated (default: 1, 50, 500)")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per measurement")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--cold", action="store_true", help="also measure with the template compiled per render")
+    args = parser.parse_args()
+
+    modes = [False, True] if args.cold else [False]
+    context = multiprocessing.get_context("spawn")
+    print(f"{'lines':>6} {'template':>9} {'pages':>6} {'renders/s':>10} {'per core':>10} {'ms/render':>10}")
+    with context.Pool(args.processes) as pool:
+        for lines in args.lines or [1, 50, 500]:
+            for cold in modes:
+                results = pool.map(measure, [(lines, args.duration, cold)] * args.processes)
+                total = sum(renders / elapsed for renders, elapsed, _ in results)
+                per_core = total / args.processes
+                print(f"{lines:>6} {'cold' if cold else 'cached':>9} {results[0][2]:>6} {total:>10.1f} {per_core:>10.1f} {1000 / per_core:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
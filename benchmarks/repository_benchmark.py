@@ -0,0 +1,120 @@
+"""Benchmarks for the storage repositories.
+
+Runs the same timings against every backend named with --backend: SQLite
+(a temporary WAL database) and Mongo (the database in MONGO_URL, which is
+dropped afterwards). The behaviour the timings assume is checked by
+tests/test_repository.py.
+
+    python benchmarks/repository_benchmark.py --backend sqlite
+    python benchmarks/repository_benchmark.py --backend sqlite --backend mongo --products 50000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+def make_products(count: int, branches: int, started: datetime):
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "name": f"Product {index:06d}",
+            "branch_id": f"branch-{index % branches}",
+            "vendor_id": "vendor-1",
+            "quantity": index % 50,
+            "purchase_price": 10.0 + index % 7,
+            "selling_price": 15.0 + index % 7,
+            "low_stock": index % 50 < 5,
+            "created_at": started + timedelta(seconds=index),
+        }
+        for index in range(count)
+    ]
+
+
+async def timed(label: str, operations: int, coroutine_factory, concurrency: int = 1):
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index):
+        async with semaphore:
+            await coroutine_factory(index)
+
+    await asyncio.gather(*(run(index) for index in range(operations)))
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<28} {operations:>7} ops  {elapsed * 1000:9.1f} ms  {operations / elapsed:10.0f} ops/s")
+
+
+async def run_benchmark(repository, product_count: int, branches: int, operations: int, concurrency: int):
+    products = make_products(product_count, branches, datetime(2024, 1, 1))
+    await repository.ensure_index("products", ["id"])
+    await repository.ensure_index("products", ["branch_id", "name"])
+
+    started = time.perf_counter()
+    for start in range(0, len(products), 1000):
+        await repository.insert_many("products", products[start:start + 1000])
+    elapsed = time.perf_counter() - started
+    print(f"  {'insert_many (1000/batch)':<28} {product_count:>7} docs {elapsed * 1000:9.1f} ms  {product_count / elapsed:10.0f} docs/s")
+
+    await timed("find_one by id", operations, lambda i: repository.find_one("products", {"id": products[i % product_count]["id"]}), concurrency)
+    await timed("list_page (50 rows)", operations // 10, lambda i: repository.list_page("products", {"branch_id": f"branch-{i % branches}"}, "name", 1 + i % 5, 50), concurrency)
+    await timed("summarize by branch", max(1, operations // 100), lambda i: repository.summarize("products", {}, "branch_id", {"value": ["quantity", "purchase_price"]}), concurrency)
+    await timed("decrement_stock", operations, lambda i: repository.decrement_stock(products[i % product_count]["id"], 1), concurrency)
+    await timed("next_sequence", operations, lambda i: repository.next_sequence("benchmark_seq"), concurrency)
+
+
+async def open_backend(name: str):
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    import server
+
+    if name == "sqlite":
+        directory = tempfile.TemporaryDirectory()
+        repository = await server.SQLiteRepository(os.path.join(directory.name, "benchmark.db")).open()
+
+        async def cleanup():
+            await repository.close()
+            directory.cleanup()
+        return repository, cleanup
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    database_name = f"repository_benchmark_{uuid.uuid4().hex[:8]}"
+    repository = server.MongoRepository(client[database_name])
+
+    async def cleanup():
+        await client.drop_database(database_name)
+        client.close()
+    return repository, cleanup
+
+
+async def main_async(args):
+    for backend in args.backend:
+        print(f"[{backend}]")
+        repository, cleanup = await open_backend(backend)
+        try:
+            await run_benchmark(repository, args.products, args.branches, args.operations, args.concurrency)
+        finally:
+            await cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", action="append", choices=["sqlite", "mongo"], help="may be repeated (default: sqlite)")
+    parser.add_argument("--products", type=int, default=10000, help="documents loaded for the benchmark")
+    parser.add_argument("--branches", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+    args.backend = args.backend or ["sqlite"]
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
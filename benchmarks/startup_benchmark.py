@@ -0,0 +1,84 @@
+"""Import-time and startup benchmark for the backend.
+
+Measures how long `import server` takes in a fresh interpreter (what every
+uvicorn/gunicorn worker pays on spawn) and, with --startup, how long
+startup_event takes against the database in MONGO_URL.
+
+    python benchmarks/startup_benchmark.py --runs 10
+    python benchmarks/startup_benchmark.py --startup --max-import-ms 800
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+def measure_import(top: int):
+    env = {**os.environ, "MONGO_URL": os.environ.get("MONGO_URL", "mongodb://localhost:27017")}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    # Lines look like: "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    total = next(cumulative for cumulative, name in rows if name.strip() == "server")
+    # Direct imports of server are indented by exactly three spaces
+    direct = sorted(
+        ((cumulative, name.strip()) for cumulative, name in rows if name.startswith("   ") and not name.startswith("    ")),
+        reverse=True
+    )
+    return total / 1000, direct[:top]
+
+
+async def measure_startup():
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    started = time.perf_counter()
+    await server.startup_event()
+    elapsed = (time.perf_counter() - started) * 1000
+    await server.shutdown_db_client()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest direct imports to list")
+    parser.add_argument("--startup", action="store_true", help="also time startup_event (needs MongoDB)")
+    parser.add_argument("--max-import-ms", type=float, help="exit with status 1 if the median import is slower")
+    args = parser.parse_args()
+
+    timings = []
+    slowest = []
+    for _ in range(args.runs):
+        total_ms, slowest = measure_import(args.top)
+        timings.append(total_ms)
+
+    median = statistics.median(timings)
+    print(f"import server: median {median:.1f} ms, min {min(timings):.1f} ms, max {max(timings):.1f} ms over {args.runs} runs")
+    print("slowest direct imports (last run):")
+    for cumulative, name in slowest:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    if args.startup:
+        print(f"startup_event: {asyncio.run(measure_startup()):.1f} ms")
+
+    if args.max_import_ms is not None and median > args.max_import_ms:
+        print(f"median import time {median:.1f} ms exceeds budget of {args.max_import_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
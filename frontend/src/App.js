@@ -861,7 +861,7 @@ const Stock = () => {
         <h3 className="text-lg font-semibold mb-4">Stock Summary</h3>
         <div className="grid grid-cols-1 md:grid-cols-3 gap-4">
           <div className="text-center">
-            <p className="text-3xl font-bold text-blue-600">{stockData?.stock_items?.length || 0}</p>
+            <p className="text-3xl font-bold text-blue-600">{stockData?.total_items ?? stockData?.stock_items?.length ?? 0}</p>
             <p className="text-gray-600">Product Types</p>
           </div>
           <div className="text-center">
@@ -0,0 +1,155 @@
+"""Shared fixtures for the backend tests.
+
+The app runs against the MongoDB in MONGO_URL when it is set in the
+environment (each session uses its own database, dropped afterwards) and
+against mongomock-motor otherwise. The database is shared by the tests of a
+session, so tests create their own uniquely named data instead of assuming
+empty collections.
+"""
+import functools
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+USE_MONGO = bool(os.environ.get("MONGO_URL"))
+
+os.environ["DB_NAME"] = f"test_{uuid.uuid4().hex[:12]}"
+os.environ.setdefault("EXPORT_DIR", tempfile.mkdtemp(prefix="exports-"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, str(BACKEND_DIR))
+
+
+def patch_mongomock():
+    # mongomock-motor stands in for Motor; these are gaps in mongomock itself
+    import mongomock
+    import motor.motor_asyncio
+    from pymongo.errors import DuplicateKeyError
+    from mongomock_motor import AsyncMongoMockClient
+
+    motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: AsyncMongoMockClient()
+
+    # The comment option is not supported
+    for name in ["insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+                 "find_one_and_update", "bulk_write", "count_documents", "distinct", "aggregate", "find", "find_one"]:
+        method = getattr(mongomock.collection.Collection, name)
+
+        @functools.wraps(method)
+        def without_comment(self, *args, __method=method, **kwargs):
+            kwargs.pop("comment", None)
+            return __method(self, *args, **kwargs)
+        setattr(mongomock.collection.Collection, name, without_comment)
+
+    # Collection options (storageEngine, ...) are not supported
+    create_collection = mongomock.database.Database.create_collection
+    mongomock.database.Database.create_collection = lambda self, name, **kwargs: create_collection(self, name)
+
+    # A new unique index checks every document, ignoring partialFilterExpression
+    create_index = mongomock.collection.Collection.create_index
+
+    def create_partial_index(self, key_or_list, cache_for=300, session=None, **kwargs):
+        partial = kwargs.get("partialFilterExpression")
+        if not (partial and kwargs.get("unique")):
+            return create_index(self, key_or_list, cache_for, session, **kwargs)
+        keys = [key for key, _ in mongomock.helpers.create_index_list(key_or_list)]
+        seen = set()
+        for document in self.find(partial):
+            values = tuple(document.get(key) for key in keys)
+            if values in seen:
+                raise DuplicateKeyError("E11000 Duplicate Key Error", 11000)
+            seen.add(values)
+        name = kwargs.get("name") or mongomock.helpers.gen_index_name(mongomock.helpers.create_index_list(key_or_list))
+        if name not in self._store.indexes:
+            name = create_index(self, key_or_list, cache_for, session, **{**kwargs, "unique": False})
+            self._store.indexes[name]["unique"] = True
+        return name
+    mongomock.collection.Collection.create_index = create_partial_index
+
+    # $group over no documents yields a row when _id is null; MongoDB yields none
+    import mongomock.aggregate
+    group_stage = mongomock.aggregate._PIPELINE_HANDLERS["$group"]
+
+    def group_nothing(in_collection, database, options):
+        in_collection = list(in_collection)
+        return group_stage(in_collection, database, options) if in_collection else []
+    mongomock.aggregate._PIPELINE_HANDLERS["$group"] = group_nothing
+
+    # ReturnDocument.AFTER re-runs the original filter, which misses documents the update moved out of it
+    find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+    def find_one_and_update_after(self, filter, update, projection=None, return_document=False, upsert=False, **kwargs):
+        if not return_document:
+            return find_one_and_update(self, filter, update, projection=projection, upsert=upsert, **kwargs)
+        before = find_one_and_update(self, filter, update, upsert=upsert, **kwargs)
+        if before is None:
+            return self.find_one(filter, projection) if upsert else None
+        return self.find_one({"_id": before["_id"]}, projection)
+    mongomock.collection.Collection.find_one_and_update = find_one_and_update_after
+
+
+@pytest.fixture(scope="session")
+def server():
+    if not USE_MONGO:
+        pytest.importorskip("mongomock_motor")
+        os.environ["MONGO_URL"] = "mongodb://localhost:27017"
+        patch_mongomock()
+    import server
+    return server
+
+
+@pytest.fixture(scope="session")
+def app_client(server):
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app) as client:
+        response = client.post("/api/login", json={"username": "admin", "password": "admin123"})
+        client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        yield client
+        if USE_MONGO:
+            client.portal.call(server.client.drop_database, server.db.name)
+
+
+@pytest.fixture
+def client(app_client, server):
+    server.reference_cache.invalidate("")
+    return app_client
+
+
+@pytest.fixture
+def call(app_client):
+    """Runs a coroutine function on the app's event loop."""
+    def run(function, *args, **kwargs):
+        return app_client.portal.call(functools.partial(function, *args, **kwargs))
+    return run
+
+
+def unique(prefix: str) -> str:
+    return f"{prefix} {uuid.uuid4().hex[:8]}"
+
+
+@pytest.fixture
+def vendor(client):
+    return client.post("/api/vendors", json={"name": unique("Vendor"), "address": "1 Road", "phone": "100"}).json()
+
+
+@pytest.fixture
+def make_product(client, vendor):
+    def make(quantity: int = 10, purchase_price: float = 10.0, selling_price: float = 15.0, **fields):
+        payload = {
+            "name": unique("Product"), "vendor_id": vendor["id"], "quantity": quantity,
+            "purchase_price": purchase_price, "selling_price": selling_price, **fields
+        }
+        response = client.post("/api/products", json=payload)
+        assert response.status_code == 200, response.text
+        return response.json()
+    return make
+
+
+@pytest.fixture
+def customer(client):
+    phone = f"98{uuid.uuid4().int % 10**8:08d}"
+    return client.post("/api/customers", json={"name": unique("Customer"), "address": "2 Road", "phone": phone}).json()
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+def test_requests_beyond_limit_and_queue_get_429(server):
+    admission = server.AdmissionController({"normal": (1, 1, False)})
+    release = asyncio.Event()
+
+    async def hold():
+        async with admission.admit("normal"):
+            await release.wait()
+
+    async def scenario():
+        running = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as raised:
+            async with admission.admit("normal"):
+                pass
+        snapshot = admission.snapshot()["classes"]["normal"]
+        release.set()
+        await asyncio.gather(running, queued)
+        return raised.value, snapshot, admission.snapshot()["classes"]["normal"]
+
+    rejected, during, after = asyncio.run(scenario())
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == str(server.SHED_RETRY_AFTER_SECONDS)
+    assert during["in_flight"] == 1 and during["waiting"] == 1 and during["rejected_queue_full"] == 1
+    assert after["admitted"] == 2 and after["in_flight"] == 0
+
+
+def test_best_effort_routes_are_shed_under_pressure(client, server, monkeypatch):
+    monkeypatch.setattr(server.admission, "under_pressure", lambda: True)
+    shed_before = server.admission.classes["best_effort"].shed
+
+    response = client.get("/api/audit")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(server.SHED_RETRY_AFTER_SECONDS)
+    assert server.admission.classes["best_effort"].shed == shed_before + 1
+    # Normal and critical classes keep being served
+    assert client.get("/api/company").status_code == 200
+    assert client.get("/api/products/search", params={"q": "a"}).status_code == 200
+
+
+def test_unknown_priority_class_is_rejected_at_import(server):
+    with pytest.raises(ValueError):
+        server.priority("urgent")
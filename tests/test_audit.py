@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+
+from tests.conftest import unique
+
+
+def make_writer(server, queue_size=2000, batch_size=500, enqueue_timeout=0.01):
+    writer = server.AuditWriter(queue_size, batch_size, flush_interval=0.01, enqueue_timeout=enqueue_timeout)
+    flushed = []
+
+    async def flush(batch):
+        assert len(batch) <= batch_size
+        flushed.append(list(batch))
+    writer._flush = flush
+    return writer, flushed
+
+
+def test_every_queued_event_is_flushed_once(server):
+    writer, flushed = make_writer(server)
+
+    async def scenario():
+        for index in range(1200):
+            await writer.record(None, "create", "products", str(index))
+        writer.start()
+        while writer.queue.qsize():
+            await asyncio.sleep(0.01)
+        await writer.stop()
+
+    asyncio.run(scenario())
+    ids = [event["entity_id"] for batch in flushed for event in batch]
+    assert sorted(ids, key=int) == [str(index) for index in range(1200)]
+    assert writer.dropped == 0
+
+
+def test_stop_flushes_what_is_still_queued(server):
+    writer, flushed = make_writer(server, batch_size=100)
+
+    async def scenario():
+        for index in range(250):
+            await writer.record(None, "update", "vendors", str(index))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert [len(batch) for batch in flushed] == [100, 100, 50]
+
+
+def test_full_queue_drops_and_counts(server):
+    writer, _ = make_writer(server, queue_size=10)
+
+    async def scenario():
+        for index in range(15):
+            await writer.record(None, "create", "sales", str(index))
+
+    asyncio.run(scenario())
+    assert writer.queue.qsize() == 10
+    assert writer.dropped == 5
+
+
+def test_audit_events_are_written_and_queryable(client, server, call, vendor):
+    call(server.audit_log.stop)
+    server.audit_log.task = None
+    try:
+        events = client.get("/api/audit", params={"entity": "vendors", "entity_id": vendor["id"]}).json()
+    finally:
+        call(server.audit_log.start)
+    assert [event["action"] for event in events] == ["create"]
+    assert events[0]["actor"] == "admin"
+
+
+def test_cancelled_insert_is_not_written_twice(server, call, monkeypatch):
+    writer = server.AuditWriter(100, 10, flush_interval=0.01, enqueue_timeout=0.01)
+    entity_id = unique("audit")
+    collection_class = type(server.db.products._collection)
+    insert_many = collection_class.insert_many
+    stored = []
+
+    async def insert_then_stall(self, *args, **kwargs):
+        # The first insert lands, then the writer is cancelled before it returns
+        result = await insert_many(self, *args, **kwargs)
+        if not stored:
+            stored.append(1)
+            await asyncio.sleep(10)
+        return result
+
+    monkeypatch.setattr(collection_class, "insert_many", insert_then_stall)
+
+    async def scenario():
+        for _ in range(3):
+            await writer.record(None, "create", "audit-test", entity_id)
+        writer.start()
+        while not stored:
+            await asyncio.sleep(0.01)
+        await writer.stop()
+        partition = f"audit_log_{datetime.utcnow():%Y%m}"
+        return await server.db[partition].count_documents({"entity_id": entity_id})
+
+    assert call(scenario) == 3
+    assert writer.written == 3
+    assert writer.failed == 0
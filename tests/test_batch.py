@@ -0,0 +1,45 @@
+from tests.conftest import unique
+
+
+def product_data(vendor, **fields):
+    return {"name": unique("Product"), "vendor_id": vendor["id"], "quantity": 5, "purchase_price": 1, "selling_price": 2, **fields}
+
+
+def test_each_operation_gets_its_own_result(client, vendor):
+    operations = [
+        {"op": "create", "collection": "products", "data": product_data(vendor)},
+        {"op": "update", "collection": "vendors", "id": vendor["id"], "data": {"name": "Renamed", "address": "b", "phone": "2"}},
+        {"op": "update", "collection": "vendors", "id": "missing", "data": {"name": "x", "address": "b", "phone": "2"}},
+        {"op": "create", "collection": "customers", "data": {"name": "no phone"}},
+        {"op": "create", "collection": "sales", "data": {}},
+        {"op": "update", "collection": "vendors", "data": {"name": "x", "address": "b", "phone": "2"}},
+        {"op": "delete", "collection": "vendors", "id": vendor["id"], "data": {"name": "x", "address": "b", "phone": "2"}},
+    ]
+    response = client.post("/api/batch", json={"operations": operations})
+    assert response.status_code == 200
+    body = response.json()
+
+    assert [result["status"] for result in body["results"]] == [201, 200, 404, 422, 400, 400, 400]
+    assert [result["index"] for result in body["results"]] == list(range(len(operations)))
+    assert body["succeeded"] == 2 and body["failed"] == 5
+
+    created = body["results"][0]
+    products = {product["id"]: product for product in client.get("/api/products").json()}
+    assert products[created["id"]]["name"] == operations[0]["data"]["name"]
+    vendors = {row["id"]: row for row in client.get("/api/vendors").json()}
+    assert vendors[vendor["id"]]["name"] == "Renamed"
+
+
+def test_customer_create_with_existing_phone_updates_it(client, customer):
+    operations = [
+        {"op": "create", "collection": "customers", "data": {"name": "Same phone", "address": "x", "phone": customer["phone"]}},
+        {"op": "create", "collection": "customers", "data": {"name": "Duplicate in batch", "address": "x", "phone": customer["phone"]}},
+    ]
+    results = client.post("/api/batch", json={"operations": operations}).json()["results"]
+    assert [result["status"] for result in results] == [200, 409]
+    assert results[0]["id"] == customer["id"]
+
+
+def test_batch_size_is_limited(client, server, vendor):
+    operations = [{"op": "create", "collection": "products", "data": product_data(vendor)}] * (server.BATCH_MAX_OPERATIONS + 1)
+    assert client.post("/api/batch", json={"operations": operations}).status_code == 400
@@ -0,0 +1,69 @@
+import uuid
+from datetime import datetime, timedelta
+
+from tests.conftest import unique
+
+
+def local_phone():
+    return f"98{uuid.uuid4().int % 10**8:08d}"
+
+
+def create(client, name, phone):
+    response = client.post("/api/customers", json={"name": name, "address": "1 Road", "phone": phone})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_same_phone_in_another_format_updates_the_customer(client):
+    phone = local_phone()
+    first = create(client, unique("Asha"), phone)
+    second = create(client, unique("Asha K"), f"+91 {phone[:5]}-{phone[5:]}")
+    assert second["id"] == first["id"]
+    found = client.get("/api/customers/lookup", params={"phone": f"0{phone}"}).json()
+    assert found["id"] == first["id"] and found["name"] == second["name"]
+
+
+def test_customers_without_a_phone_are_never_merged(client, server, call):
+    alice = create(client, unique("Walk-in Alice"), "")
+    bob = create(client, unique("Walk-in Bob"), "n/a")
+    assert alice["id"] != bob["id"]
+    assert call(server.db.customers.find_one, {"id": alice["id"]})["name"] == alice["name"]
+    assert client.get("/api/customers/lookup", params={"phone": "n/a"}).status_code == 404
+
+
+def test_batch_creates_without_a_phone_are_all_inserted(client):
+    operations = [{"op": "create", "collection": "customers", "data": {"name": unique("Walk-in"), "address": "x", "phone": ""}}
+                  for _ in range(2)]
+    results = client.post("/api/batch", json={"operations": operations}).json()["results"]
+    assert [result["status"] for result in results] == [201, 201]
+    assert results[0]["id"] != results[1]["id"]
+
+
+def test_dedup_merges_duplicates_and_builds_the_index(server, call, customer):
+    phone = local_phone()
+    branch_id = customer["branch_id"]
+    now = datetime.utcnow()
+
+    def record(name, phone, age):
+        return {"id": str(uuid.uuid4()), "name": unique(name), "address": "x", "phone": phone, "branch_id": branch_id,
+                "phone_normalized": server.normalize_phone(phone), "created_at": now - timedelta(days=age), "version": 0}
+
+    oldest, newer = record("Old", phone, 2), record("New", f"+91{phone}", 1)
+    blanks = [record("Walk-in", "", 1), record("Walk-in", "-", 1)]
+    sale = server.Sale(customer_id=newer["id"], items=[], total_amount=0, branch_id=branch_id, invoice_number=unique("INV")).dict()
+
+    async def scenario():
+        await server.db.customers.drop_index(server.CUSTOMER_PHONE_INDEX)
+        await server.db.customers.insert_many([oldest, newer, *blanks])
+        await server.db.sales.insert_one(sale)
+        summary = await server.dedup_customers()
+        ids = {row["id"] for row in await server.db.customers.find({"branch_id": branch_id}, {"id": 1}).to_list(None)}
+        moved = await server.db.sales.find_one({"id": sale["id"]})
+        return summary, ids, moved, await server.db.customers.index_information()
+
+    summary, ids, moved, indexes = call(scenario)
+    assert summary["merged"] >= 1 and summary["unique_index"] is True
+    assert oldest["id"] in ids and newer["id"] not in ids
+    assert {blank["id"] for blank in blanks} <= ids
+    assert moved["customer_id"] == oldest["id"]
+    assert indexes[server.CUSTOMER_PHONE_INDEX]["partialFilterExpression"] == {"phone_normalized": {"$gt": ""}}
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import ExecutionTimeout
+
+
+@pytest.fixture
+def slow_company(server, monkeypatch):
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+    monkeypatch.setitem(server.ROUTE_DEADLINE_SECONDS, "/api/company", 0.05)
+    monkeypatch.setattr(server, "cached_company", slow)
+    return cancelled
+
+
+def test_longest_prefix_picks_the_budget(server):
+    assert server.route_deadline_seconds("/api/products/search") == 1
+    assert server.route_deadline_seconds("/api/sales/archive") is None
+    assert server.route_deadline_seconds("/api/sales/123/invoice") == 10
+    assert server.route_deadline_seconds("/api/users") == server.REQUEST_DEADLINE_SECONDS
+    assert server.route_deadline_seconds("/api/stock/reorder") == 5
+
+
+def test_manual_batch_jobs_have_no_deadline(server):
+    for path in ["/api/stock/reorder/run", "/api/stock/snapshots", "/api/stock/verify", "/api/customers/dedup"]:
+        assert server.route_deadline_seconds(path) is None
+
+
+def test_request_over_budget_gets_503_and_is_cancelled(client, server, slow_company):
+    response = client.get("/api/company")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.DEADLINE_RETRY_AFTER_SECONDS)
+    assert response.json() == {"detail": "Request deadline exceeded"}
+    # The handler is cancelled rather than left running
+    for _ in range(100):
+        if slow_company:
+            break
+        time.sleep(0.01)
+    assert slow_company == [True]
+
+
+def test_mongo_execution_timeout_maps_to_503(client, server, monkeypatch):
+    async def timed_out():
+        raise ExecutionTimeout("operation exceeded time limit")
+    monkeypatch.setattr(server, "cached_company", timed_out)
+    response = client.get("/api/company")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.DEADLINE_RETRY_AFTER_SECONDS)
+
+
+def test_remaining_budget_is_checked_before_queries(server):
+    token = server.request_deadline.set(server.time.monotonic() - 1)
+    try:
+        with pytest.raises(HTTPException) as raised:
+            server.remaining_ms()
+        assert raised.value.status_code == 503
+    finally:
+        server.request_deadline.reset(token)
+    assert server.remaining_ms() is None
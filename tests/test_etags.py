@@ -0,0 +1,82 @@
+from tests.conftest import unique
+
+
+def test_fields_projects_the_list(client, make_product):
+    make_product()
+    response = client.get("/api/products", params={"fields": "name,quantity"})
+    assert response.status_code == 200
+    assert response.json() and all(set(row) == {"id", "name", "quantity"} for row in response.json())
+
+
+def test_unknown_fields_are_rejected(client):
+    response = client.get("/api/products", params={"fields": "name,password"})
+    assert response.status_code == 400
+    assert "password" in response.json()["detail"]
+
+
+def test_matching_etag_gets_304(client, make_product):
+    make_product()
+    first = client.get("/api/products")
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+
+    unchanged = client.get("/api/products", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.headers["ETag"] == etag
+    assert unchanged.content == b""
+    # Weak comparison, and any tag in the list
+    assert client.get("/api/products", headers={"If-None-Match": f'"stale", {etag.removeprefix("W/")}'}).status_code == 304
+    assert client.get("/api/products", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_projection_has_its_own_etag(client, make_product):
+    make_product()
+    full = client.get("/api/products").headers["ETag"]
+    projected = client.get("/api/products", params={"fields": "name"}).headers["ETag"]
+    assert projected != full
+    assert client.get("/api/products", params={"fields": "name"}, headers={"If-None-Match": full}).status_code == 200
+
+
+def test_creates_and_updates_change_the_etag(client, make_product):
+    product = make_product()
+    before = client.get("/api/products").headers["ETag"]
+
+    make_product()
+    after_create = client.get("/api/products", headers={"If-None-Match": before})
+    assert after_create.status_code == 200
+    assert after_create.headers["ETag"] != before
+
+    data = {key: product[key] for key in ["name", "vendor_id", "purchase_price", "selling_price"]}
+    operations = [{"op": "update", "collection": "products", "id": product["id"], "data": {**data, "quantity": 1}}]
+    assert client.post("/api/batch", json={"operations": operations}).json()["succeeded"] == 1
+    after_update = client.get("/api/products", headers={"If-None-Match": after_create.headers["ETag"]})
+    assert after_update.status_code == 200
+    assert after_update.headers["ETag"] != after_create.headers["ETag"]
+
+
+def test_reference_lists_change_etag_after_a_write(client, vendor):
+    before = client.get("/api/vendors").headers["ETag"]
+    assert client.get("/api/vendors", headers={"If-None-Match": before}).status_code == 304
+    client.post("/api/vendors", json={"name": "Another vendor", "address": "a", "phone": "1"})
+    after = client.get("/api/vendors", headers={"If-None-Match": before})
+    assert after.status_code == 200
+    assert after.headers["ETag"] != before
+
+
+def test_no_etag_while_a_lower_version_is_still_being_written(server, call, vendor):
+    async def scenario():
+        admin = server.User(**await server.db.users.find_one({"username": "admin"}))
+        payload = {"vendor_id": vendor["id"], "quantity": 1, "purchase_price": 1, "selling_price": 2}
+        before = await server.conditional_list("products", server.Product, {}, None, None)
+        async with server.versioned_write() as pending_version:
+            # A later write lands while the earlier one is still pending
+            await server._create_product(server.ProductCreate(name=unique("Fast"), **payload), admin)
+            during = await server.conditional_list("products", server.Product, {}, None, before.headers["ETag"])
+            slow = server.Product(branch_id=admin.branch_id or "main", version=pending_version, name=unique("Slow"), **payload)
+            await server.db.products.insert_one(server.product_document(slow))
+        after = await server.conditional_list("products", server.Product, {}, None, before.headers["ETag"])
+        return before, during, after
+
+    before, during, after = call(scenario)
+    assert during.status_code == 200 and "ETag" not in during.headers
+    assert after.status_code == 200 and after.headers["ETag"] != before.headers["ETag"]
@@ -0,0 +1,12 @@
+def test_version_export_stops_below_writes_in_flight(server, call, make_product):
+    make_product()
+
+    async def scenario():
+        async with server.export_lock:
+            async with server.versioned_write() as version:
+                result = await server.export_dataset("products")
+            return version, result
+
+    version, result = call(scenario)
+    assert result["watermark"] < version
+    assert result["rows"] >= 1
@@ -0,0 +1,112 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from tests.conftest import unique
+
+
+def vendor_payload():
+    return {"name": unique("Vendor"), "address": "1 Road", "phone": "100"}
+
+
+def test_retry_replays_first_response(client):
+    payload = vendor_payload()
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    first = client.post("/api/vendors", json=payload, headers=headers)
+    second = client.post("/api/vendors", json=payload, headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    names = [vendor["name"] for vendor in client.get("/api/vendors").json()]
+    assert names.count(payload["name"]) == 1
+
+
+def test_key_reused_with_different_body_is_rejected(client):
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    assert client.post("/api/vendors", json=vendor_payload(), headers=headers).status_code == 200
+    response = client.post("/api/vendors", json=vendor_payload(), headers=headers)
+    assert response.status_code == 422
+
+
+def test_requests_without_key_are_not_deduplicated(client):
+    payload = vendor_payload()
+    first = client.post("/api/vendors", json=payload).json()
+    second = client.post("/api/vendors", json=payload).json()
+    assert first["id"] != second["id"]
+
+
+@pytest.fixture
+def user(server):
+    return server.User(username=unique("user"), email="user@example.com", password_hash="x", role="admin")
+
+
+@pytest.fixture
+def yielding_find_one(server, monkeypatch):
+    # mongomock answers without yielding; a real driver gives other requests a turn
+    find_one = server.DeadlineCollection.find_one
+
+    async def find_one_after_yield(self, *args, **kwargs):
+        await asyncio.sleep(0)
+        return await find_one(self, *args, **kwargs)
+    monkeypatch.setattr(server.DeadlineCollection, "find_one", find_one_after_yield)
+
+
+def test_concurrent_duplicates_share_one_execution(server, call, user, yielding_find_one):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"value": len(calls)}
+
+    async def run_both():
+        key = str(uuid.uuid4())
+        return await asyncio.gather(*(
+            server.run_idempotent(key, "test", user, {"a": 1}, handler) for _ in range(2)
+        ))
+
+    original, duplicate = call(run_both)
+    assert len(calls) == 1
+    assert original == {"value": 1}
+    assert duplicate.headers["Idempotent-Replayed"] == "true"
+    assert duplicate.body == b'{"value":1}'
+
+
+def test_concurrent_duplicate_with_different_body_is_rejected(server, call, user, yielding_find_one):
+    async def handler():
+        await asyncio.sleep(0.05)
+        return {"value": 1}
+
+    async def run_both():
+        key = str(uuid.uuid4())
+        return await asyncio.gather(
+            server.run_idempotent(key, "test", user, {"a": 1}, handler),
+            server.run_idempotent(key, "test", user, {"a": 2}, handler),
+            return_exceptions=True
+        )
+
+    original, duplicate = call(run_both)
+    assert original == {"value": 1}
+    assert isinstance(duplicate, HTTPException) and duplicate.status_code == 422
+
+
+def test_failed_request_is_not_cached(server, call, user):
+    attempts = []
+
+    async def handler():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise HTTPException(status_code=400, detail="first attempt fails")
+        return {"attempt": len(attempts)}
+
+    key = str(uuid.uuid4())
+    with pytest.raises(HTTPException):
+        call(server.run_idempotent, key, "test", user, {"a": 1}, handler)
+    assert call(server.run_idempotent, key, "test", user, {"a": 1}, handler) == {"attempt": 2}
+    replay = call(server.run_idempotent, key, "test", user, {"a": 1}, handler)
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert len(attempts) == 2
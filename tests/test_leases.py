@@ -0,0 +1,49 @@
+import asyncio
+
+from tests.conftest import unique
+
+
+def test_a_held_lease_is_refused_even_to_its_own_worker(server, call):
+    name = unique("lease")
+    token = call(server.acquire_lease, name, 60)
+    assert token
+    assert call(server.acquire_lease, name, 60) is None
+    # Only the holder's token releases it
+    call(server.release_lease, name, "someone-else")
+    assert call(server.acquire_lease, name, 60) is None
+    call(server.release_lease, name, token)
+    assert call(server.acquire_lease, name, 60)
+
+
+def test_expired_holder_cannot_release_its_successor(server, call):
+    name = unique("lease")
+    expired = call(server.acquire_lease, name, 0)
+    successor = call(server.acquire_lease, name, 60)
+    assert successor and successor != expired
+    call(server.release_lease, name, expired)
+    assert call(server.acquire_lease, name, 60) is None
+    assert call(server.renew_lease, name, expired, 60) is False
+
+
+def test_kept_lease_outlives_its_ttl_and_is_released_after(server, call):
+    name = unique("lease")
+
+    async def scenario():
+        token = await server.acquire_lease(name, 0.3)
+        async with server.keep_lease(name, token, 0.3):
+            await asyncio.sleep(0.6)
+            during = await server.acquire_lease(name, 0.3)
+        return during, await server.db.leases.find_one({"_id": name})
+
+    during, after = call(scenario)
+    assert during is None
+    assert after is None
+
+
+def test_manual_run_is_refused_while_the_job_holds_the_lease(client, server, call):
+    token = call(server.acquire_lease, "sales_archive", 60)
+    try:
+        assert client.post("/api/sales/archive").status_code == 409
+        assert client.post("/api/stock/reorder/run").status_code == 200
+    finally:
+        call(server.release_lease, "sales_archive", token)
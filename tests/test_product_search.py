@@ -0,0 +1,124 @@
+import asyncio
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def cache(server):
+    return server.ProductSearchCache(ttl=60, max_branches=4, max_products=100)
+
+
+def row(name: str, branch_id: str = "b1", **fields):
+    return {"id": str(uuid.uuid4()), "name": name, "name_normalized": name.lower(), "vendor_id": "v", "quantity": 1,
+            "purchase_price": 1.0, "selling_price": 2.0, "branch_id": branch_id, **fields}
+
+
+def names(rows):
+    return [found["name"] for found in rows]
+
+
+def test_search_goes_to_the_index_until_the_background_load_finishes(server, call, make_product):
+    product = make_product(name=f"Zebra {uuid.uuid4().hex[:6]}")
+    cache = server.ProductSearchCache(ttl=60, max_branches=4, max_products=1000)
+    prefix = server.normalize_name(product["name"])
+
+    async def scenario():
+        cold = cache.search(product["branch_id"], prefix, 5)
+        await cache.loading[product["branch_id"]]
+        return cold, cache.search(product["branch_id"], prefix, 5)
+
+    cold, warm = call(scenario)
+    assert cold is None
+    assert names(warm) == [product["name"]]
+
+
+def test_writes_are_placed_in_the_sorted_list(server, call, cache):
+    async def scenario():
+        await server.db.products.insert_many([row("Banana"), row("Cherry")])
+        cache.search("b1", "", 1)
+        await cache.loading["b1"]
+        apple, apricot = row("Apple"), row("Apricot")
+        cache.upsert("b1", apricot)
+        cache.upsert("b1", apple)
+        cache.upsert("b1", {**apple, "name": "Zucchini", "name_normalized": "zucchini"})
+        return cache.search("b1", "", 10), cache.search("b1", "ap", 10)
+
+    everything, prefixed = call(scenario)
+    assert names(everything) == ["Apricot", "Banana", "Cherry", "Zucchini"]
+    assert names(prefixed) == ["Apricot"]
+
+
+def test_expired_entry_is_served_while_it_reloads(server, call, cache, monkeypatch):
+    branch_id = f"branch-{uuid.uuid4().hex[:6]}"
+
+    async def scenario():
+        await server.db.products.insert_one(row("Mango", branch_id))
+        cache.search(branch_id, "", 1)
+        await cache.loading[branch_id]
+        await server.db.products.insert_one(row("Melon", branch_id))
+        cache.ttl = 0
+        stale = cache.search(branch_id, "m", 10)
+        refresh = cache.loading[branch_id]
+        await refresh
+        cache.ttl = 60
+        return stale, cache.search(branch_id, "m", 10)
+
+    stale, fresh = call(scenario)
+    assert names(stale) == ["Mango"]
+    assert names(fresh) == ["Mango", "Melon"]
+
+
+def test_background_load_ignores_the_request_deadline(server, call, cache):
+    async def scenario():
+        token = server.request_deadline.set(0.0)  # already expired
+        try:
+            cache.search("b1", "", 1)
+            task = cache.loading["b1"]
+        finally:
+            server.request_deadline.reset(token)
+        await task
+        return task.exception()
+
+    assert call(scenario) is None
+
+
+def test_rows_written_during_a_load_survive_it(server, call, cache):
+    branch_id = f"branch-{uuid.uuid4().hex[:6]}"
+
+    async def scenario():
+        cache.search(branch_id, "", 1)
+        # Written after the load's query was issued
+        await asyncio.sleep(0)
+        cache.upsert(branch_id, row("Kiwi", branch_id))
+        await cache.loading[branch_id]
+        return cache.search(branch_id, "", 10)
+
+    assert names(call(scenario)) == ["Kiwi"]
+
+
+def test_fuzzy_matches_are_returned_in_name_order(server, call, monkeypatch):
+    prefix_hits = [row("Chai Masala"), row("Chai Tea")]
+    fuzzy_hits = [row("Masala Chai"), row("Adrak Chai"), prefix_hits[0]]
+
+    class TextIndex:
+        def find(self, filter, projection):
+            assert "$text" in filter
+            return self
+
+        def sort(self, *args):
+            return self
+
+        def limit(self, limit):
+            return self
+
+        async def to_list(self, length):
+            return [dict(found, score=1.0) for found in fuzzy_hits]
+
+    monkeypatch.setattr(server.product_search_cache, "search", lambda branch_id, prefix, limit: list(prefix_hits))
+    monkeypatch.setattr(server.db, "products", TextIndex(), raising=False)
+
+    found = call(server.search_branch_products, "b1", "chai", 10, True, "chai")
+    assert names(found) == ["Adrak Chai", "Chai Masala", "Chai Tea", "Masala Chai"]
+    assert all("score" not in match for match in found)
+    assert names(call(server.search_branch_products, "b1", "chai", 3, True, "chai")) == ["Chai Masala", "Chai Tea", "Masala Chai"]
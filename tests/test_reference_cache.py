@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import unique
+
+
+def counting_loader(value="value", gate=None, error=None):
+    calls = []
+
+    async def load():
+        calls.append(True)
+        if gate is not None:
+            await gate.wait()
+        if error is not None:
+            raise error
+        return value
+    return load, calls
+
+
+def test_concurrent_misses_share_one_load(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=10)
+
+    async def scenario():
+        gate = asyncio.Event()
+        load, calls = counting_loader(gate=gate)
+        waiters = [asyncio.ensure_future(cache.get("vendors:*", load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*waiters), calls
+
+    values, calls = asyncio.run(scenario())
+    assert values == ["value"] * 5 and len(calls) == 1
+    stats = cache.snapshot()["namespaces"]["vendors"]
+    assert stats["misses"] == 1 and stats["coalesced"] == 4 and stats["hit_ratio"] == 0.8
+
+
+def test_shared_load_ignores_the_first_callers_deadline(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=10)
+
+    async def load():
+        await asyncio.sleep(0.01)
+        server.remaining_ms()  # raises 503 once a deadline has passed
+        return "value"
+
+    async def caller(deadline):
+        server.request_deadline.set(deadline)
+        return await cache.get("branches", load)
+
+    async def scenario():
+        nearly_out = server.time.monotonic() + 0.001
+        return await asyncio.gather(caller(nearly_out), caller(None))
+
+    assert asyncio.run(scenario()) == ["value", "value"]
+
+
+def test_least_recently_used_entry_is_evicted(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=2)
+
+    async def scenario():
+        for key in ["a", "b", "a", "c"]:
+            await cache.get(key, counting_loader(key)[0])
+
+    asyncio.run(scenario())
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.stats["b"]["evictions"] == 1
+
+
+def test_expired_entry_is_reloaded(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=10)
+
+    async def scenario():
+        load, calls = counting_loader()
+        await cache.get("company", load, ttl=0)
+        await cache.get("company", load, ttl=0)
+        return calls
+
+    assert len(asyncio.run(scenario())) == 2
+
+
+def test_invalidation_drops_a_load_in_flight(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=10)
+
+    async def scenario():
+        gate = asyncio.Event()
+        stale, _ = counting_loader("stale", gate=gate)
+        waiter = asyncio.ensure_future(cache.get("vendors:*", stale))
+        await asyncio.sleep(0)
+        cache.invalidate("vendors:")
+        gate.set()
+        # The caller already waiting still gets its answer, but it is not kept
+        first = await waiter
+        fresh, calls = counting_loader("fresh")
+        return first, await cache.get("vendors:*", fresh), calls
+
+    first, second, calls = asyncio.run(scenario())
+    assert first == "stale" and second == "fresh" and len(calls) == 1
+
+
+def test_failed_loads_are_not_cached(server):
+    cache = server.ReadThroughCache(ttl=60, max_entries=10)
+
+    async def scenario():
+        failing, _ = counting_loader(error=RuntimeError("down"))
+        with pytest.raises(RuntimeError):
+            await cache.get("branches", failing)
+        load, calls = counting_loader()
+        return await cache.get("branches", load), calls
+
+    value, calls = asyncio.run(scenario())
+    assert value == "value" and len(calls) == 1
+    assert cache.stats["branches"]["load_errors"] == 1
+
+
+def test_write_routes_invalidate_cached_lists(client):
+    assert client.get("/api/vendors").status_code == 200
+    created = client.post("/api/vendors", json={"name": unique("Vendor"), "address": "a", "phone": "1"}).json()
+    assert created["id"] in {row["id"] for row in client.get("/api/vendors").json()}
+
+    original = client.get("/api/company").json()
+    try:
+        name = unique("Company")
+        assert client.put("/api/company", json={"name": name, "address": "a", "phone": "1"}).status_code == 200
+        assert client.get("/api/company").json()["name"] == name
+    finally:
+        if original:
+            client.put("/api/company", json={key: original[key] for key in ["name", "address", "phone", "logo_base64"]})
+
+
+def test_cache_metrics_report_per_namespace(client, server):
+    client.get("/api/vendors")
+    client.get("/api/vendors")
+    metrics = client.get("/api/metrics/cache").json()
+    assert metrics["max_entries"] == server.REFERENCE_CACHE_MAX_ENTRIES
+    assert metrics["namespaces"]["vendors"]["hits"] >= 1
+    assert metrics["namespaces"]["vendors"]["entries"] >= 1
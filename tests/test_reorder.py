@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from tests.conftest import unique
+
+
+def reorder_point_of(server, call, product):
+    return call(server.db.reorder_points.find_one, {"product_id": product["id"]}, {"_id": 0})
+
+
+def test_restock_clears_the_reorder_flag_on_the_next_incremental_run(client, server, call, make_product, customer):
+    product = make_product(quantity=2)
+    items = [{"product_id": product["id"], "quantity": 2, "selling_price": product["selling_price"]}]
+    assert client.post("/api/sales", json={"customer_id": customer["id"], "items": items}).status_code == 200
+    call(server.run_reorder_job, full=True)
+    assert reorder_point_of(server, call, product)["below_reorder_point"] is True
+
+    data = {key: product[key] for key in ["name", "vendor_id", "purchase_price", "selling_price"]}
+    operations = [{"op": "update", "collection": "products", "id": product["id"], "data": {**data, "quantity": 50}}]
+    assert client.post("/api/batch", json={"operations": operations}).json()["succeeded"] == 1
+
+    result = call(server.run_reorder_job)
+    assert result["full"] is False
+    row = reorder_point_of(server, call, product)
+    assert row["quantity"] == 50 and row["below_reorder_point"] is False
+
+
+def test_sales_leaving_the_window_are_recomputed(server, call, make_product):
+    product = make_product(quantity=5)
+    now = datetime.utcnow()
+    window = timedelta(days=server.REORDER_WINDOW_DAYS)
+    # Only the aged-out sale, not the purchase, falls in the incremental run's range
+    call(server.db.stock_movements.update_many, {"product_id": product["id"]}, {"$set": {"created_at": now - timedelta(hours=3)}})
+    sale = server.stock_movement({**product, "name": unique("Sold")}, -30, "sale")
+    sale["created_at"] = now - window - timedelta(hours=1)
+    call(server.db.stock_movements.insert_one, sale)
+    call(server.db.reorder_points.update_one, {"product_id": product["id"]},
+         {"$set": {"branch_id": product["branch_id"], "daily_velocity": 5.0, "below_reorder_point": True}}, upsert=True)
+    call(server.db.reorder_state.update_one, {"_id": "reorder"},
+         {"$set": {"last_run_at": now - timedelta(hours=2), "last_full_at": now}}, upsert=True)
+
+    assert call(server.run_reorder_job)["full"] is False
+    row = reorder_point_of(server, call, product)
+    assert row["daily_velocity"] == 0 and row["below_reorder_point"] is False
+
+
+def test_full_run_is_forced_after_the_full_interval(server, call):
+    stale = datetime.utcnow() - timedelta(hours=server.REORDER_FULL_INTERVAL_HOURS + 1)
+    call(server.db.reorder_state.update_one, {"_id": "reorder"}, {"$set": {"last_full_at": stale}}, upsert=True)
+    assert call(server.run_reorder_job)["full"] is True
+    assert call(server.run_reorder_job)["full"] is False
@@ -0,0 +1,140 @@
+"""Conformance checks for the storage repositories.
+
+Every check runs against SQLiteRepository and against MongoRepository on a
+database of its own (the server in MONGO_URL, or mongomock-motor). They pin down the
+behaviour routes rely on: filter operators, paging, grouped sums, counters
+and stock decrements that never oversell under concurrency.
+"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+STARTED = datetime(2024, 1, 1)
+
+
+def make_products(count: int = 20, branches: int = 2):
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "name": f"Product {index:06d}",
+            "branch_id": f"branch-{index % branches}",
+            "vendor_id": "vendor-1",
+            "quantity": index % 50,
+            "purchase_price": 10.0 + index % 7,
+            "selling_price": 15.0 + index % 7,
+            "low_stock": index % 50 < 5,
+            "created_at": STARTED + timedelta(seconds=index),
+        }
+        for index in range(count)
+    ]
+
+
+@pytest.fixture(params=["sqlite", "mongo"])
+def repository(request, server, call, tmp_path):
+    if request.param == "sqlite":
+        pytest.importorskip("aiosqlite")
+        repository = call(server.SQLiteRepository(str(tmp_path / "repository.db")).open)
+        yield repository
+        call(repository.close)
+    else:
+        name = f"repository_{uuid.uuid4().hex[:8]}"
+        yield server.MongoRepository(server.client[name])
+        call(server.client.drop_database, name)
+
+
+@pytest.fixture
+def products(repository, call):
+    products = make_products()
+    call(repository.insert_many, "products", products)
+    call(repository.ensure_index, "products", ["branch_id", "name"])
+    return products
+
+
+def test_find_supports_the_filter_operators(repository, call, products):
+    async def scenario():
+        return {
+            "found": await repository.find_one("products", {"id": products[3]["id"]}),
+            "branch": await repository.find("products", {"branch_id": "branch-0"}, sort=[("name", 1)]),
+            "range": await repository.find("products", {"quantity": {"$gte": 5, "$lt": 10}}),
+            "in": await repository.find("products", {"id": {"$in": [products[0]["id"], products[1]["id"]]}}),
+            "in_empty": await repository.find("products", {"id": {"$in": []}}),
+            "bool": await repository.find("products", {"low_stock": True}),
+            "ne": await repository.find("products", {"branch_id": {"$ne": "branch-0"}}),
+            "after": await repository.find("products", {"created_at": {"$gt": STARTED + timedelta(seconds=15)}}),
+            "newest": await repository.find("products", {}, sort=[("created_at", -1)], limit=1, fields=["id", "name"]),
+        }
+
+    results = call(scenario)
+    assert results["found"] == products[3]
+    assert isinstance(results["found"]["created_at"], datetime)
+    assert [row["name"] for row in results["branch"]] == [p["name"] for p in products if p["branch_id"] == "branch-0"]
+    assert len(results["range"]) == 5
+    assert len(results["in"]) == 2
+    assert results["in_empty"] == []
+    assert len(results["bool"]) == 5
+    assert len(results["ne"]) == 10
+    assert len(results["after"]) == 4
+    assert results["newest"] == [{"id": products[-1]["id"], "name": products[-1]["name"]}]
+
+
+def test_list_page_returns_the_page_and_the_total(repository, call, products):
+    page, total = call(repository.list_page, "products", {"branch_id": "branch-1"}, "name", 2, 4)
+    assert total == 10
+    assert [row["name"] for row in page] == [p["name"] for p in products if p["branch_id"] == "branch-1"][4:8]
+
+
+def test_summarize_groups_and_multiplies(repository, call, products):
+    summary = call(repository.summarize, "products", {}, "branch_id", {"value": ["quantity", "purchase_price"], "units": ["quantity"]})
+    assert [row["_id"] for row in summary] == ["branch-0", "branch-1"]
+    for row in summary:
+        expected = [p for p in products if p["branch_id"] == row["_id"]]
+        assert row["units"] == sum(p["quantity"] for p in expected)
+        assert row["value"] == pytest.approx(sum(p["quantity"] * p["purchase_price"] for p in expected))
+    assert call(repository.summarize, "products", {"branch_id": "none"}, None, {"units": ["quantity"]}) == []
+
+
+def test_update_one_reports_whether_it_matched(repository, call, products):
+    assert call(repository.update_one, "products", {"id": products[0]["id"]}, {"name": "Renamed"})
+    assert not call(repository.update_one, "products", {"id": "missing"}, {"name": "Renamed"})
+    assert call(repository.find_one, "products", {"id": products[0]["id"]})["name"] == "Renamed"
+
+
+def test_concurrent_decrements_never_oversell(repository, call, products):
+    target = products[15]
+
+    async def scenario():
+        # Twenty concurrent sales of 2 against 15 in stock
+        return await asyncio.gather(*(repository.decrement_stock(target["id"], 2, {"version": 7}) for _ in range(20)))
+
+    results = call(scenario)
+    assert sum(1 for result in results if result) == 7
+    final = call(repository.find_one, "products", {"id": target["id"]})
+    assert final["quantity"] == 1 and final["version"] == 7
+    assert call(repository.decrement_stock, "missing", 1) is None
+
+
+def test_sequences_advance_and_seed(repository, call):
+    async def scenario():
+        values = [await repository.next_sequence("invoices"), await repository.next_sequence("invoices", 5)]
+        await repository.seed_sequence("invoices", 3)
+        values.append(await repository.next_sequence("invoices"))
+        await repository.seed_sequence("seeded", 40)
+        values.append(await repository.next_sequence("seeded"))
+        concurrent = await asyncio.gather(*(repository.next_sequence("concurrent") for _ in range(50)))
+        return values, concurrent
+
+    values, concurrent = call(scenario)
+    assert values == [1, 6, 7, 41]
+    assert sorted(concurrent) == list(range(1, 51))
+
+
+def test_unsupported_operators_are_rejected(repository, call):
+    with pytest.raises(ValueError):
+        call(repository.find, "products", {"name": {"$regex": "x"}})
+
+
+def test_repository_is_abstract(server):
+    with pytest.raises(TypeError):
+        server.Repository()
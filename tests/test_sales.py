@@ -0,0 +1,89 @@
+def sell(client, customer, *lines):
+    items = [{"product_id": product["id"], "quantity": quantity, "selling_price": product["selling_price"]} for product, quantity in lines]
+    return client.post("/api/sales", json={"customer_id": customer["id"], "items": items})
+
+
+def quantity_of(client, product):
+    products = client.get("/api/products", params={"fields": "quantity"}).json()
+    return next(row["quantity"] for row in products if row["id"] == product["id"])
+
+
+def movements_of(client, product):
+    return client.get("/api/stock/movements", params={"product_id": product["id"]}).json()
+
+
+def summary_mismatches(client, *products):
+    names = {product["name"] for product in products}
+    report = client.get("/api/stock/verify").json()
+    return [mismatch for mismatch in report["mismatches"] if mismatch["name"] in names]
+
+
+def test_sale_takes_stock_and_records_movements(client, make_product, customer):
+    first, second = make_product(quantity=10), make_product(quantity=5)
+    response = sell(client, customer, (first, 3), (second, 5))
+    assert response.status_code == 200
+    sale = response.json()
+
+    assert quantity_of(client, first) == 7 and quantity_of(client, second) == 0
+    assert sale["total_amount"] == 8 * first["selling_price"]
+    assert [row["quantity_delta"] for row in movements_of(client, first) if row["kind"] == "sale"] == [-3]
+    assert summary_mismatches(client, first, second) == []
+
+
+def test_missing_later_item_leaves_stock_untouched(client, make_product, customer):
+    product = make_product(quantity=10)
+    response = sell(client, customer, (product, 2), ({"id": "missing", "selling_price": 1}, 1))
+    assert response.status_code == 404
+    assert quantity_of(client, product) == 10
+    assert [row["kind"] for row in movements_of(client, product)] == ["purchase"]
+    assert summary_mismatches(client, product) == []
+
+
+def test_short_later_item_leaves_stock_untouched(client, make_product, customer):
+    plenty, short = make_product(quantity=10), make_product(quantity=1)
+    assert sell(client, customer, (plenty, 2), (short, 2)).status_code == 400
+    # The same product twice counts against one stock level
+    assert sell(client, customer, (plenty, 6), (plenty, 6)).status_code == 400
+    assert quantity_of(client, plenty) == 10 and quantity_of(client, short) == 1
+
+
+def version_of(client, product):
+    products = client.get("/api/products", params={"fields": "version"}).json()
+    return next(row["version"] for row in products if row["id"] == product["id"])
+
+
+def test_lost_decrement_race_puts_earlier_items_back(client, server, monkeypatch, make_product, customer):
+    first, second = make_product(quantity=10), make_product(quantity=10)
+    decrement_stock = server.repository.decrement_stock
+
+    decremented = []
+
+    async def concurrent_sale_wins(product_id, quantity, fields=None):
+        if product_id == second["id"]:
+            return None
+        decremented.append(await decrement_stock(product_id, quantity, fields))
+        return decremented[-1]
+    monkeypatch.setattr(server.repository, "decrement_stock", concurrent_sale_wins)
+
+    assert sell(client, customer, (first, 4), (second, 4)).status_code == 400
+    monkeypatch.undo()
+    assert quantity_of(client, first) == 10
+    # The restore is a versioned write of its own
+    assert version_of(client, first) > decremented[0]["version"]
+    assert [row["kind"] for row in movements_of(client, first)] == ["purchase"]
+    assert summary_mismatches(client, first, second) == []
+    # A retry succeeds and takes the stock exactly once
+    assert sell(client, customer, (first, 4), (second, 4)).status_code == 200
+    assert quantity_of(client, first) == 6
+
+
+def test_verify_reports_on_get_and_repairs_on_post(client, server, call, make_product):
+    product = make_product(quantity=4)
+    call(server.db.stock_summary.update_one, {"kind": "item", "name": product["name"]}, {"$inc": {"total_quantity": 100}})
+
+    assert len(summary_mismatches(client, product)) == 1
+    assert len(summary_mismatches(client, product)) == 1
+
+    repaired = client.post("/api/stock/verify", params={"branch_id": product["branch_id"]}).json()
+    assert repaired["repaired"]
+    assert summary_mismatches(client, product) == []
@@ -0,0 +1,58 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def branch_id():
+    return f"branch-{uuid.uuid4().hex[:8]}"
+
+
+def movement(server, branch_id, product_id, delta, age_seconds):
+    row = server.stock_movement({"id": product_id, "branch_id": branch_id, "name": "Tea"}, delta, "adjustment")
+    row["created_at"] = datetime.utcnow() - timedelta(seconds=age_seconds)
+    return row
+
+
+def snapshot_quantities(server, call, snapshot):
+    rows = call(lambda: server.db.stock_snapshot_items.find({"snapshot_id": snapshot["id"]}).to_list(None))
+    return {row["product_id"]: row["quantity"] for row in rows}
+
+
+def test_snapshots_follow_the_ledger_up_to_the_safety_lag(server, call, monkeypatch, branch_id):
+    product_id = str(uuid.uuid4())
+    # Live quantity disagrees with the ledger; the ledger wins
+    call(server.db.products.insert_one, {"id": product_id, "branch_id": branch_id, "name": "Tea", "quantity": 999})
+    call(server.db.stock_movements.insert_many, [
+        movement(server, branch_id, product_id, 10, 120),
+        movement(server, branch_id, product_id, -3, 90),
+        movement(server, branch_id, product_id, 5, 10),  # still inside the lag
+    ])
+    monkeypatch.setattr(server, "STOCK_SNAPSHOT_SAFETY_LAG_SECONDS", 60)
+    first = call(server.take_stock_snapshot, branch_id)
+    assert first["taken_at"] < datetime.utcnow() - timedelta(seconds=59)
+    assert snapshot_quantities(server, call, first) == {product_id: 7}
+
+    monkeypatch.setattr(server, "STOCK_SNAPSHOT_SAFETY_LAG_SECONDS", 0)
+    second = call(server.take_stock_snapshot, branch_id)
+    # The movement inside the first lag is counted once, by the roll-forward
+    assert snapshot_quantities(server, call, second) == {product_id: 12}
+
+
+def test_products_older_than_the_ledger_get_an_opening_movement(server, call, monkeypatch, branch_id):
+    untouched = {"id": str(uuid.uuid4()), "branch_id": branch_id, "name": "Old stock", "quantity": 4,
+                 "created_at": (datetime.utcnow() - timedelta(days=400)).replace(microsecond=0)}
+    call(server.db.products.insert_one, dict(untouched))
+
+    class NoSnapshots:
+        async def find_one(self, *args, **kwargs):
+            return None
+    monkeypatch.setattr(server.db, "stock_snapshots", NoSnapshots(), raising=False)
+    call(server.backfill_opening_movements)
+    call(server.backfill_opening_movements)
+    monkeypatch.undo()
+
+    rows = call(lambda: server.db.stock_movements.find({"product_id": untouched["id"]}).to_list(None))
+    assert [(row["quantity_delta"], row["created_at"]) for row in rows] == [(4, untouched["created_at"])]
+    assert snapshot_quantities(server, call, call(server.take_stock_snapshot, branch_id)) == {untouched["id"]: 4}
@@ -0,0 +1,103 @@
+import pytest
+
+from tests.conftest import unique
+
+
+def vendor_payload():
+    return {"name": unique("Vendor"), "address": "1 Road", "phone": "100"}
+
+
+def sync_head(client) -> int:
+    token, has_more = 0, True
+    while has_more:
+        body = client.get("/api/sync", params={"since": token}).json()
+        token, has_more = body["token"], body["has_more"]
+    return token
+
+
+@pytest.fixture
+def admin(server, call):
+    async def load():
+        return server.User(**await server.db.users.find_one({"username": "admin"}))
+    return call(load)
+
+
+def test_pages_follow_versions_until_caught_up(client):
+    head = sync_head(client)
+    created = [client.post("/api/vendors", json=vendor_payload()).json()["id"] for _ in range(3)]
+
+    first = client.get("/api/sync", params={"since": head, "limit": 2}).json()
+    assert [vendor["id"] for vendor in first["changes"]["vendors"]] == created[:2]
+    assert first["has_more"]
+
+    second = client.get("/api/sync", params={"since": first["token"], "limit": 2}).json()
+    assert [vendor["id"] for vendor in second["changes"]["vendors"]] == created[2:]
+    assert not second["has_more"]
+    assert client.get("/api/sync", params={"since": second["token"]}).json()["changes"]["vendors"] == []
+
+
+def test_deletions_are_reported_as_tombstones(client, server, call, vendor):
+    head = sync_head(client)
+    call(server.record_tombstones, "vendors", [vendor])
+    body = client.get("/api/sync", params={"since": head}).json()
+    assert body["deleted"]["vendors"] == [vendor["id"]]
+    assert body["token"] > head
+
+
+def test_token_stops_below_a_write_still_in_flight(client, server, call, admin):
+    head = sync_head(client)
+
+    async def scenario():
+        async with server.versioned_write() as pending_version:
+            # A later write lands while the earlier one is still pending
+            later = await server._create_vendor(server.VendorCreate(**vendor_payload()), admin)
+            during = await server.sync_changes(since=head, current_user=admin)
+            slow = server.Vendor(branch_id=later.branch_id, version=pending_version, **vendor_payload())
+            await server.db.vendors.insert_one(slow.dict())
+        after = await server.sync_changes(since=head, current_user=admin)
+        return pending_version, later, slow, during, after
+
+    pending_version, later, slow, during, after = call(scenario)
+    assert later.version > pending_version
+    assert during["token"] == pending_version - 1
+    assert during["changes"]["vendors"] == []
+    assert [vendor.id for vendor in after["changes"]["vendors"]] == [slow.id, later.id]
+    assert after["token"] >= later.version
+
+
+def test_abandoned_markers_expire(client, server, call):
+    async def scenario():
+        latest = await server.current_version()
+        expired = server.datetime.utcnow() - server.timedelta(seconds=1)
+        await server.db.counters.update_one(
+            {"_id": "sync_version"}, {"$set": {"pending.abandoned": {"floor": 1, "expires_at": expired}}}
+        )
+        stable = await server.stable_version()
+        return latest, stable, await server.db.counters.find_one({"_id": "sync_version"})
+
+    latest, stable, counter = call(scenario)
+    assert stable == latest
+    assert "abandoned" not in counter["pending"]
+
+
+def test_allocation_and_marker_are_one_round_trip(server, call, monkeypatch):
+    calls = []
+    original = server.DeadlineCollection.__getattr__
+
+    def counting(self, name):
+        if self._collection.name == "counters":
+            calls.append(name)
+        return original(self, name)
+    monkeypatch.setattr(server.DeadlineCollection, "__getattr__", counting)
+
+    async def scenario():
+        async with server.versioned_write(3) as first_version:
+            before_write = list(calls)
+            pending = await server.stable_version()
+        return before_write, first_version, pending, await server.stable_version()
+
+    before_write, first_version, pending, after = call(scenario)
+    monkeypatch.undo()
+    assert before_write == ["find_one_and_update"]
+    assert pending == first_version - 1
+    assert after >= first_version + 2